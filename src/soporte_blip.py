@@ -1,43 +1,175 @@
+import os
+import json
+import math
+import time
+import threading
+import numpy as np
 import pandas as pd
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from scipy import stats
+from scipy import sparse
 from PIL import Image
-import requests
-from io import BytesIO
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from src import soporte_cache as sc
 
-# Cargar el procesador y modelo BLIP
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+# El procesador y el modelo BLIP (y la librería transformers) se cargan la primera vez que se usan.
+# La ruta puede ser un identificador de Hugging Face o un directorio local con los pesos.
+ruta_modelo = os.getenv("ruta_modelo_blip", "Salesforce/blip-image-captioning-base")
+_processor = None
+_model = None
+_lock_modelo = threading.Lock()
+# Tamaño mínimo al que se decodifican las fotos (resolución de entrada de BLIP base)
+tamanio_decodificacion = 384
 
-def generar_descripciones(df, columna_url):
+
+def configurar_modelo(ruta):
+    """
+    Cambia el modelo BLIP a utilizar. Si ya había uno cargado, se descarta y se cargará el nuevo en el siguiente uso.
+
+    Args:
+        ruta (str): Identificador de Hugging Face o directorio local con el procesador y los pesos.
+    """
+    global ruta_modelo, _processor, _model
+    with _lock_modelo:
+        if ruta != ruta_modelo:
+            ruta_modelo = ruta
+            _processor, _model = None, None
+
+
+def cargar_modelo():
+    """
+    Devuelve el procesador y el modelo BLIP, cargándolos la primera vez que se piden.
+    Es seguro llamarla desde varios hilos: la carga se hace una sola vez.
+
+    Returns:
+        tuple: (BlipProcessor, BlipForConditionalGeneration)
+    """
+    global _processor, _model
+    if _model is None:
+        with _lock_modelo:
+            if _model is None:
+                from transformers import BlipProcessor, BlipForConditionalGeneration
+                _processor = BlipProcessor.from_pretrained(ruta_modelo)
+                _model = BlipForConditionalGeneration.from_pretrained(ruta_modelo)
+    return _processor, _model
+
+
+def warmup():
+    """
+    Carga el modelo BLIP y genera una descripción sobre una imagen vacía, para que la primera
+    imagen real no pague el coste de inicialización.
+
+    Returns:
+        float: Segundos empleados en la carga y la primera inferencia.
+    """
+    inicio = time.perf_counter()
+    processor, model = cargar_modelo()
+    inputs = processor(images=Image.new("RGB", (384, 384)), return_tensors="pt")
+    model.generate(**inputs, max_new_tokens=5)
+    return time.perf_counter() - inicio
+
+
+def _cargar_imagen(url_imagen):
+    """
+    Carga una imagen desde la caché local (o la descarga si no está). Devuelve None si falla.
+    """
+    try:
+        return sc.obtener_imagen(url_imagen, tamanio_minimo=tamanio_decodificacion)
+    except Exception:
+        return None
+
+
+def _preprocesar_imagen(processor, imagen, salida):
+    """
+    Escribe en `salida` (array float32 (3, alto, ancho)) el tensor de entrada de BLIP de una imagen, con las
+    transformaciones del procesador (redimensionar, reescalar y normalizar) pero sin crear un tensor nuevo por
+    imagen. Devuelve False si la imagen no se puede procesar.
+    """
+    try:
+        configuracion = processor.image_processor
+        alto, ancho = salida.shape[1:]
+        imagen = imagen.convert("RGB").resize((ancho, alto), configuracion.resample)
+        np.multiply(np.asarray(imagen).transpose(2, 0, 1), configuracion.rescale_factor, out=salida,
+                    casting="unsafe")
+        salida -= np.asarray(configuracion.image_mean, dtype=np.float32)[:, None, None]
+        salida /= np.asarray(configuracion.image_std, dtype=np.float32)[:, None, None]
+        return True
+    except Exception:
+        return False
+
+
+def _describir(processor, model, pixel_values, max_new_tokens):
+    """
+    Genera las descripciones de un lote de tensores de entrada ya apilados.
+    """
+    outputs = model.generate(pixel_values=pixel_values, max_new_tokens=max_new_tokens)
+    return [descripcion.strip() for descripcion in processor.batch_decode(outputs, skip_special_tokens=True)]
+
+
+def generar_descripciones(df, columna_url, tamanio_lote=8, hilos=None, max_new_tokens=30, hilos_descarga=8):
     """
     Genera descripciones de imágenes a partir de una columna de URLs en un DataFrame.
+    Las imágenes se procesan en lotes dentro de `torch.inference_mode`, mientras las del lote
+    siguiente se descargan en paralelo; todos los lotes se preprocesan sobre el mismo tensor de entrada. Las imágenes que no se pueden descargar o procesar se quitan
+    del lote, y si falla la generación del lote completo se repite imagen a imagen, de modo que una
+    foto defectuosa sólo deja sin descripción su propia fila.
 
     Args:
         df (pd.DataFrame): El DataFrame de entrada.
         columna_url (str): El nombre de la columna que contiene las URLs de las imágenes.
+        tamanio_lote (int): Número de imágenes que se describen en cada llamada al modelo.
+        hilos (int, opcional): Hilos de PyTorch para la inferencia. Por defecto, los que decida PyTorch.
+        max_new_tokens (int): Longitud máxima de cada descripción, en tokens.
+        hilos_descarga (int): Número de imágenes que se descargan en paralelo.
 
     Returns:
-        list: Una lista con las descripciones generadas (o None en caso de errores).
-    """
-    descripciones = []
-
-    for indice, url_imagen in tqdm(df[columna_url].items()):
-        try:
-            # Cargar la imagen desde la URL
-            response = requests.get(url_imagen)
-            response.raise_for_status()  # Verificar que la solicitud fue exitosa
-            image = Image.open(BytesIO(response.content)).convert("RGB")
-            
-            # Procesar la imagen y generar una descripción
-            inputs = processor(images=image, return_tensors="pt")
-            outputs = model.generate(**inputs)
-            descripcion = processor.decode(outputs[0], skip_special_tokens=True)
-            
-            # Agregar la descripción a los resultados
-            descripciones.append(descripcion)
-        except Exception as e:
-            descripciones.append(None)  # Agregar None en caso de errores
+        list: Una lista con las descripciones generadas (o None en caso de errores), en el orden de las filas.
+    """
+    import torch
+
+    processor, model = cargar_modelo()
+    if hilos:
+        torch.set_num_threads(hilos)
+
+    urls = df[columna_url].tolist()
+    descripciones = [None] * len(urls)
+    lotes = [list(range(i, min(i + tamanio_lote, len(urls)))) for i in range(0, len(urls), tamanio_lote)]
+    # Tensor de entrada reutilizado por todos los lotes (el último puede ocupar sólo una parte)
+    tamanio = processor.image_processor.size
+    entrada = torch.empty((tamanio_lote, 3, tamanio["height"], tamanio["width"]))
+
+    with ThreadPoolExecutor(max_workers=hilos_descarga) as executor, torch.inference_mode():
+        def descargar(lote):
+            return [executor.submit(_cargar_imagen, urls[i]) for i in lote]
+
+        pendientes = descargar(lotes[0]) if lotes else []
+        for numero, lote in enumerate(tqdm(lotes, desc="Generando descripciones")):
+            imagenes = [futuro.result() for futuro in pendientes]
+            # Descargar el lote siguiente mientras se procesa el actual
+            if numero + 1 < len(lotes):
+                pendientes = descargar(lotes[numero + 1])
+
+            # Procesar cada imagen por separado y quitar del lote las que no se pueden descargar o procesar
+            validas = []
+            for i, imagen in zip(lote, imagenes):
+                if imagen is None or not _preprocesar_imagen(processor, imagen, entrada[len(validas)].numpy()):
+                    print(f"Error procesando la imagen {urls[i]}")
+                else:
+                    validas.append(i)
+            if not validas:
+                continue
+            try:
+                # Generar las descripciones del lote (las salidas se rellenan con tokens de padding)
+                pixel_values = entrada[:len(validas)]
+                for i, descripcion in zip(validas, _describir(processor, model, pixel_values, max_new_tokens)):
+                    descripciones[i] = descripcion
+            except Exception as e:
+                print(f"Error generando descripciones del lote {numero}, se repite imagen a imagen: {e}")
+                for j, i in enumerate(validas):
+                    try:
+                        descripciones[i] = _describir(processor, model, entrada[j:j + 1], max_new_tokens)[0]
+                    except Exception as e:
+                        print(f"Error generando la descripción de {urls[i]}: {e}")
 
     return descripciones
 
@@ -66,4 +198,330 @@ def contar_palabras(frases, palabra):
             palabras = frase.lower().split()
             contador_palabras += palabras.count(palabra)
 
-    return contador_palabras
\ No newline at end of file
+    return contador_palabras
+
+
+def tamanio_muestra(poblacion, margen=0.05, confianza=0.95, proporcion=0.5):
+    """
+    Calcula el tamaño de muestra necesario para estimar una proporción con un margen de error dado,
+    aplicando la corrección por población finita.
+
+    Args:
+        poblacion (int): Número total de elementos.
+        margen (float): Semiamplitud deseada del intervalo de confianza (por ejemplo, 0.05 = ±5 puntos).
+        confianza (float): Nivel de confianza del intervalo.
+        proporcion (float): Proporción esperada. 0.5 es el caso más conservador.
+
+    Returns:
+        int: Tamaño de muestra (nunca mayor que la población).
+    """
+    if poblacion <= 0:
+        return 0
+    z = stats.norm.ppf(1 - (1 - confianza) / 2)
+    n0 = z ** 2 * proporcion * (1 - proporcion) / margen ** 2
+    return min(poblacion, math.ceil(n0 / (1 + (n0 - 1) / poblacion)))
+
+
+def intervalo_wilson(aciertos, n, confianza=0.95):
+    """
+    Calcula el intervalo de confianza de Wilson para una proporción, más fiable que el normal
+    cuando la proporción está cerca de 0 o 1.
+
+    Args:
+        aciertos (int): Número de éxitos.
+        n (int): Número de observaciones.
+        confianza (float): Nivel de confianza.
+
+    Returns:
+        tuple: (límite inferior, límite superior).
+    """
+    if n == 0:
+        return 0.0, 1.0
+    z = stats.norm.ppf(1 - (1 - confianza) / 2)
+    p = aciertos / n
+    centro = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    semiamplitud = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return max(0.0, centro - semiamplitud), min(1.0, centro + semiamplitud)
+
+
+def auditar_precision(df, columnas=None, margen=0.05, confianza=0.95, proporcion_esperada=0.5,
+                      columna_estrato=None, semilla=42, **kwargs):
+    """
+    Estima la precisión de la detección de habitaciones de YOLO describiendo con BLIP sólo una muestra
+    aleatoria estratificada, en lugar de todas las imágenes. Una imagen se considera correcta si su
+    descripción contiene alguna de las palabras esperadas para su columna.
+
+    Para cada columna se calcula el tamaño de muestra necesario para el margen y la confianza pedidos,
+    y se reparte proporcionalmente entre los estratos (al menos una imagen por estrato).
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas de URLs a auditar.
+        columnas (dict, opcional): Columna de URLs -> palabra o lista de palabras esperadas.
+            Por defecto, {"url_cocina": "kitchen", "url_banio": "bathroom"}.
+        margen (float): Semiamplitud deseada del intervalo de confianza.
+        confianza (float): Nivel de confianza del intervalo.
+        proporcion_esperada (float): Precisión esperada para dimensionar la muestra (0.5 es lo más conservador).
+        columna_estrato (str, opcional): Columna adicional por la que estratificar (por ejemplo, 'distrito').
+        semilla (int): Semilla del muestreo aleatorio.
+        **kwargs: Argumentos adicionales para `generar_descripciones` (tamanio_lote, hilos...).
+
+    Returns:
+        pd.DataFrame: Resumen por columna con población, muestra, aciertos, precisión estimada e intervalo.
+        pd.DataFrame: Muestra auditada, con la descripción generada y si contiene la palabra esperada.
+    """
+    columnas = columnas or {"url_cocina": "kitchen", "url_banio": "bathroom"}
+    resumen, muestras = [], []
+
+    for columna, palabras in columnas.items():
+        palabras = [palabras] if isinstance(palabras, str) else list(palabras)
+        poblacion = df[df[columna].notna()]
+        n = tamanio_muestra(len(poblacion), margen, confianza, proporcion_esperada)
+        if n == 0:
+            continue
+
+        # Muestreo estratificado con asignación proporcional
+        estratos = poblacion.groupby(columna_estrato, dropna=False) if columna_estrato else [(None, poblacion)]
+        partes = []
+        for _, estrato in estratos:
+            n_estrato = min(len(estrato), max(1, round(n * len(estrato) / len(poblacion))))
+            partes.append(estrato.sample(n=n_estrato, random_state=semilla))
+        muestra = pd.concat(partes)
+
+        descripciones = generar_descripciones(muestra, columna, **kwargs)
+        muestra = pd.DataFrame({
+            "columna": columna,
+            "estrato": muestra[columna_estrato].values if columna_estrato else None,
+            "url": muestra[columna].values,
+            "descripcion": descripciones,
+        }, index=muestra.index)
+        muestra["correcta"] = muestra["descripcion"].apply(
+            lambda d: isinstance(d, str) and any(p.lower() in d.lower().split() for p in palabras)
+        )
+        # Las imágenes sin descripción no cuentan ni como acierto ni como error
+        evaluada = muestra[muestra["descripcion"].notna()]
+
+        if columna_estrato:
+            # Estimador estratificado: media de las precisiones de cada estrato ponderada por su peso en la población
+            pesos = poblacion[columna_estrato].value_counts(normalize=True, dropna=False)
+            por_estrato = evaluada.groupby("estrato", dropna=False)["correcta"].agg(["mean", "count"])
+            por_estrato["peso"] = pesos.reindex(por_estrato.index).values
+            por_estrato["peso"] /= por_estrato["peso"].sum()
+            precision = (por_estrato["peso"] * por_estrato["mean"]).sum()
+            varianza = (por_estrato["peso"] ** 2 * por_estrato["mean"] * (1 - por_estrato["mean"])
+                        / por_estrato["count"]).sum() * (1 - len(evaluada) / len(poblacion))
+            z = stats.norm.ppf(1 - (1 - confianza) / 2)
+            limite_inferior, limite_superior = max(0.0, precision - z * np.sqrt(varianza)), min(1.0, precision + z * np.sqrt(varianza))
+            if varianza == 0:
+                # Todos los estratos con precisión 0 o 1: el intervalo normal degenera y se usa el de Wilson
+                limite_inferior, limite_superior = intervalo_wilson(evaluada["correcta"].sum(), len(evaluada), confianza)
+        else:
+            precision = evaluada["correcta"].mean() if len(evaluada) else np.nan
+            limite_inferior, limite_superior = intervalo_wilson(evaluada["correcta"].sum(), len(evaluada), confianza)
+
+        resumen.append({
+            "columna": columna,
+            "poblacion": len(poblacion),
+            "muestra": len(evaluada),
+            "aciertos": int(evaluada["correcta"].sum()),
+            "precision": precision,
+            "limite_inferior": limite_inferior,
+            "limite_superior": limite_superior,
+            "fraccion_descrita": len(muestra) / len(poblacion),
+        })
+        muestras.append(muestra)
+
+    return pd.DataFrame(resumen), pd.concat(muestras) if muestras else pd.DataFrame()
+
+
+class IndiceDescripciones:
+    """
+    Índice de términos sobre las descripciones generadas por BLIP. Cada descripción se tokeniza una sola vez
+    (minúsculas y separación por espacios, igual que `contar_palabras`) en una matriz dispersa de frecuencias
+    (una fila por descripción, una columna por término del vocabulario), de modo que las consultas por varias
+    palabras, por anuncio o por habitación se resuelven con operaciones vectorizadas.
+    """
+
+    def __init__(self, descripciones, anuncios=None, habitaciones=None):
+        """
+        Args:
+            descripciones (list): Descripciones (pueden contener None).
+            anuncios (list, opcional): Identificador del anuncio de cada descripción (por ejemplo, 'codigo').
+            habitaciones (list, opcional): Habitación de cada descripción (por ejemplo, "kitchen" o "bathroom").
+        """
+        self.descripciones = list(descripciones)
+        n = len(self.descripciones)
+        self.metadatos = pd.DataFrame({
+            "anuncio": list(anuncios) if anuncios is not None else [None] * n,
+            "habitacion": list(habitaciones) if habitaciones is not None else [None] * n,
+        })
+
+        self.vocabulario = {}
+        filas, columnas = [], []
+        for fila, descripcion in enumerate(self.descripciones):
+            if not isinstance(descripcion, str):
+                continue
+            for termino in descripcion.lower().split():
+                filas.append(fila)
+                columnas.append(self.vocabulario.setdefault(termino, len(self.vocabulario)))
+        # Las parejas (fila, término) repetidas se suman al construir la matriz
+        self.matriz = sparse.csr_matrix(
+            (np.ones(len(filas), dtype=np.int32), (filas, columnas)), shape=(n, len(self.vocabulario))
+        )
+        # Matrices indicadoras de grupo ya construidas, por columna de agrupación
+        self._indicadoras = {}
+
+    @classmethod
+    def desde_listas(cls, descripciones_por_habitacion, anuncios=None):
+        """
+        Crea el índice a partir de varias listas de descripciones alineadas con las filas de un DataFrame,
+        por ejemplo las devueltas por `generar_descripciones` para 'url_cocina' y 'url_banio'.
+
+        Args:
+            descripciones_por_habitacion (dict): Habitación -> lista de descripciones.
+            anuncios (list, opcional): Identificador del anuncio de cada fila, común a todas las listas.
+
+        Returns:
+            IndiceDescripciones: Índice con una fila por descripción.
+        """
+        descripciones, lista_anuncios, habitaciones = [], [], []
+        for habitacion, lista in descripciones_por_habitacion.items():
+            descripciones.extend(lista)
+            lista_anuncios.extend(list(anuncios) if anuncios is not None else [None] * len(lista))
+            habitaciones.extend([habitacion] * len(lista))
+        return cls(descripciones, lista_anuncios, habitaciones)
+
+    def _indicadora(self, por):
+        """
+        Devuelve los grupos de la columna `por` (en orden de aparición, "ND" para los nulos) y la matriz
+        dispersa (descripciones x grupos) que vale 1 en el grupo de cada descripción. Se construye una sola
+        vez por columna.
+        """
+        if por not in self._indicadoras:
+            codigos, grupos = pd.factorize(self.metadatos[por].fillna("ND"))
+            indicadora = sparse.csr_matrix(
+                (np.ones(len(codigos), dtype=np.int32), (np.arange(len(codigos)), codigos)),
+                shape=(len(codigos), len(grupos)),
+            )
+            self._indicadoras[por] = (grupos, indicadora)
+        return self._indicadoras[por]
+
+    def _columnas(self, palabras):
+        palabras = [palabras] if isinstance(palabras, str) else palabras
+        return [self.vocabulario.get(palabra.lower()) for palabra in palabras]
+
+    def contar(self, palabra):
+        """
+        Cuenta cuántas veces aparece una palabra en todas las descripciones (equivalente a `contar_palabras`).
+
+        Args:
+            palabra (str): Palabra a contar (no distingue mayúsculas y minúsculas).
+
+        Returns:
+            int: Número total de apariciones.
+        """
+        columna = self._columnas(palabra)[0]
+        return 0 if columna is None else int(self.matriz[:, columna].sum())
+
+    def mascara(self, palabras, modo="todas"):
+        """
+        Indica qué descripciones mencionan las palabras indicadas.
+
+        Args:
+            palabras (str o list): Palabra o lista de palabras.
+            modo (str): "todas" (deben aparecer todas) o "alguna" (basta con una).
+
+        Returns:
+            np.ndarray: Array booleano con una posición por descripción.
+        """
+        columnas = self._columnas(palabras)
+        presentes = [c for c in columnas if c is not None]
+        if modo == "todas" and len(presentes) < len(columnas):
+            return np.zeros(self.matriz.shape[0], dtype=bool)
+        if not presentes:
+            return np.zeros(self.matriz.shape[0], dtype=bool)
+
+        apariciones = (self.matriz[:, presentes] > 0).sum(axis=1).A1
+        return apariciones == len(presentes) if modo == "todas" else apariciones > 0
+
+    def consultar(self, palabras, modo="todas", por=None):
+        """
+        Cuenta las descripciones que mencionan las palabras indicadas, en total o agrupadas.
+
+        Args:
+            palabras (str o list): Palabra o lista de palabras, por ejemplo ["sink", "kitchen"].
+            modo (str): "todas" o "alguna".
+            por (str, opcional): "anuncio" o "habitacion" para agrupar el resultado.
+
+        Returns:
+            int o pd.DataFrame: Número de descripciones coincidentes o, si se agrupa, un DataFrame con
+                las coincidencias, el total de descripciones y la proporción por grupo.
+        """
+        mascara = self.mascara(palabras, modo)
+        if por is None:
+            return int(mascara.sum())
+
+        validas = np.array([isinstance(d, str) for d in self.descripciones])
+        agrupado = pd.DataFrame({por: self.metadatos[por], "coincidencias": mascara, "descripciones": validas})
+        agrupado = agrupado.groupby(por, dropna=False)[["coincidencias", "descripciones"]].sum()
+        agrupado["proporcion"] = agrupado["coincidencias"] / agrupado["descripciones"].replace(0, np.nan)
+        return agrupado
+
+    def frecuencias(self, top=20, por=None):
+        """
+        Devuelve los términos más frecuentes, en total o por grupo.
+
+        Args:
+            top (int): Número de términos a devolver.
+            por (str, opcional): "anuncio" o "habitacion" para obtener las frecuencias de cada grupo.
+
+        Returns:
+            pd.Series o pd.DataFrame: Frecuencia de los términos (columnas = grupos si se agrupa).
+        """
+        terminos = np.array(sorted(self.vocabulario, key=self.vocabulario.get))
+        totales = pd.Series(self.matriz.sum(axis=0).A1, index=terminos).nlargest(top)
+        if por is None:
+            return totales
+
+        # Frecuencias de todos los grupos en un solo producto (grupos x términos) sobre los términos más frecuentes
+        grupos, indicadora = self._indicadora(por)
+        columnas = [self.vocabulario[termino] for termino in totales.index]
+        por_grupo = (indicadora.T @ self.matriz[:, columnas]).toarray()
+        return pd.DataFrame(por_grupo.T, index=totales.index, columns=grupos)
+
+    def guardar(self, ruta):
+        """
+        Guarda el índice junto a las descripciones: la matriz en `ruta`.npz y el vocabulario,
+        las descripciones y los metadatos en `ruta`.json.
+
+        Args:
+            ruta (str): Ruta base de los ficheros, sin extensión.
+        """
+        sparse.save_npz(f"{ruta}.npz", self.matriz)
+        with open(f"{ruta}.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "vocabulario": self.vocabulario,
+                "descripciones": self.descripciones,
+                "anuncios": self.metadatos["anuncio"].tolist(),
+                "habitaciones": self.metadatos["habitacion"].tolist(),
+            }, f, ensure_ascii=False, default=str)
+
+    @classmethod
+    def cargar(cls, ruta):
+        """
+        Carga un índice guardado con `guardar`, sin volver a generar ni tokenizar las descripciones.
+
+        Args:
+            ruta (str): Ruta base de los ficheros, sin extensión.
+
+        Returns:
+            IndiceDescripciones: Índice cargado.
+        """
+        with open(f"{ruta}.json", encoding="utf-8") as f:
+            datos = json.load(f)
+        indice = cls.__new__(cls)
+        indice.descripciones = datos["descripciones"]
+        indice.metadatos = pd.DataFrame({"anuncio": datos["anuncios"], "habitacion": datos["habitaciones"]})
+        indice.vocabulario = datos["vocabulario"]
+        indice.matriz = sparse.load_npz(f"{ruta}.npz").tocsr()
+        indice._indicadoras = {}
+        return indice
@@ -0,0 +1,445 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+import numpy as np
+from io import BytesIO
+from typing import Dict, List, Optional
+from PIL import Image
+from scipy.fft import dctn
+
+
+# Directorio de la caché en disco y tamaño máximo (se pueden sobreescribir con variables de entorno)
+DIRECTORIO_CACHE = os.getenv(
+    "cache_imagenes",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "cache_imagenes")
+)
+TAMANIO_MAXIMO_MB = float(os.getenv("cache_imagenes_mb", 2048))
+
+# Lado largo por defecto de la versión reducida y normalizada de cada imagen
+LADO_REDUCIDO = 512
+# Tamaño al que se decodifican las imágenes para calcular su hash perceptual
+LADO_HASH_PERCEPTUAL = 64
+
+_lock = threading.RLock()
+_conexion = None
+_pid_conexion = None
+_estadisticas = {"aciertos": 0, "fallos": 0, "desalojos": 0}
+
+
+def configurar_cache(directorio: Optional[str] = None, tamanio_maximo_mb: Optional[float] = None) -> None:
+    """
+    Cambia el directorio y/o el tamaño máximo de la caché de imágenes.
+
+    Args:
+        directorio (Optional[str]): Nueva ruta de la caché. Si es None se mantiene la actual.
+        tamanio_maximo_mb (Optional[float]): Tamaño máximo en MB antes de desalojar imágenes (LRU).
+    """
+    global DIRECTORIO_CACHE, TAMANIO_MAXIMO_MB, _conexion
+    with _lock:
+        if directorio is not None and os.path.abspath(directorio) != os.path.abspath(DIRECTORIO_CACHE):
+            if _conexion is not None:
+                _conexion.close()
+                _conexion = None
+            DIRECTORIO_CACHE = directorio
+        if tamanio_maximo_mb is not None:
+            TAMANIO_MAXIMO_MB = float(tamanio_maximo_mb)
+            _desalojar()
+
+
+def _obtener_conexion() -> sqlite3.Connection:
+    """
+    Abre (una vez por proceso) el índice SQLite de la caché y crea las tablas si no existen.
+    """
+    global _conexion, _pid_conexion
+    if _conexion is None or _pid_conexion != os.getpid():
+        os.makedirs(os.path.join(DIRECTORIO_CACHE, "ficheros"), exist_ok=True)
+        _conexion = sqlite3.connect(
+            os.path.join(DIRECTORIO_CACHE, "indice.sqlite"), timeout=30, check_same_thread=False
+        )
+        _conexion.execute("PRAGMA journal_mode=WAL")
+        _conexion.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url_hash TEXT PRIMARY KEY, url TEXT, contenido_hash TEXT)"
+        )
+        _conexion.execute(
+            "CREATE TABLE IF NOT EXISTS perceptuales (contenido_hash TEXT, metodo TEXT, valor TEXT, PRIMARY KEY (contenido_hash, metodo))"
+        )
+        _conexion.execute(
+            """CREATE TABLE IF NOT EXISTS ficheros (
+                nombre TEXT PRIMARY KEY, contenido_hash TEXT, bytes INTEGER, ultimo_acceso REAL
+            )"""
+        )
+        _conexion.commit()
+        _pid_conexion = os.getpid()
+    return _conexion
+
+
+def _hash(datos: bytes) -> str:
+    return hashlib.sha256(datos).hexdigest()
+
+
+def _ruta(nombre: str) -> str:
+    return os.path.join(DIRECTORIO_CACHE, "ficheros", nombre[:2], nombre)
+
+
+def _leer(nombre: str) -> Optional[bytes]:
+    """
+    Lee un fichero de la caché y actualiza su último acceso. Devuelve None si ha sido desalojado.
+    """
+    ruta = _ruta(nombre)
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, "rb") as f:
+        datos = f.read()
+    conexion = _obtener_conexion()
+    conexion.execute("UPDATE ficheros SET ultimo_acceso = ? WHERE nombre = ?", (time.time(), nombre))
+    conexion.commit()
+    return datos
+
+
+def _escribir(nombre: str, contenido_hash: str, datos: bytes) -> None:
+    """
+    Escribe un fichero en la caché de forma atómica, lo registra en el índice y desaloja si es necesario.
+    """
+    ruta = _ruta(nombre)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+    conexion = _obtener_conexion()
+    conexion.execute(
+        "INSERT OR REPLACE INTO ficheros (nombre, contenido_hash, bytes, ultimo_acceso) VALUES (?, ?, ?, ?)",
+        (nombre, contenido_hash, len(datos), time.time())
+    )
+    conexion.commit()
+    _desalojar()
+
+
+def _desalojar() -> None:
+    """
+    Elimina los ficheros menos usados recientemente hasta que la caché quede por debajo del tamaño máximo.
+    """
+    conexion = _obtener_conexion()
+    total = conexion.execute("SELECT COALESCE(SUM(bytes), 0) FROM ficheros").fetchone()[0]
+    limite = TAMANIO_MAXIMO_MB * 1024 * 1024
+    if total <= limite:
+        return
+
+    for nombre, tamanio in conexion.execute(
+        "SELECT nombre, bytes FROM ficheros ORDER BY ultimo_acceso ASC"
+    ).fetchall():
+        if total <= limite:
+            break
+        try:
+            os.remove(_ruta(nombre))
+        except FileNotFoundError:
+            pass
+        conexion.execute("DELETE FROM ficheros WHERE nombre = ?", (nombre,))
+        total -= tamanio
+        _estadisticas["desalojos"] += 1
+    conexion.commit()
+
+
+def hash_contenido(url: str, timeout: int = 10) -> str:
+    """
+    Devuelve el hash SHA-256 del contenido de la imagen de una URL, descargándola si no está en caché.
+
+    Args:
+        url (str): URL de la imagen.
+        timeout (int): Tiempo máximo de espera de la descarga en segundos.
+
+    Returns:
+        str: Hash hexadecimal del contenido original.
+    """
+    with _lock:
+        fila = _obtener_conexion().execute(
+            "SELECT contenido_hash FROM urls WHERE url_hash = ?", (_hash(url.encode()),)
+        ).fetchone()
+    if fila and os.path.exists(_ruta(f"{fila[0]}.orig")):
+        return fila[0]
+    return _hash(obtener_bytes(url, timeout=timeout))
+
+
+def obtener_bytes(url: str, timeout: int = 10) -> bytes:
+    """
+    Devuelve los bytes originales de la imagen de una URL, leyéndolos de la caché en disco
+    o descargándolos (y guardándolos) si no están disponibles.
+
+    Args:
+        url (str): URL de la imagen.
+        timeout (int): Tiempo máximo de espera de la descarga en segundos.
+
+    Returns:
+        bytes: Contenido original de la imagen.
+
+    Raises:
+        requests.HTTPError: Si la descarga falla.
+    """
+    url_hash = _hash(url.encode())
+    with _lock:
+        fila = _obtener_conexion().execute(
+            "SELECT contenido_hash FROM urls WHERE url_hash = ?", (url_hash,)
+        ).fetchone()
+        if fila:
+            datos = _leer(f"{fila[0]}.orig")
+            if datos is not None:
+                _estadisticas["aciertos"] += 1
+                return datos
+
+    # La descarga se hace fuera del bloqueo para no serializar las peticiones entre hilos
+    respuesta = requests.get(url, timeout=timeout)
+    respuesta.raise_for_status()
+    datos = respuesta.content
+    contenido_hash = _hash(datos)
+
+    with _lock:
+        _estadisticas["fallos"] += 1
+        conexion = _obtener_conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO urls (url_hash, url, contenido_hash) VALUES (?, ?, ?)",
+            (url_hash, url, contenido_hash)
+        )
+        conexion.commit()
+        # Varias URLs pueden apuntar al mismo contenido: sólo se guarda una copia
+        if not os.path.exists(_ruta(f"{contenido_hash}.orig")):
+            _escribir(f"{contenido_hash}.orig", contenido_hash, datos)
+    return datos
+
+
+def decodificar(datos: bytes, tamanio_minimo: Optional[int] = None) -> Image.Image:
+    """
+    Decodifica los bytes de una imagen a un objeto PIL en RGB. Si se indica un tamaño mínimo y la imagen
+    es JPEG, usa el modo draft de PIL para que el decodificador aplique el escalado DCT (1/2, 1/4 o 1/8)
+    y genere directamente una imagen cercana al tamaño de entrada del modelo, sin decodificar la resolución completa.
+
+    Args:
+        datos (bytes): Contenido de la imagen.
+        tamanio_minimo (Optional[int]): Tamaño mínimo que deben conservar ambos lados tras el escalado.
+
+    Returns:
+        PIL.Image.Image: Imagen en modo RGB (ambos lados >= tamanio_minimo si la original lo permitía).
+    """
+    imagen = Image.open(BytesIO(datos))
+    if tamanio_minimo:
+        # Sin efecto en formatos distintos de JPEG
+        imagen.draft("RGB", (tamanio_minimo, tamanio_minimo))
+    return imagen.convert("RGB")
+
+
+def obtener_imagen(url: str, lado: Optional[int] = None, timeout: int = 10,
+                   tamanio_minimo: Optional[int] = None) -> Image.Image:
+    """
+    Devuelve la imagen de una URL como objeto PIL en RGB, usando la caché en disco.
+
+    Args:
+        url (str): URL de la imagen.
+        lado (Optional[int]): Si se indica, devuelve la versión normalizada (RGB, JPEG) reducida
+            a ese lado largo, que también se guarda en la caché. Si es None, devuelve la original.
+        timeout (int): Tiempo máximo de espera de la descarga en segundos.
+        tamanio_minimo (Optional[int]): Si se indica (y lado es None), decodifica la original a resolución
+            reducida conservando al menos este tamaño en ambos lados (ver `decodificar`).
+
+    Returns:
+        PIL.Image.Image: Imagen en modo RGB.
+    """
+    datos = obtener_bytes(url, timeout=timeout)
+    if lado is None:
+        return decodificar(datos, tamanio_minimo)
+
+    contenido_hash = _hash(datos)
+    nombre = f"{contenido_hash}.{lado}.jpg"
+    with _lock:
+        reducida = _leer(nombre)
+    if reducida is not None:
+        return decodificar(reducida)
+
+    imagen = decodificar(datos, lado)
+    imagen.thumbnail((lado, lado))
+    buffer = BytesIO()
+    imagen.save(buffer, format="JPEG", quality=90)
+    with _lock:
+        _escribir(nombre, contenido_hash, buffer.getvalue())
+    return imagen
+
+
+def calcular_hash_perceptual(imagen: Image.Image, metodo: str = "phash") -> int:
+    """
+    Calcula el hash perceptual de 64 bits de una imagen. Imágenes casi idénticas (recomprimidas,
+    redimensionadas o con pequeños cambios) tienen hashes a poca distancia de Hamming.
+
+    Args:
+        imagen (PIL.Image.Image): Imagen a procesar.
+        metodo (str): "phash" (DCT de 32x32, más robusto) o "dhash" (diferencias entre píxeles vecinos, más rápido).
+
+    Returns:
+        int: Hash de 64 bits.
+    """
+    gris = imagen.convert("L")
+    if metodo == "dhash":
+        pixeles = np.asarray(gris.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+        bits = (pixeles[:, 1:] > pixeles[:, :-1]).flatten()
+    elif metodo == "phash":
+        pixeles = np.asarray(gris.resize((32, 32), Image.LANCZOS), dtype=np.float32)
+        frecuencias = dctn(pixeles, norm="ortho")[:8, :8].flatten()
+        # La componente continua no se usa para calcular la mediana
+        bits = frecuencias > np.median(frecuencias[1:])
+    else:
+        raise ValueError(f"Método de hash perceptual no soportado: {metodo}")
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hash_perceptual(url: str, metodo: str = "phash") -> int:
+    """
+    Devuelve el hash perceptual de la imagen de una URL, calculado sobre la decodificación reducida
+    y guardado en el índice de la caché para no recalcularlo.
+
+    Args:
+        url (str): URL de la imagen.
+        metodo (str): "phash" o "dhash".
+
+    Returns:
+        int: Hash de 64 bits.
+    """
+    datos = obtener_bytes(url)
+    contenido_hash = _hash(datos)
+    with _lock:
+        fila = _obtener_conexion().execute(
+            "SELECT valor FROM perceptuales WHERE contenido_hash = ? AND metodo = ?", (contenido_hash, metodo)
+        ).fetchone()
+    if fila:
+        return int(fila[0], 16)
+
+    valor = calcular_hash_perceptual(decodificar(datos, LADO_HASH_PERCEPTUAL), metodo)
+    with _lock:
+        conexion = _obtener_conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO perceptuales (contenido_hash, metodo, valor) VALUES (?, ?, ?)",
+            (contenido_hash, metodo, f"{valor:016x}")
+        )
+        conexion.commit()
+    return valor
+
+
+def distancia_hamming(hash_a: int, hash_b: int) -> int:
+    """
+    Devuelve el número de bits distintos entre dos hashes perceptuales.
+    """
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class IndicePerceptual:
+    """
+    Índice incremental de hashes perceptuales que agrupa imágenes casi idénticas. Para no comparar cada
+    hash con todos los anteriores, divide los 64 bits en `distancia_maxima + 1` bandas: dos hashes a distancia
+    menor o igual que `distancia_maxima` coinciden necesariamente en al menos una banda completa.
+    """
+
+    def __init__(self, distancia_maxima: int = 4):
+        self.distancia_maxima = distancia_maxima
+        n_bandas = distancia_maxima + 1
+        limites = [int(limite) for limite in np.linspace(0, 64, n_bandas + 1)]
+        self.bandas = list(zip(limites[:-1], limites[1:]))
+        self.buckets = [{} for _ in self.bandas]
+        self.hashes = {}
+        self.representantes = {}
+        self.consultas = 0
+        self.duplicados = 0
+
+    def _claves(self, valor: int) -> List[int]:
+        return [(valor >> inicio) & ((1 << (fin - inicio)) - 1) for inicio, fin in self.bandas]
+
+    def buscar(self, valor: int) -> Optional[str]:
+        """
+        Devuelve el representante del grupo más cercano a un hash, o None si no hay ninguno a distancia suficiente.
+        """
+        mejor, mejor_distancia = None, self.distancia_maxima + 1
+        for bucket, clave in zip(self.buckets, self._claves(valor)):
+            for candidato in bucket.get(clave, []):
+                distancia = distancia_hamming(valor, self.hashes[candidato])
+                if distancia < mejor_distancia:
+                    mejor, mejor_distancia = candidato, distancia
+        return self.representantes[mejor] if mejor is not None else None
+
+    def agregar(self, identificador: str, valor: int) -> str:
+        """
+        Añade una imagen al índice y devuelve el representante de su grupo (ella misma si es la primera).
+        """
+        self.consultas += 1
+        if identificador in self.representantes:
+            return self.representantes[identificador]
+
+        representante = self.buscar(valor)
+        if representante is None:
+            representante = identificador
+        else:
+            self.duplicados += 1
+        self.hashes[identificador] = valor
+        self.representantes[identificador] = representante
+        for bucket, clave in zip(self.buckets, self._claves(valor)):
+            bucket.setdefault(clave, []).append(identificador)
+        return representante
+
+    def resumen(self) -> dict:
+        """
+        Devuelve cuántas imágenes se han indexado, cuántas eran duplicadas y en cuántos grupos se reparten.
+        """
+        imagenes = len(self.representantes)
+        grupos = len(set(self.representantes.values()))
+        return {
+            "imagenes": imagenes,
+            "grupos": grupos,
+            "duplicadas": imagenes - grupos,
+            "tasa_duplicados": (imagenes - grupos) / imagenes if imagenes else 0.0,
+        }
+
+
+def agrupar_duplicados(urls: List[str], distancia_maxima: int = 4, metodo: str = "phash") -> Dict[str, str]:
+    """
+    Agrupa las imágenes casi idénticas de una lista de URLs por su hash perceptual.
+
+    Args:
+        urls (List[str]): URLs de las imágenes.
+        distancia_maxima (int): Distancia de Hamming máxima para considerar dos imágenes duplicadas.
+        metodo (str): "phash" o "dhash".
+
+    Returns:
+        Dict[str, str]: URL -> URL representante de su grupo (la primera del grupo en el orden recibido).
+            Las URLs que no se han podido descargar se representan a sí mismas.
+    """
+    indice = IndicePerceptual(distancia_maxima)
+    representantes = {}
+    for url in urls:
+        if url in representantes:
+            continue
+        try:
+            representantes[url] = indice.agregar(url, hash_perceptual(url, metodo))
+        except Exception as e:
+            print(f"Error calculando el hash perceptual de {url}: {e}")
+            representantes[url] = url
+    resumen = indice.resumen()
+    print(f"Imágenes duplicadas: {resumen['duplicadas']} de {resumen['imagenes']} ({resumen['tasa_duplicados']:.1%}).")
+    return representantes
+
+
+def estadisticas_cache() -> dict:
+    """
+    Devuelve las métricas de uso de la caché en el proceso actual y su ocupación en disco.
+
+    Returns:
+        dict: Aciertos, fallos, tasa de aciertos, desalojos, número de ficheros y MB ocupados.
+    """
+    with _lock:
+        ficheros, total = _obtener_conexion().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM ficheros"
+        ).fetchone()
+        consultas = _estadisticas["aciertos"] + _estadisticas["fallos"]
+        return {
+            **_estadisticas,
+            "tasa_aciertos": _estadisticas["aciertos"] / consultas if consultas else 0.0,
+            "ficheros": ficheros,
+            "mb_ocupados": total / (1024 * 1024),
+        }
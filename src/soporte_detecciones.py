@@ -0,0 +1,190 @@
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Tuple
+
+
+# Fichero SQLite donde se guardan las clasificaciones de cada imagen (se puede sobreescribir con una variable de entorno)
+RUTA_ALMACEN = os.getenv(
+    "almacen_detecciones",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "detecciones.sqlite")
+)
+
+_lock = threading.RLock()
+_conexion = None
+_pid_conexion = None
+_estadisticas = {"aciertos": 0, "fallos": 0}
+
+
+def configurar_almacen(ruta: str) -> None:
+    """
+    Cambia el fichero SQLite del almacén de detecciones.
+
+    Args:
+        ruta (str): Ruta del nuevo fichero. Se crea si no existe.
+    """
+    global RUTA_ALMACEN, _conexion
+    with _lock:
+        if _conexion is not None:
+            _conexion.close()
+            _conexion = None
+        RUTA_ALMACEN = ruta
+
+
+def _obtener_conexion() -> sqlite3.Connection:
+    """
+    Abre (una vez por proceso) el almacén y crea las tablas si no existen.
+    Cada clasificación se guarda como los índices de clase del top-k (int16) y sus probabilidades (float16).
+    """
+    global _conexion, _pid_conexion
+    if _conexion is None or _pid_conexion != os.getpid():
+        os.makedirs(os.path.dirname(os.path.abspath(RUTA_ALMACEN)), exist_ok=True)
+        _conexion = sqlite3.connect(RUTA_ALMACEN, timeout=30, check_same_thread=False)
+        _conexion.execute("PRAGMA journal_mode=WAL")
+        _conexion.execute(
+            """CREATE TABLE IF NOT EXISTS detecciones (
+                contenido_hash TEXT, modelo TEXT, indices BLOB, probs BLOB,
+                PRIMARY KEY (contenido_hash, modelo)
+            )"""
+        )
+        _conexion.execute("CREATE TABLE IF NOT EXISTS modelos (modelo TEXT PRIMARY KEY, nombres TEXT)")
+        _conexion.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, contenido_hash TEXT)")
+        _conexion.commit()
+        _pid_conexion = os.getpid()
+    return _conexion
+
+
+def guardar_nombres(modelo: str, nombres: Dict[int, str]) -> None:
+    """
+    Guarda el diccionario índice -> nombre de clase de un modelo, si no estaba guardado.
+
+    Args:
+        modelo (str): Identificador del modelo (por ejemplo, "yolo11x-cls|pytorch").
+        nombres (Dict[int, str]): Nombres de las clases del modelo.
+    """
+    with _lock:
+        conexion = _obtener_conexion()
+        conexion.execute(
+            "INSERT OR IGNORE INTO modelos (modelo, nombres) VALUES (?, ?)",
+            (modelo, json.dumps({int(k): v for k, v in nombres.items()}))
+        )
+        conexion.commit()
+
+
+def obtener_nombres(modelo: str) -> Optional[Dict[int, str]]:
+    """
+    Devuelve el diccionario índice -> nombre de clase guardado para un modelo, o None si no existe.
+
+    Args:
+        modelo (str): Identificador del modelo.
+
+    Returns:
+        Optional[Dict[int, str]]: Nombres de las clases.
+    """
+    with _lock:
+        fila = _obtener_conexion().execute("SELECT nombres FROM modelos WHERE modelo = ?", (modelo,)).fetchone()
+    return {int(k): v for k, v in json.loads(fila[0]).items()} if fila else None
+
+
+def guardar(contenido_hash: str, modelo: str, indices: List[int], probs: List[float], url: Optional[str] = None) -> None:
+    """
+    Guarda la clasificación de una imagen.
+
+    Args:
+        contenido_hash (str): Hash del contenido de la imagen.
+        modelo (str): Identificador del modelo que la ha clasificado.
+        indices (List[int]): Índices de clase del top-k.
+        probs (List[float]): Probabilidades del top-k.
+        url (Optional[str]): URL de la imagen, para poder reetiquetar sin volver a descargarla.
+    """
+    with _lock:
+        conexion = _obtener_conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO detecciones (contenido_hash, modelo, indices, probs) VALUES (?, ?, ?, ?)",
+            (contenido_hash, modelo, np.asarray(indices, dtype=np.int16).tobytes(),
+             np.asarray(probs, dtype=np.float16).tobytes())
+        )
+        if url is not None:
+            conexion.execute("INSERT OR REPLACE INTO urls (url, contenido_hash) VALUES (?, ?)", (url, contenido_hash))
+        conexion.commit()
+
+
+def consultar(contenido_hash: str, modelo: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Devuelve la clasificación guardada de una imagen, o None si no se ha clasificado con ese modelo.
+
+    Args:
+        contenido_hash (str): Hash del contenido de la imagen.
+        modelo (str): Identificador del modelo.
+
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray]]: Índices (int16) y probabilidades (float16) del top-k.
+    """
+    with _lock:
+        fila = _obtener_conexion().execute(
+            "SELECT indices, probs FROM detecciones WHERE contenido_hash = ? AND modelo = ?", (contenido_hash, modelo)
+        ).fetchone()
+        _estadisticas["aciertos" if fila else "fallos"] += 1
+    if fila is None:
+        return None
+    return np.frombuffer(fila[0], dtype=np.int16), np.frombuffer(fila[1], dtype=np.float16)
+
+
+def hash_de_url(url: str) -> Optional[str]:
+    """
+    Devuelve el hash del contenido registrado para una URL, o None si la URL no se ha clasificado.
+
+    Args:
+        url (str): URL de la imagen.
+
+    Returns:
+        Optional[str]: Hash del contenido.
+    """
+    with _lock:
+        fila = _obtener_conexion().execute("SELECT contenido_hash FROM urls WHERE url = ?", (url,)).fetchone()
+    return fila[0] if fila else None
+
+
+def cargar_detecciones(modelo: str) -> pd.DataFrame:
+    """
+    Carga todas las clasificaciones guardadas de un modelo en un DataFrame.
+
+    Args:
+        modelo (str): Identificador del modelo.
+
+    Returns:
+        pd.DataFrame: Columnas 'contenido_hash', 'etiquetas' (lista del top-k) y 'probs' (array del top-k).
+    """
+    nombres = obtener_nombres(modelo) or {}
+    with _lock:
+        filas = _obtener_conexion().execute(
+            "SELECT contenido_hash, indices, probs FROM detecciones WHERE modelo = ?", (modelo,)
+        ).fetchall()
+    return pd.DataFrame({
+        "contenido_hash": [fila[0] for fila in filas],
+        "etiquetas": [[nombres.get(int(i), str(i)) for i in np.frombuffer(fila[1], dtype=np.int16)] for fila in filas],
+        "probs": [np.frombuffer(fila[2], dtype=np.float16).astype(np.float32) for fila in filas],
+    })
+
+
+def estadisticas_almacen() -> dict:
+    """
+    Devuelve las consultas resueltas por el almacén en el proceso actual y su contenido.
+
+    Returns:
+        dict: Aciertos, fallos, tasa de aciertos, número de detecciones guardadas y modelos.
+    """
+    with _lock:
+        conexion = _obtener_conexion()
+        total = conexion.execute("SELECT COUNT(*) FROM detecciones").fetchone()[0]
+        modelos = [fila[0] for fila in conexion.execute("SELECT modelo FROM modelos").fetchall()]
+        consultas = _estadisticas["aciertos"] + _estadisticas["fallos"]
+        return {
+            **_estadisticas,
+            "tasa_aciertos": _estadisticas["aciertos"] / consultas if consultas else 0.0,
+            "detecciones": total,
+            "modelos": modelos,
+        }
@@ -0,0 +1,280 @@
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.linear_model import Ridge
+from sklearn.model_selection import train_test_split
+from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+from src import soporte_cache as sc
+from src import soporte_yolo as sy
+
+
+COLUMNAS_PUNTUACION = ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']
+
+# Embeddings ya calculados en el proceso: tamaño del modelo -> {URL: embedding}. Cada tamaño de YOLO
+# genera vectores de distinta dimensión, así que nunca se mezclan
+_embeddings = {}
+
+
+def calcular_embeddings(urls: List[Optional[str]], tamanio: str = "s", tamanio_lote: int = 16) -> np.ndarray:
+    """
+    Calcula el embedding de cada foto con el clasificador YOLO de habitaciones (la salida de la capa
+    anterior a la clasificación). Las fotos se leen de la caché de imágenes a resolución reducida.
+
+    Args:
+        urls (List[Optional[str]]): URLs de las fotos. Pueden ser None o NaN.
+        tamanio (str): Tamaño del modelo YOLO ("s", "m", "l" o "x").
+        tamanio_lote (int): Imágenes por llamada al modelo.
+
+    Returns:
+        np.ndarray: Array float32 (n, d). Las fotos ausentes o que no se pueden descargar tienen un vector de ceros.
+    """
+    calculados = _embeddings.setdefault(tamanio, {})
+    pendientes = list(dict.fromkeys(url for url in urls if isinstance(url, str) and url not in calculados))
+    modelo = sy.cargar_modelo(tamanio) if pendientes else None
+
+    for i in tqdm(range(0, len(pendientes), tamanio_lote), desc="Calculando embeddings"):
+        lote, imagenes = [], []
+        for url in pendientes[i:i + tamanio_lote]:
+            try:
+                imagenes.append(sc.obtener_imagen(url, tamanio_minimo=sy.tamanio_decodificacion))
+                lote.append(url)
+            except Exception as e:
+                print(f"Error descargando imagen {url}: {e}")
+        if imagenes:
+            for url, embedding in zip(lote, modelo.embed(imagenes, verbose=False)):
+                calculados[url] = embedding.cpu().numpy().astype(np.float32).ravel()
+
+    dimension = next((e.shape[0] for e in calculados.values()), 0)
+    vacio = np.zeros(dimension, dtype=np.float32)
+    return np.stack([calculados.get(url, vacio) if isinstance(url, str) else vacio for url in urls])
+
+
+def construir_variables(df: pd.DataFrame, tamanio: str = "s") -> np.ndarray:
+    """
+    Construye las variables de cada propiedad: el embedding de la foto de cocina y el de la de baño,
+    cada uno seguido de un indicador de si la foto está disponible.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        tamanio (str): Tamaño del modelo YOLO que genera los embeddings.
+
+    Returns:
+        np.ndarray: Matriz (n, 2 * (d + 1)).
+    """
+    bloques = []
+    for columna in ['url_cocina', 'url_banio']:
+        embeddings = calcular_embeddings(df[columna].tolist(), tamanio)
+        bloques.extend([embeddings, np.abs(embeddings).sum(axis=1, keepdims=True) > 0])
+    return np.hstack(bloques).astype(np.float32)
+
+
+class ModeloLocalPuntuaciones:
+    """
+    Modelo local que estima las puntuaciones y los metros de cocina y baño a partir de los embeddings
+    de las fotos. Es un conjunto de regresiones Ridge entrenadas sobre remuestreos bootstrap: la media
+    de sus predicciones es la estimación y su desviación típica mide la incertidumbre de cada propiedad.
+    """
+
+    def __init__(self, n_modelos: int = 10, alpha: float = 10.0, tamanio_yolo: str = "s", random_state: int = 42):
+        self.n_modelos = n_modelos
+        self.alpha = alpha
+        self.tamanio_yolo = tamanio_yolo
+        self.random_state = random_state
+        self.modelos = []
+
+    def entrenar(self, X: np.ndarray, y: np.ndarray) -> "ModeloLocalPuntuaciones":
+        """
+        Entrena el conjunto de regresiones.
+
+        Args:
+            X (np.ndarray): Variables (n, p), de `construir_variables`.
+            y (np.ndarray): Puntuaciones (n, 4) en el orden de COLUMNAS_PUNTUACION.
+        """
+        generador = np.random.default_rng(self.random_state)
+        self.modelos = []
+        for _ in range(self.n_modelos):
+            muestra = generador.integers(0, len(X), len(X))
+            self.modelos.append(Ridge(alpha=self.alpha).fit(X[muestra], y[muestra]))
+        return self
+
+    def predecir(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predice las puntuaciones y su incertidumbre.
+
+        Args:
+            X (np.ndarray): Variables (n, p).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Puntuaciones (n, 4) redondeadas a enteros en su rango (0 para las
+                habitaciones sin foto), e incertidumbre (n,): la mayor desviación típica de las dos puntuaciones
+                de las habitaciones con foto.
+        """
+        predicciones = np.stack([modelo.predict(X) for modelo in self.modelos])
+        media, desviacion = predicciones.mean(axis=0), predicciones.std(axis=0)
+
+        mitad = X.shape[1] // 2
+        tiene_foto = np.column_stack([X[:, mitad - 1] > 0, X[:, -1] > 0])
+        puntuaciones = np.column_stack([
+            np.clip(np.rint(media[:, 0]), 1, 5), np.clip(np.rint(media[:, 1]), 1, None),
+            np.clip(np.rint(media[:, 2]), 1, 5), np.clip(np.rint(media[:, 3]), 1, None),
+        ])
+        puntuaciones[:, :2] *= tiene_foto[:, [0]]
+        puntuaciones[:, 2:] *= tiene_foto[:, [1]]
+        incertidumbre = np.max(desviacion[:, [0, 2]] * tiene_foto, axis=1)
+        return puntuaciones.astype(int), incertidumbre
+
+    def guardar(self, ruta: str) -> None:
+        """
+        Guarda el modelo en un fichero pickle.
+        """
+        with open(ruta, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def cargar(ruta: str) -> "ModeloLocalPuntuaciones":
+        """
+        Carga un modelo guardado con `guardar`.
+        """
+        with open(ruta, "rb") as f:
+            return pickle.load(f)
+
+
+def informe_calibracion(modelo: ModeloLocalPuntuaciones, X: np.ndarray, y: np.ndarray, n_grupos: int = 5,
+                        tasas_escalado: List[float] = (0.0, 0.1, 0.2, 0.3, 0.5)) -> Dict[str, pd.DataFrame]:
+    """
+    Evalúa sobre datos de validación si la incertidumbre del modelo local ordena bien sus errores,
+    y qué precisión se obtiene al escalar a la API distintas proporciones de propiedades.
+
+    Args:
+        modelo (ModeloLocalPuntuaciones): Modelo entrenado.
+        X (np.ndarray): Variables de validación.
+        y (np.ndarray): Puntuaciones de la API para esas propiedades (n, 4).
+        n_grupos (int): Grupos de incertidumbre (cuantiles) del informe de calibración. Con menos propiedades
+            de validación que grupos, se usa un grupo por propiedad.
+        tasas_escalado (List[float]): Proporciones de propiedades escaladas a la API a evaluar.
+
+    Returns:
+        Dict[str, pd.DataFrame]:
+            - "calibracion": por grupo de incertidumbre, incertidumbre media, error absoluto medio de las
+              puntuaciones y de los metros, y proporción de puntuaciones exactas.
+            - "escalado": por tasa de escalado, umbral de incertidumbre, proporción de puntuaciones exactas y
+              error absoluto medio de las puntuaciones, tomando como correctas las propiedades escaladas.
+            - "resumen": correlación de Spearman entre incertidumbre y error.
+    """
+    puntuaciones, incertidumbre = modelo.predecir(X)
+    error_puntuacion = np.abs(puntuaciones[:, [0, 2]] - y[:, [0, 2]]).mean(axis=1)
+    error_mts = np.abs(puntuaciones[:, [1, 3]] - y[:, [1, 3]]).mean(axis=1)
+    exactas = (puntuaciones[:, [0, 2]] == y[:, [0, 2]]).mean(axis=1)
+
+    df = pd.DataFrame({"incertidumbre": incertidumbre, "error_puntuacion": error_puntuacion,
+                       "error_mts": error_mts, "exactas": exactas})
+    df["grupo"] = pd.qcut(df["incertidumbre"].rank(method="first"), max(1, min(n_grupos, len(df))),
+                          labels=False, duplicates="drop")
+    calibracion = df.groupby("grupo").agg(
+        propiedades=("exactas", "size"),
+        incertidumbre_media=("incertidumbre", "mean"),
+        error_puntuacion=("error_puntuacion", "mean"),
+        error_mts=("error_mts", "mean"),
+        puntuaciones_exactas=("exactas", "mean"),
+    ).reset_index()
+
+    escalado = []
+    for tasa in tasas_escalado:
+        umbral = np.quantile(incertidumbre, 1 - tasa) if tasa > 0 else np.inf
+        escaladas = incertidumbre > umbral if tasa > 0 else np.zeros(len(df), dtype=bool)
+        escalado.append({
+            "tasa_escalado": tasa,
+            "umbral_incertidumbre": umbral,
+            "escaladas": escaladas.mean(),
+            "puntuaciones_exactas": np.where(escaladas, 1.0, exactas).mean(),
+            "error_puntuacion": np.where(escaladas, 0.0, error_puntuacion).mean(),
+        })
+
+    correlacion = stats.spearmanr(incertidumbre, error_puntuacion).correlation
+    return {
+        "calibracion": calibracion,
+        "escalado": pd.DataFrame(escalado),
+        "resumen": pd.DataFrame([{"propiedades": len(df), "spearman_incertidumbre_error": correlacion}]),
+    }
+
+
+def entrenar_modelo_local(df: pd.DataFrame, tamanio_yolo: str = "s", n_modelos: int = 10, alpha: float = 10.0,
+                          test_size: float = 0.2,
+                          random_state: int = 42) -> Tuple[ModeloLocalPuntuaciones, Dict[str, pd.DataFrame]]:
+    """
+    Entrena el modelo local con las puntuaciones ya obtenidas de la API y genera su informe de calibración
+    sobre una partición de validación. El modelo final se entrena con todos los datos.
+
+    Args:
+        df (pd.DataFrame): Propiedades puntuadas, con las columnas "url_cocina", "url_banio" y COLUMNAS_PUNTUACION.
+        tamanio_yolo (str): Tamaño del modelo YOLO que genera los embeddings.
+        n_modelos (int): Regresiones del conjunto.
+        alpha (float): Regularización de las regresiones Ridge.
+        test_size (float): Proporción de propiedades de validación.
+        random_state (int): Semilla.
+
+    Returns:
+        Tuple[ModeloLocalPuntuaciones, Dict[str, pd.DataFrame]]: Modelo entrenado e informe de calibración.
+    """
+    df = df.dropna(subset=COLUMNAS_PUNTUACION)
+    df = df[df['url_cocina'].notna() | df['url_banio'].notna()]
+    X = construir_variables(df, tamanio_yolo)
+    y = df[COLUMNAS_PUNTUACION].to_numpy(dtype=float)
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    modelo = ModeloLocalPuntuaciones(n_modelos, alpha, tamanio_yolo, random_state).entrenar(X_train, y_train)
+    informe = informe_calibracion(modelo, X_test, y_test)
+
+    modelo.entrenar(X, y)
+    return modelo, informe
+
+
+def puntuar_con_modelo_local(df: pd.DataFrame, modelo: ModeloLocalPuntuaciones, tasa_escalado: float = 0.2,
+                             umbral_incertidumbre: Optional[float] = None, **kwargs) -> pd.DataFrame:
+    """
+    Puntúa las propiedades con el modelo local y envía a la API (`soporte_scoring.analizar_propiedades`)
+    sólo las de mayor incertidumbre.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        modelo (ModeloLocalPuntuaciones): Modelo entrenado.
+        tasa_escalado (float): Proporción de propiedades, las más inciertas, que se escalan a la API.
+        umbral_incertidumbre (Optional[float]): Si se indica, se escalan las propiedades con incertidumbre
+            mayor que este valor (por ejemplo, uno elegido en el informe de calibración) en lugar de usar la tasa.
+        **kwargs: Argumentos para `analizar_propiedades` (batch, usar_cache, batch_maximo...).
+
+    Returns:
+        pd.DataFrame: DataFrame con COLUMNAS_PUNTUACION, "incertidumbre_local" y "origen_puntuacion"
+            ("local" o "api").
+    """
+    from src import soporte_scoring as ss
+
+    for col in COLUMNAS_PUNTUACION:
+        if col not in df.columns:
+            df[col] = None
+    df.loc[df['url_cocina'].isna(), ['puntuacion_cocina', 'mts_cocina']] = [0, 0]
+    df.loc[df['url_banio'].isna(), ['puntuacion_banio', 'mts_banio']] = [0, 0]
+
+    indices_validos = df[df['url_cocina'].notna() | df['url_banio'].notna()].index
+    puntuaciones, incertidumbre = modelo.predecir(construir_variables(df.loc[indices_validos], modelo.tamanio_yolo))
+    df.loc[indices_validos, COLUMNAS_PUNTUACION] = puntuaciones
+    df.loc[indices_validos, "incertidumbre_local"] = incertidumbre
+    df.loc[indices_validos, "origen_puntuacion"] = "local"
+
+    if umbral_incertidumbre is None:
+        n_escaladas = int(round(tasa_escalado * len(indices_validos)))
+        escaladas = indices_validos[np.argsort(-incertidumbre)[:n_escaladas]]
+    else:
+        escaladas = indices_validos[incertidumbre > umbral_incertidumbre]
+
+    if len(escaladas):
+        df_api, _ = ss.analizar_propiedades(df.loc[escaladas, ['url_cocina', 'url_banio']].copy(), **kwargs)
+        puntuadas = df_api.dropna(subset=COLUMNAS_PUNTUACION).index
+        df.loc[puntuadas, COLUMNAS_PUNTUACION] = df_api.loc[puntuadas, COLUMNAS_PUNTUACION].values
+        df.loc[puntuadas, "origen_puntuacion"] = "api"
+
+    print(f"Propiedades puntuadas localmente: {len(indices_validos) - len(escaladas)}; "
+          f"escaladas a la API: {len(escaladas)} ({len(escaladas) / max(len(indices_validos), 1):.1%}).")
+    return df
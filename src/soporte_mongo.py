@@ -1,13 +1,20 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import shape
 from shapely.geometry import Point
-from pandas import json_normalize
+from shapely.geometry import mapping
+import bson
+from pymongo import GEOSPHERE, ReplaceOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 import os
 import json
+import threading
+from itertools import islice
 
 
 load_dotenv(dotenv_path="/Users/davidfranco/Library/CloudStorage/OneDrive-Personal/Hackio/Jupyter/Proyecto-Rentabilidad-Viviendas/src/.env")
@@ -17,19 +24,181 @@ if not mongo_uri:
     raise ValueError("mongo_uri no está definido en las variables de entorno")
 
 
+# Opciones de los clientes de MongoDB: tamaño del pool de conexiones, tiempo máximo de inactividad de cada
+# conexión y de selección de servidor, y si se mide el tamaño en bytes de cada comando y respuesta. Medir los
+# bytes obliga a volver a serializar en BSON cada comando y cada respuesta, así que sólo se activa para
+# diagnosticar: duplica aproximadamente el coste de serialización de cada operación
+config_cliente = {
+    "maxPoolSize": 50,
+    "minPoolSize": 0,
+    "maxIdleTimeMS": 300_000,
+    "serverSelectionTimeoutMS": 10_000,
+    "medir_bytes": False,
+}
+
+_clientes = {}
+_pid_clientes = None
+_lock_clientes = threading.Lock()
+
+
+class MonitorComandos(monitoring.CommandListener):
+    """
+    Registra, por tipo de comando (find, getMore, insert, update...), el número de llamadas y errores,
+    la latencia, los documentos devueltos o escritos y los bytes enviados y recibidos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._enviados = {}
+        self.metricas = {}
+
+    def _metrica(self, comando):
+        return self.metricas.setdefault(comando, {
+            "llamadas": 0, "errores": 0, "segundos": 0.0, "segundos_max": 0.0,
+            "documentos": 0, "bytes_enviados": 0, "bytes_recibidos": 0,
+        })
+
+    @staticmethod
+    def _documentos(respuesta):
+        cursor = respuesta.get("cursor")
+        if cursor is not None:
+            return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        return respuesta.get("n", 0)
+
+    def started(self, event):
+        if config_cliente["medir_bytes"]:
+            with self._lock:
+                self._enviados[event.request_id] = len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        segundos = event.duration_micros / 1e6
+        recibidos = len(bson.encode(event.reply)) if config_cliente["medir_bytes"] else 0
+        with self._lock:
+            metrica = self._metrica(event.command_name)
+            metrica["llamadas"] += 1
+            metrica["segundos"] += segundos
+            metrica["segundos_max"] = max(metrica["segundos_max"], segundos)
+            metrica["documentos"] += self._documentos(event.reply)
+            metrica["bytes_enviados"] += self._enviados.pop(event.request_id, 0)
+            metrica["bytes_recibidos"] += recibidos
+
+    def failed(self, event):
+        with self._lock:
+            metrica = self._metrica(event.command_name)
+            metrica["llamadas"] += 1
+            metrica["errores"] += 1
+            metrica["segundos"] += event.duration_micros / 1e6
+            metrica["bytes_enviados"] += self._enviados.pop(event.request_id, 0)
+
+    def reiniciar(self):
+        with self._lock:
+            self.metricas.clear()
+            self._enviados.clear()
+
+
+monitor_comandos = MonitorComandos()
+
+
+class _ClienteCompartido(MongoClient):
+    """
+    MongoClient que registra si se ha cerrado. Un MongoClient no se puede volver a usar después de close(),
+    y el cliente es compartido: si alguien lo cierra (por ejemplo con `bd.client.close()`), `obtener_cliente`
+    crea otro en su lugar.
+    """
+
+    cerrado = False
+
+    def close(self):
+        self.cerrado = True
+        super().close()
+
+
+def configurar_cliente(**opciones):
+    """
+    Cambia las opciones de los clientes de MongoDB (ver `config_cliente`). Se aplican a los clientes que se
+    creen después; para aplicarlas a los ya creados, llamar antes a `cerrar_clientes`.
+
+    Args:
+        **opciones: Opciones de MongoClient (maxPoolSize, minPoolSize, maxIdleTimeMS...) o medir_bytes.
+    """
+    config_cliente.update(opciones)
+
+
+def obtener_cliente(uri=None):
+    """
+    Devuelve el cliente de MongoDB compartido por todo el proceso para una URI, creándolo la primera vez.
+    El cliente mantiene un pool de conexiones y no se conecta hasta la primera operación (connect=False),
+    de modo que la resolución DNS y la negociación TLS sólo se pagan una vez por proceso.
+    Es seguro llamarla desde varios hilos; tras un fork se crea un cliente nuevo en el proceso hijo, y si
+    alguien ha cerrado el cliente compartido (por ejemplo con `bd.client.close()`), se crea otro en su lugar.
+    Para cerrar las conexiones al terminar, usar `cerrar_clientes`.
+
+    Args:
+        uri (str, opcional): URI de conexión. Por defecto, la de la variable de entorno 'mongo_uri'.
+
+    Returns:
+        pymongo.MongoClient: Cliente de MongoDB.
+    """
+    global _pid_clientes
+    uri = uri or mongo_uri
+    with _lock_clientes:
+        if _pid_clientes != os.getpid():
+            _clientes.clear()
+            _pid_clientes = os.getpid()
+        cliente = _clientes.get(uri)
+        if cliente is None or cliente.cerrado:
+            opciones = {clave: valor for clave, valor in config_cliente.items() if clave != "medir_bytes"}
+            cliente = _ClienteCompartido(uri, server_api=ServerApi('1'), connect=False,
+                                  event_listeners=[monitor_comandos], **opciones)
+            _clientes[uri] = cliente
+    return cliente
+
+
+def cerrar_clientes():
+    """
+    Cierra los clientes de MongoDB del proceso y sus conexiones.
+    """
+    with _lock_clientes:
+        for cliente in _clientes.values():
+            cliente.close()
+        _clientes.clear()
+
+
+def metricas_mongo(reiniciar=False):
+    """
+    Devuelve las métricas de los comandos enviados a MongoDB por los clientes del proceso.
+
+    Args:
+        reiniciar (bool): Si es True, pone las métricas a cero después de leerlas.
+
+    Returns:
+        pd.DataFrame: Una fila por tipo de comando con llamadas, errores, segundos totales, medios y máximos,
+            documentos y bytes enviados y recibidos.
+    """
+    with monitor_comandos._lock:
+        df = pd.DataFrame.from_dict(monitor_comandos.metricas, orient="index")
+    if reiniciar:
+        monitor_comandos.reiniciar()
+    if df.empty:
+        return df
+    df["segundos_medios"] = df["segundos"] / df["llamadas"]
+    return df.rename_axis("comando").sort_values("segundos", ascending=False)
+
+
 # Conectar a MongoDB Atlas
-def conectar_a_mongo(nombre_bd: str):
+def conectar_a_mongo(nombre_bd: str, uri: str = None):
     """
-    Conecta a una base de datos en MongoDB Atlas y devuelve el objeto de la base de datos.
+    Devuelve el objeto de una base de datos de MongoDB usando el cliente compartido del proceso
+    (ver `obtener_cliente`), sin abrir una conexión nueva en cada llamada.
 
     Args:
         nombre_bd (str): Nombre de la base de datos a la que se desea conectar.
+        uri (str, opcional): URI de conexión. Por defecto, la de MongoDB Atlas ('mongo_uri').
 
     Returns:
         pymongo.database.Database: Objeto de la base de datos MongoDB.
     """
-    cliente = MongoClient(mongo_uri, server_api=ServerApi('1'))
-    return cliente[nombre_bd]
+    return obtener_cliente(uri)[nombre_bd]
 
 
 # Función para subir un DataFrame a MongoDB
@@ -70,6 +239,217 @@ def subir_geodataframe_a_mongo(bd, gdf, nombre_coleccion):
     print(f"GeoDataFrame subido a la colección: {nombre_coleccion}")
 
 
+def _indexar_clave(coleccion, clave):
+    """
+    Crea (si no existe) un índice único sobre la clave de los upserts, para que cada upsert localice su
+    documento por índice y la colección no pueda acumular dos documentos del mismo anuncio.
+
+    Raises:
+        ValueError: Si la colección ya tiene valores duplicados de la clave (por ejemplo, de subidas
+            anteriores con `subir_*`); hay que eliminarla o deduplicarla antes de usar los upserts.
+    """
+    try:
+        coleccion.create_index(clave, unique=True)
+    except OperationFailure as e:
+        raise ValueError(
+            f"La colección '{coleccion.name}' tiene valores de '{clave}' duplicados y no admite un índice único: "
+            f"elimínala (eliminar_coleccion) o deduplícala antes de usar los upserts."
+        ) from e
+
+
+def _comprobar_clave(df, clave):
+    """
+    Comprueba que la columna clave existe y no tiene valores repetidos: la clave debe identificar el anuncio
+    (p. ej. 'codigo'), no la posición de la fila, para que los upserts sean idempotentes entre ejecuciones.
+    """
+    if clave not in df.columns:
+        raise ValueError(f"El DataFrame no tiene la columna clave '{clave}'.")
+    duplicados = df[clave].dropna().duplicated().sum()
+    if duplicados:
+        raise ValueError(f"La columna clave '{clave}' tiene {duplicados} valores repetidos.")
+
+
+def _valor_campo(documento, ruta):
+    """
+    Devuelve el valor de un campo (en notación de MongoDB, p. ej. 'properties.codigo') de un documento,
+    o None si no lo tiene.
+    """
+    for parte in ruta.split("."):
+        if not isinstance(documento, dict):
+            return None
+        documento = documento.get(parte)
+    return documento
+
+
+def _eliminar_ausentes(coleccion, filtro_clave, claves, tamanio_bloque):
+    """
+    Elimina los documentos cuya clave no está entre `claves` (incluidos los que no tienen clave). Recorre sólo
+    la clave y el _id de los documentos guardados y borra por _id en bloques de `tamanio_bloque`, de modo que
+    ningún comando lleva la lista completa de claves (que en catálogos grandes superaría el límite de 16 MB de
+    un documento BSON).
+
+    Returns:
+        int: Documentos eliminados.
+    """
+    claves = set(claves)
+    eliminados, ids = 0, []
+    for documento in coleccion.find({}, {filtro_clave: 1}):
+        if _valor_campo(documento, filtro_clave) not in claves:
+            ids.append(documento["_id"])
+            if len(ids) >= tamanio_bloque:
+                eliminados += coleccion.delete_many({"_id": {"$in": ids}}).deleted_count
+                ids = []
+    if ids:
+        eliminados += coleccion.delete_many({"_id": {"$in": ids}}).deleted_count
+    return eliminados
+
+
+def _escribir_upserts(coleccion, documentos, filtro_clave, clave, tamanio_bloque, eliminar_ausentes=False):
+    """
+    Escribe los documentos con operaciones ReplaceOne + upsert agrupadas en bloques de bulk_write no ordenados
+    y devuelve los documentos insertados, actualizados y sin cambios. Cada documento sustituye por completo al
+    guardado, así que los campos que ya no tiene el origen desaparecen también de MongoDB. Con
+    eliminar_ausentes, borra después los documentos cuya clave no está entre las escritas. Los documentos que
+    MongoDB rechaza (por ejemplo, una geometría inválida en una colección con índice 2dsphere) se cuentan como
+    rechazados sin interrumpir el resto del bloque, y se conserva la versión guardada de cada uno.
+    """
+    recuento = {"insertados": 0, "actualizados": 0, "sin_cambios": 0, "sin_clave": 0, "rechazados": 0,
+                "eliminados": 0}
+    operaciones, claves, errores = [], [], []
+
+    def escribir():
+        try:
+            resultado = coleccion.bulk_write(operaciones, ordered=False)
+            insertados, actualizados, coincidentes = (resultado.upserted_count, resultado.modified_count,
+                                                      resultado.matched_count)
+        except BulkWriteError as e:
+            # En un bulk_write no ordenado, MongoDB escribe todas las operaciones válidas del bloque
+            insertados, actualizados, coincidentes = e.details["nUpserted"], e.details["nModified"], e.details["nMatched"]
+            recuento["rechazados"] += len(e.details["writeErrors"])
+            claves_bloque = claves[-len(operaciones):]
+            errores.extend((claves_bloque[error["index"]], error["errmsg"]) for error in e.details["writeErrors"])
+        recuento["insertados"] += insertados
+        recuento["actualizados"] += actualizados
+        recuento["sin_cambios"] += coincidentes - actualizados
+        operaciones.clear()
+
+    for valor, documento in documentos:
+        if valor is None or pd.isna(valor):
+            recuento["sin_clave"] += 1
+            continue
+        operaciones.append(ReplaceOne({filtro_clave: valor}, documento, upsert=True))
+        claves.append(valor)
+        if len(operaciones) >= tamanio_bloque:
+            escribir()
+    if operaciones:
+        escribir()
+
+    # Los anuncios que ya no están en el origen (y los documentos sin clave) se eliminan
+    if eliminar_ausentes:
+        recuento["eliminados"] = _eliminar_ausentes(coleccion, filtro_clave, claves, tamanio_bloque)
+
+    if recuento["sin_clave"]:
+        print(f"Registros sin '{clave}' no subidos: {recuento['sin_clave']}.")
+    if errores:
+        print(f"Registros rechazados por MongoDB: {recuento['rechazados']}. Primeros errores:")
+        for valor, mensaje in errores[:10]:
+            print(f"  {clave}={valor}: {mensaje}")
+    return recuento
+
+
+# Función para subir un DataFrame a MongoDB actualizando los documentos existentes
+def upsert_dataframe_a_mongo(bd, df, nombre_coleccion, clave="codigo", tamanio_bloque=1000, eliminar_ausentes=False):
+    """
+    Sube un DataFrame a una colección de MongoDB de forma idempotente: cada fila se escribe con un upsert
+    por la columna clave (un identificador del anuncio, nunca el índice del DataFrame, que cambia al filtrar
+    o concatenar), de modo que las filas nuevas se insertan, las modificadas sustituyen por completo al
+    documento guardado y las que no han cambiado no se tocan. No hace falta eliminar la colección antes de cada actualización.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        df (pd.DataFrame): DataFrame a subir.
+        nombre_coleccion (str): Nombre de la colección en MongoDB.
+        clave (str): Columna que identifica cada documento (por defecto 'codigo'). Debe ser única.
+        tamanio_bloque (int): Operaciones por llamada a bulk_write.
+        eliminar_ausentes (bool): Si es True, elimina de la colección los documentos cuya clave no está en el
+            DataFrame (anuncios retirados del origen).
+
+    Returns:
+        dict: Número de documentos insertados, actualizados, sin cambios y eliminados, y filas sin clave.
+    """
+    _comprobar_clave(df, clave)
+    coleccion = bd[nombre_coleccion]
+    _indexar_clave(coleccion, clave)
+    registros = df.to_dict(orient="records")
+    recuento = _escribir_upserts(
+        coleccion, ((registro.get(clave), registro) for registro in registros), clave, clave, tamanio_bloque,
+        eliminar_ausentes
+    )
+    print(f"DataFrame subido a la colección {nombre_coleccion}: {recuento['insertados']} insertados, "
+          f"{recuento['actualizados']} actualizados, {recuento['sin_cambios']} sin cambios, "
+          f"{recuento['eliminados']} eliminados.")
+    return recuento
+
+
+def documentos_geojson(gdf, clave=None):
+    """
+    Genera los documentos GeoJSON (Feature) de un GeoDataFrame sin pasar por gdf.to_json(): las propiedades
+    se toman de las columnas (con None en lugar de NaN) y la geometría se convierte con shapely.geometry.mapping.
+
+    Args:
+        gdf (geopandas.GeoDataFrame): GeoDataFrame a convertir.
+        clave (str, opcional): Columna cuyo valor se usa como "id" de cada Feature. Por defecto, el índice.
+
+    Returns:
+        generator: Documentos {"id", "type", "properties", "geometry"}, uno por fila.
+    """
+    columnas = [col for col in gdf.columns if col != gdf.geometry.name]
+    propiedades = gdf[columnas].astype(object).where(gdf[columnas].notna(), None).to_dict(orient="records")
+    identificadores = gdf.index if clave is None else gdf[clave]
+    for identificador, props, geometria in zip(identificadores, propiedades, gdf.geometry):
+        yield {
+            "id": str(identificador),
+            "type": "Feature",
+            "properties": props,
+            "geometry": mapping(geometria) if geometria is not None and not geometria.is_empty else None,
+        }
+
+
+# Función para subir un GeoDataFrame a MongoDB actualizando los documentos existentes
+def upsert_geodataframe_a_mongo(bd, gdf, nombre_coleccion, clave="codigo", tamanio_bloque=500,
+                                eliminar_ausentes=False):
+    """
+    Sube un GeoDataFrame a una colección de MongoDB en formato GeoJSON de forma idempotente: cada fila
+    se escribe con un upsert por 'properties.<clave>' (un identificador del anuncio, que también se usa como
+    "id" de la Feature), de modo que sólo se sustituyen los documentos que han cambiado aunque el GeoDataFrame
+    se haya filtrado o reindexado. No hace falta eliminar la colección antes de cada actualización.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        gdf (geopandas.GeoDataFrame): GeoDataFrame a subir.
+        nombre_coleccion (str): Nombre de la colección en MongoDB.
+        clave (str): Columna que identifica cada documento (por defecto 'codigo'). Debe ser única.
+        tamanio_bloque (int): Operaciones por llamada a bulk_write.
+        eliminar_ausentes (bool): Si es True, elimina de la colección los documentos cuya clave no está en el
+            GeoDataFrame (anuncios retirados del origen).
+
+    Returns:
+        dict: Número de documentos insertados, actualizados, sin cambios y eliminados, y filas sin clave.
+    """
+    _comprobar_clave(gdf, clave)
+    coleccion = bd[nombre_coleccion]
+    filtro_clave = f"properties.{clave}"
+    _indexar_clave(coleccion, filtro_clave)
+    recuento = _escribir_upserts(
+        coleccion, ((doc["properties"].get(clave), doc) for doc in documentos_geojson(gdf, clave)),
+        filtro_clave, clave, tamanio_bloque, eliminar_ausentes
+    )
+    print(f"GeoDataFrame subido a la colección {nombre_coleccion}: {recuento['insertados']} insertados, "
+          f"{recuento['actualizados']} actualizados, {recuento['sin_cambios']} sin cambios, "
+          f"{recuento['eliminados']} eliminados.")
+    return recuento
+
+
 # Función para eliminar una colección de MongoDB
 def eliminar_coleccion(db, collection_name):
     """
@@ -89,69 +469,399 @@ def eliminar_coleccion(db, collection_name):
         return f"La colección '{collection_name}' no existe en la base de datos."
     
 
+# Marca de los campos que no tiene un documento (json_normalize los deja como NaN, y los None explícitos como None)
+_AUSENTE = object()
+
+
+def _aplanar(documento, columnas, fila, n_filas, prefijo="", sep="_"):
+    """
+    Añade los campos de un documento (aplanando los subdocumentos con `sep`) a las listas de cada columna.
+    Las columnas nuevas se rellenan con _AUSENTE en todas las filas.
+    """
+    for clave, valor in documento.items():
+        nombre = f"{prefijo}{clave}"
+        if isinstance(valor, dict) and valor:
+            _aplanar(valor, columnas, fila, n_filas, f"{nombre}{sep}", sep)
+            continue
+        valores = columnas.get(nombre)
+        if valores is None:
+            valores = columnas[nombre] = [_AUSENTE] * n_filas
+        valores[fila] = valor
+
+
+def _columna_tipada(valores):
+    """
+    Convierte los valores de una columna en un array de NumPy con el tipo de sus valores: int64, float64
+    (con NaN en los valores nulos o ausentes), bool u object (textos, listas y tipos mezclados).
+    """
+    tipos = set(map(type, valores))
+    ausentes = object in tipos
+    tipos.discard(object)
+    if tipos == {int} and not ausentes:
+        try:
+            return np.array(valores, dtype=np.int64)
+        except OverflowError:
+            pass
+    elif tipos <= {int, float, type(None)} and tipos & {int, float}:
+        return np.array([np.nan if valor is None or valor is _AUSENTE else valor for valor in valores],
+                        dtype=np.float64)
+    elif tipos == {bool} and not ausentes:
+        return np.array(valores, dtype=bool)
+    columna = np.empty(len(valores), dtype=object)
+    columna[:] = [np.nan if valor is _AUSENTE else valor for valor in valores] if ausentes else valores
+    return columna
+
+
+def documentos_a_dataframe(documentos, sep="_"):
+    """
+    Convierte una lista de documentos de MongoDB en un DataFrame con columnas tipadas: recorre los documentos
+    una sola vez acumulando los valores de cada campo (con los subdocumentos aplanados con `sep`, como
+    json_normalize) y construye cada columna directamente como un array de NumPy de su tipo, en lugar de
+    inferir el tipo fila a fila a partir de una lista de diccionarios.
+
+    Args:
+        documentos (list): Documentos de MongoDB.
+        sep (str): Separador de los nombres de los campos anidados.
+
+    Returns:
+        pd.DataFrame: Una fila por documento y una columna por campo, en el orden en que aparecen.
+    """
+    columnas = {}
+    for fila, documento in enumerate(documentos):
+        _aplanar(documento, columnas, fila, len(documentos), sep=sep)
+    return pd.DataFrame({nombre: _columna_tipada(valores) for nombre, valores in columnas.items()},
+                        index=pd.RangeIndex(len(documentos)))
+
+
+def leer_en_bloques(coleccion, filtro=None, proyeccion=None, batch_size=5000, tamanio_bloque=20000):
+    """
+    Lee los documentos de una colección en bloques y convierte cada bloque en un DataFrame con columnas
+    tipadas (ver `documentos_a_dataframe`), de modo que en memoria sólo hay a la vez los documentos de un
+    bloque. El filtro y la proyección se aplican en el servidor, así que sólo se transfieren los documentos
+    y campos pedidos.
+
+    Args:
+        coleccion (pymongo.collection.Collection): Colección de MongoDB.
+        filtro (dict, opcional): Filtro de la consulta.
+        proyeccion (dict, opcional): Proyección de la consulta.
+        batch_size (int): Documentos por lote del cursor (por cada viaje al servidor).
+        tamanio_bloque (int): Documentos por bloque convertido a DataFrame.
+
+    Returns:
+        generator: DataFrames de cada bloque, con los campos anidados aplanados con '_'.
+    """
+    cursor = coleccion.find(filtro or {}, proyeccion, batch_size=batch_size)
+    while True:
+        documentos = list(islice(cursor, tamanio_bloque))
+        if not documentos:
+            break
+        yield documentos_a_dataframe(documentos, sep="_")
+
+
 # Función para importar una colección de MongoDB a un DataFrame
-def importar_a_dataframe(bd, nombre_coleccion):
+def importar_a_dataframe(bd, nombre_coleccion, filtro=None, campos=None, batch_size=5000, tamanio_bloque=20000):
     """
     Importa una colección de MongoDB a un DataFrame de pandas, manteniendo los nombres originales de las columnas 
-    y eliminando las columnas '_id', 'type', y 'id'.
+    y sin las columnas '_id', 'type', e 'id', que se excluyen en el servidor. Los documentos se leen y convierten
+    en bloques que se concatenan una sola vez al final.
 
     Args:
         bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
         nombre_coleccion (str): Nombre de la colección en MongoDB que se desea importar.
+        filtro (dict, opcional): Filtro de MongoDB para importar sólo algunos documentos.
+        campos (list, opcional): Campos a importar (en notación de MongoDB, p. ej. 'precio'). Por defecto, todos.
+        batch_size (int): Documentos por lote del cursor.
+        tamanio_bloque (int): Documentos por bloque convertido a DataFrame.
 
     Returns:
         pd.DataFrame: DataFrame con los datos de la colección, con las columnas específicas eliminadas.
     """
-    coleccion = bd[nombre_coleccion]
-    documentos = list(coleccion.find())
+    if campos:
+        proyeccion = {"_id": 0, **{campo: 1 for campo in campos}}
+    else:
+        proyeccion = {"_id": 0, "type": 0, "id": 0}
 
-    if documentos:
-        # Convertir documentos a DataFrame
-        df = json_normalize(documentos, sep="_")
-        
-        # Eliminar las columnas '_id', 'type' y 'id' si existen
-        columnas_a_eliminar = ["_id", "type", "id"]
-        df = df.drop(columns=[col for col in columnas_a_eliminar if col in df.columns])
-        
-        return df
+    bloques = list(leer_en_bloques(bd[nombre_coleccion], filtro, proyeccion, batch_size, tamanio_bloque))
+    if bloques:
+        return pd.concat(bloques, ignore_index=True)
     else:
         print(f"La colección '{nombre_coleccion}' está vacía o no existe.")
         return pd.DataFrame()
 
 
-def importar_a_geodataframe(bd, nombre_coleccion):
+def decodificar_geometrias(tipos, coordenadas):
+    """
+    Reconstruye las geometrías a partir de los campos 'geometry.type' y 'geometry.coordinates' de los
+    documentos GeoJSON, construyendo en bloque las de cada tipo con los constructores vectorizados de
+    shapely 2 (points y from_ragged_array) en lugar de crear cada geometría por separado.
+    Los tipos distintos de Point, Polygon y MultiPolygon se reconstruyen uno a uno con shapely.geometry.shape.
+
+    Args:
+        tipos (pd.Series): Tipo GeoJSON de cada geometría (NaN si el documento no tiene geometría).
+        coordenadas (pd.Series): Coordenadas GeoJSON de cada geometría (listas anidadas).
+
+    Returns:
+        np.ndarray: Array de geometrías de shapely (None donde no hay geometría).
+    """
+    tipos = pd.Series(tipos).reset_index(drop=True)
+    coordenadas = pd.Series(coordenadas).reset_index(drop=True)
+    geometrias = np.full(len(tipos), None, dtype=object)
+
+    posiciones = np.flatnonzero(tipos == "Point")
+    if len(posiciones):
+        geometrias[posiciones] = shapely.points(np.array(coordenadas.iloc[posiciones].tolist(), dtype=float))
+
+    # Polygon: anillos -> polígonos
+    posiciones = np.flatnonzero(tipos == "Polygon")
+    if len(posiciones):
+        anillos = [anillo for poligono in coordenadas.iloc[posiciones] for anillo in poligono]
+        offsets_anillos = np.cumsum([0] + [len(anillo) for anillo in anillos])
+        offsets_poligonos = np.cumsum([0] + [len(poligono) for poligono in coordenadas.iloc[posiciones]])
+        puntos = np.array([punto for anillo in anillos for punto in anillo], dtype=float)
+        geometrias[posiciones] = shapely.from_ragged_array(
+            shapely.GeometryType.POLYGON, puntos, (offsets_anillos, offsets_poligonos)
+        )
+
+    # MultiPolygon: anillos -> polígonos -> multipolígonos
+    posiciones = np.flatnonzero(tipos == "MultiPolygon")
+    if len(posiciones):
+        poligonos = [poligono for multipoligono in coordenadas.iloc[posiciones] for poligono in multipoligono]
+        anillos = [anillo for poligono in poligonos for anillo in poligono]
+        offsets_anillos = np.cumsum([0] + [len(anillo) for anillo in anillos])
+        offsets_poligonos = np.cumsum([0] + [len(poligono) for poligono in poligonos])
+        offsets_multipoligonos = np.cumsum([0] + [len(multipoligono) for multipoligono in coordenadas.iloc[posiciones]])
+        puntos = np.array([punto for anillo in anillos for punto in anillo], dtype=float)
+        geometrias[posiciones] = shapely.from_ragged_array(
+            shapely.GeometryType.MULTIPOLYGON, puntos, (offsets_anillos, offsets_poligonos, offsets_multipoligonos)
+        )
+
+    # Resto de tipos (LineString, MultiPoint...)
+    otros = ~tipos.isin(["Point", "Polygon", "MultiPolygon"]) & tipos.notna()
+    for posicion in np.flatnonzero(otros):
+        geometrias[posicion] = shape({"type": tipos.iloc[posicion], "coordinates": coordenadas.iloc[posicion]})
+
+    return geometrias
+
+
+def importar_a_geodataframe(bd, nombre_coleccion, filtro=None, campos=None, batch_size=5000, tamanio_bloque=20000,
+                            crs="EPSG:4326"):
     """
     Importa una colección de MongoDB a un GeoDataFrame de geopandas, procesando correctamente la columna 'geometry',
-    eliminando columnas innecesarias y ajustando los nombres de las columnas.
+    excluyendo en el servidor los campos innecesarios y ajustando los nombres de las columnas. Los documentos
+    se leen y convierten en bloques que se concatenan una sola vez al final.
 
     Args:
         bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
         nombre_coleccion (str): Nombre de la colección en MongoDB que se desea importar.
+        filtro (dict, opcional): Filtro de MongoDB (p. ej. {"properties.distrito": "Centro"}).
+        campos (list, opcional): Propiedades a importar (sin el prefijo 'properties.'). Por defecto, todas.
+        batch_size (int): Documentos por lote del cursor.
+        tamanio_bloque (int): Documentos por bloque convertido a DataFrame.
+        crs (str): Sistema de referencia de las geometrías (GeoJSON usa siempre WGS84, EPSG:4326).
 
     Returns:
         gpd.GeoDataFrame: GeoDataFrame con los datos de la colección.
     """
-    coleccion = bd[nombre_coleccion]
-    documentos = list(coleccion.find())
+    if campos:
+        proyeccion = {"_id": 0, "geometry": 1, **{f"properties.{campo}": 1 for campo in campos}}
+    else:
+        proyeccion = {"_id": 0, "type": 0, "id": 0}
 
-    if documentos:
-        # Convertir documentos a DataFrame, preservando columnas anidadas
-        df = json_normalize(documentos, sep="_")
-        
-        # Crear la columna 'geometry' a partir de 'geometry.coordinates'
+    bloques = []
+    for df in leer_en_bloques(bd[nombre_coleccion], filtro, proyeccion, batch_size, tamanio_bloque):
+        # Crear la columna 'geometry' a partir de 'geometry.type' y 'geometry.coordinates'
         if "geometry_coordinates" in df.columns:
-            df["geometry"] = df["geometry_coordinates"].apply(
-                lambda coords: Point(coords) if isinstance(coords, list) else None
-            )
-        
-        # Eliminar columnas '_id', 'type', 'id', 'geometry_type', y 'geometry_coordinates' si existen
-        columnas_a_eliminar = ["_id", "type", "id", "geometry_type", "geometry_coordinates"]
-        df = df.drop(columns=[col for col in columnas_a_eliminar if col in df.columns])
-        
+            df["geometry"] = decodificar_geometrias(df["geometry_type"], df["geometry_coordinates"])
+
+        # Eliminar columnas 'geometry_type' y 'geometry_coordinates' si existen
+        columnas_a_eliminar = ["geometry_type", "geometry_coordinates"]
+        bloques.append(df.drop(columns=[col for col in columnas_a_eliminar if col in df.columns]))
+
+    if bloques:
+        df = pd.concat(bloques, ignore_index=True)
+
         # Renombrar columnas para eliminar el prefijo 'properties_'
         df.columns = [col.replace("properties_", "") for col in df.columns]
         
-        return gpd.GeoDataFrame(df, geometry="geometry")
+        return gpd.GeoDataFrame(df, geometry="geometry", crs=crs)
     else:
         print(f"La colección '{nombre_coleccion}' está vacía o no existe.")
-        return gpd.GeoDataFrame()
\ No newline at end of file
+        return gpd.GeoDataFrame()
+
+
+# Función para crear índices geoespaciales en las colecciones con geometría
+def geometrias_invalidas(coleccion, campo="geometry"):
+    """
+    Devuelve los documentos de una colección cuya geometría no es válida según shapely (anillos que se cortan
+    a sí mismos, polígonos sin área...), que MongoDB rechaza al crear un índice 2dsphere o al escribir en una
+    colección que ya lo tiene. Los documentos sin geometría no se indexan y no se consideran inválidos.
+
+    Args:
+        coleccion (pymongo.collection.Collection): Colección de MongoDB.
+        campo (str): Campo con la geometría GeoJSON.
+
+    Returns:
+        pd.DataFrame: _id, id de la Feature y motivo de cada geometría inválida.
+    """
+    filas = []
+    for documento in coleccion.find({}, {campo: 1, "id": 1}):
+        geometria = _valor_campo(documento, campo)
+        if not geometria:
+            continue
+        try:
+            motivo = shapely.is_valid_reason(shape(geometria))
+        except Exception as e:
+            motivo = f"No se puede leer: {e}"
+        if motivo != "Valid Geometry":
+            filas.append({"_id": documento["_id"], "id": documento.get("id"), "motivo": motivo})
+    return pd.DataFrame(filas, columns=["_id", "id", "motivo"])
+
+
+def crear_indices_geoespaciales(bd, colecciones=("venta", "ventafinal", "distritos"), campo="geometry"):
+    """
+    Crea (si no existe) un índice 2dsphere sobre la geometría de cada colección, necesario para las consultas
+    $near y que acelera las consultas $geoWithin. Si MongoDB no puede crear el índice de una colección (por
+    ejemplo, porque algún polígono de distrito se corta a sí mismo), no se interrumpe el resto: se avisa con
+    las geometrías inválidas (ver `geometrias_invalidas`), que hay que corregir (p. ej. con shapely.make_valid)
+    y volver a subir antes de indexar la colección.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        colecciones (tuple): Nombres de las colecciones a indexar. Se omiten las que no existen.
+        campo (str): Campo con la geometría GeoJSON.
+
+    Returns:
+        dict: Nombre del índice creado en cada colección, o None si no se ha podido crear.
+    """
+    existentes = set(bd.list_collection_names())
+    indices = {}
+    for nombre in colecciones:
+        if nombre not in existentes:
+            continue
+        try:
+            indices[nombre] = bd[nombre].create_index([(campo, GEOSPHERE)])
+        except OperationFailure as e:
+            invalidas = geometrias_invalidas(bd[nombre], campo)
+            print(f"No se ha podido crear el índice 2dsphere de '{nombre}': {e}")
+            if not invalidas.empty:
+                print(f"Geometrías inválidas en '{nombre}' ({len(invalidas)}):")
+                print(invalidas.head(10).to_string(index=False))
+            indices[nombre] = None
+    return indices
+
+
+def _combinar_filtros(filtro_geo, filtro=None):
+    """
+    Combina el filtro geoespacial con un filtro adicional opcional.
+    """
+    return {"$and": [filtro_geo, filtro]} if filtro else filtro_geo
+
+
+def geometria_distrito(bd, nombre_distrito, coleccion_distritos="distritos", campo="distrito"):
+    """
+    Devuelve la geometría GeoJSON de un distrito guardado en MongoDB.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        nombre_distrito (str): Nombre del distrito.
+        coleccion_distritos (str): Colección con los distritos.
+        campo (str): Propiedad con el nombre del distrito.
+
+    Returns:
+        dict: Geometría GeoJSON (Polygon o MultiPolygon).
+    """
+    documento = bd[coleccion_distritos].find_one({f"properties.{campo}": nombre_distrito}, {"_id": 0, "geometry": 1})
+    if documento is None:
+        raise ValueError(f"El distrito '{nombre_distrito}' no existe en la colección '{coleccion_distritos}'.")
+    return documento["geometry"]
+
+
+def consultar_en_distrito(bd, nombre_coleccion, nombre_distrito, campos=None, filtro=None,
+                          coleccion_distritos="distritos"):
+    """
+    Importa sólo los anuncios cuya ubicación está dentro del polígono de un distrito. El filtro se
+    resuelve en el servidor con $geoWithin.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        nombre_coleccion (str): Colección de anuncios (p. ej. 'venta' o 'ventafinal').
+        nombre_distrito (str): Nombre del distrito.
+        campos (list, opcional): Propiedades a importar. Por defecto, todas.
+        filtro (dict, opcional): Filtro adicional de MongoDB.
+        coleccion_distritos (str): Colección con los distritos.
+
+    Returns:
+        gpd.GeoDataFrame: Anuncios del distrito.
+    """
+    filtro_geo = {"geometry": {"$geoWithin": {"$geometry": geometria_distrito(bd, nombre_distrito, coleccion_distritos)}}}
+    return importar_a_geodataframe(bd, nombre_coleccion, _combinar_filtros(filtro_geo, filtro), campos)
+
+
+def rectangulo_geojson(lon_min, lat_min, lon_max, lat_max, paso_grados=0.1):
+    """
+    Devuelve un Polygon GeoJSON que sigue un rectángulo de coordenadas. En una consulta sobre un índice 2dsphere,
+    cada lado de un polígono es un arco de círculo máximo, y los lados este-oeste de un rectángulo de pocos
+    vértices se curvan hacia el polo (unos 40 km en el centro de un lado de 20° de longitud a 40° de latitud),
+    así que la consulta no coincidiría con la vista plana del mapa. Para seguir los paralelos, los lados
+    este-oeste se dividen en tramos de como mucho `paso_grados` de longitud (con 0,1°, la desviación es de
+    milímetros a las latitudes de España).
+
+    Args:
+        lon_min, lat_min, lon_max, lat_max (float): Límites del rectángulo en grados (EPSG:4326).
+        paso_grados (float): Longitud máxima de cada tramo de los lados este-oeste.
+
+    Returns:
+        dict: Polygon GeoJSON con el anillo cerrado en sentido antihorario.
+    """
+    n = max(1, int(np.ceil((lon_max - lon_min) / paso_grados)))
+    longitudes = np.linspace(lon_min, lon_max, n + 1).tolist()
+    anillo = ([[lon, lat_min] for lon in longitudes] + [[lon, lat_max] for lon in reversed(longitudes)]
+              + [[lon_min, lat_min]])
+    return {"type": "Polygon", "coordinates": [anillo]}
+
+
+def consultar_en_rectangulo(bd, nombre_coleccion, lon_min, lat_min, lon_max, lat_max, campos=None, filtro=None):
+    """
+    Importa sólo los anuncios dentro de un rectángulo de coordenadas (por ejemplo, la vista actual del mapa).
+    El rectángulo se envía como un polígono GeoJSON con los lados este-oeste densificados (ver
+    `rectangulo_geojson`), que sí puede usar el índice 2dsphere; $box sigue exactamente la geometría plana pero
+    sólo lo acelera un índice 2d, así que con un índice 2dsphere obligaría a recorrer toda la colección.
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        nombre_coleccion (str): Colección de anuncios.
+        lon_min, lat_min, lon_max, lat_max (float): Límites del rectángulo en grados (EPSG:4326).
+        campos (list, opcional): Propiedades a importar. Por defecto, todas.
+        filtro (dict, opcional): Filtro adicional de MongoDB.
+
+    Returns:
+        gpd.GeoDataFrame: Anuncios dentro del rectángulo.
+    """
+    rectangulo = rectangulo_geojson(lon_min, lat_min, lon_max, lat_max)
+    filtro_geo = {"geometry": {"$geoWithin": {"$geometry": rectangulo}}}
+    return importar_a_geodataframe(bd, nombre_coleccion, _combinar_filtros(filtro_geo, filtro), campos)
+
+
+def consultar_cerca_de(bd, nombre_coleccion, lon, lat, radio_m, campos=None, filtro=None):
+    """
+    Importa sólo los anuncios a menos de `radio_m` metros de un punto, ordenados del más cercano al más lejano.
+    Requiere el índice 2dsphere (ver `crear_indices_geoespaciales`).
+
+    Args:
+        bd (pymongo.database.Database): Objeto de la base de datos MongoDB.
+        nombre_coleccion (str): Colección de anuncios.
+        lon, lat (float): Coordenadas del punto en grados (EPSG:4326).
+        radio_m (float): Radio en metros.
+        campos (list, opcional): Propiedades a importar. Por defecto, todas.
+        filtro (dict, opcional): Filtro adicional de MongoDB.
+
+    Returns:
+        gpd.GeoDataFrame: Anuncios cercanos al punto.
+    """
+    filtro_geo = {"geometry": {"$near": {
+        "$geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "$maxDistance": radio_m,
+    }}}
+    # $near no se puede usar dentro de $and: el filtro adicional se añade como condiciones del mismo nivel
+    return importar_a_geodataframe(bd, nombre_coleccion, {**(filtro or {}), **filtro_geo}, campos)
+
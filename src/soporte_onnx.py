@@ -0,0 +1,218 @@
+import os
+import ast
+import time
+import threading
+import numpy as np
+import pandas as pd
+from PIL import Image
+from typing import Dict, List, Optional, Tuple
+
+# onnxruntime es una dependencia opcional: sólo se importa al crear una sesión o cuantizar un modelo.
+# Instalación: pip install onnx onnxruntime
+
+# Buffers de entrada reutilizados entre lotes (uno por hilo y forma de lote)
+_buffers = threading.local()
+
+
+def exportar_onnx(ruta_pt: str, cuantizar: bool = False, imgsz: int = 224) -> str:
+    """
+    Exporta un modelo YOLO de clasificación a ONNX y, opcionalmente, lo cuantiza a int8.
+    El fichero se genera junto al .pt; si ya existe, no se vuelve a exportar.
+
+    Args:
+        ruta_pt (str): Ruta del modelo YOLO (.pt).
+        cuantizar (bool): Si es True, genera además una versión con pesos int8 (cuantización dinámica).
+        imgsz (int): Tamaño de entrada del modelo.
+
+    Returns:
+        str: Ruta del modelo ONNX (la versión cuantizada si cuantizar es True).
+    """
+    ruta_onnx = os.path.splitext(ruta_pt)[0] + ".onnx"
+    if not os.path.exists(ruta_onnx):
+        from ultralytics import YOLO
+        ruta_onnx = YOLO(ruta_pt).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+
+    if not cuantizar:
+        return ruta_onnx
+
+    ruta_int8 = os.path.splitext(ruta_onnx)[0] + "-int8.onnx"
+    if not os.path.exists(ruta_int8):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(ruta_onnx, ruta_int8, weight_type=QuantType.QUInt8)
+    return ruta_int8
+
+
+def crear_sesion(ruta_onnx: str, hilos: Optional[int] = None, hilos_inter: int = 1):
+    """
+    Crea una sesión de ONNX Runtime en CPU con el número de hilos ajustado.
+
+    Args:
+        ruta_onnx (str): Ruta del modelo ONNX.
+        hilos (Optional[int]): Hilos para paralelizar cada operación. Por defecto, los núcleos disponibles.
+        hilos_inter (int): Hilos para ejecutar operaciones independientes en paralelo.
+
+    Returns:
+        onnxruntime.InferenceSession: Sesión lista para inferencia.
+    """
+    import onnxruntime as ort
+
+    opciones = ort.SessionOptions()
+    opciones.intra_op_num_threads = hilos or os.cpu_count() or 1
+    opciones.inter_op_num_threads = hilos_inter
+    opciones.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(ruta_onnx, sess_options=opciones, providers=["CPUExecutionProvider"])
+
+
+def nombres_clases(sesion) -> Dict[int, str]:
+    """
+    Devuelve el diccionario índice -> nombre de clase guardado por ultralytics en los metadatos del modelo ONNX.
+
+    Args:
+        sesion (onnxruntime.InferenceSession): Sesión del modelo.
+
+    Returns:
+        Dict[int, str]: Nombres de las clases.
+    """
+    if not hasattr(sesion, "_nombres_clases"):
+        sesion._nombres_clases = ast.literal_eval(sesion.get_modelmeta().custom_metadata_map["names"])
+    return sesion._nombres_clases
+
+
+def preprocesar(img: Image.Image, imgsz: int = 224, salida: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Aplica a una imagen las mismas transformaciones que ultralytics usa en clasificación:
+    redimensionar el lado corto a `imgsz`, recortar el centro y escalar a [0, 1] en formato CHW.
+
+    Args:
+        img (PIL.Image.Image): Imagen RGB.
+        imgsz (int): Tamaño de entrada del modelo.
+        salida (Optional[np.ndarray]): Array float32 (3, imgsz, imgsz) en el que escribir el resultado,
+            para reutilizar memoria entre imágenes. Si es None, se crea uno nuevo.
+
+    Returns:
+        np.ndarray: Array float32 de forma (3, imgsz, imgsz).
+    """
+    # Mismos redondeos que torchvision (Resize trunca el lado largo y CenterCrop redondea el desplazamiento),
+    # que es lo que usa ultralytics en classify_transforms
+    ancho, alto = img.size
+    if ancho <= alto:
+        nuevo_ancho, nuevo_alto = imgsz, int(imgsz * alto / ancho)
+    else:
+        nuevo_ancho, nuevo_alto = int(imgsz * ancho / alto), imgsz
+    img = img.convert("RGB").resize((nuevo_ancho, nuevo_alto), Image.BILINEAR)
+
+    izquierda, arriba = int(round((nuevo_ancho - imgsz) / 2.0)), int(round((nuevo_alto - imgsz) / 2.0))
+    img = img.crop((izquierda, arriba, izquierda + imgsz, arriba + imgsz))
+
+    if salida is None:
+        salida = np.empty((3, imgsz, imgsz), dtype=np.float32)
+    np.multiply(np.asarray(img).transpose(2, 0, 1), 1 / 255.0, out=salida, casting="unsafe")
+    return salida
+
+
+def _buffer_entrada(n: int, imgsz: int) -> np.ndarray:
+    """
+    Devuelve un buffer float32 (n, 3, imgsz, imgsz) reutilizable por el hilo actual.
+    """
+    clave = (n, imgsz)
+    buffers = getattr(_buffers, "por_forma", None)
+    if buffers is None:
+        buffers = _buffers.por_forma = {}
+    if clave not in buffers:
+        buffers[clave] = np.empty((n, 3, imgsz, imgsz), dtype=np.float32)
+    return buffers[clave]
+
+
+def clasificar_lote(sesion, imagenes: List[Image.Image], k: int = 5, imgsz: int = 224) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clasifica un lote de imágenes con una sesión ONNX.
+
+    Args:
+        sesion (onnxruntime.InferenceSession): Sesión del modelo.
+        imagenes (List[PIL.Image.Image]): Imágenes a clasificar.
+        k (int): Número de clases más probables a devolver.
+        imgsz (int): Tamaño de entrada del modelo.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Índices (n, k) y probabilidades (n, k) del top-k de cada imagen.
+    """
+    entrada = _buffer_entrada(len(imagenes), imgsz)
+    for i, img in enumerate(imagenes):
+        preprocesar(img, imgsz, salida=entrada[i])
+    probs = sesion.run(None, {sesion.get_inputs()[0].name: entrada})[0]
+    indices = np.argsort(-probs, axis=1)[:, :k]
+    return indices, np.take_along_axis(probs, indices, axis=1)
+
+
+def clasificar(sesion, img: Image.Image, k: int = 5) -> Tuple[List[str], List[float]]:
+    """
+    Clasifica una imagen con una sesión ONNX y devuelve las etiquetas y probabilidades del top-k.
+
+    Args:
+        sesion (onnxruntime.InferenceSession): Sesión del modelo.
+        img (PIL.Image.Image): Imagen a clasificar.
+        k (int): Número de clases más probables a devolver.
+
+    Returns:
+        Tuple[List[str], List[float]]: Etiquetas y probabilidades del top-k.
+    """
+    indices, probs = clasificar_lote(sesion, [img], k)
+    nombres = nombres_clases(sesion)
+    return [nombres[int(i)] for i in indices[0]], [float(p) for p in probs[0]]
+
+
+def comparar_backends(rutas_imagenes: List[str], ruta_pt: str, rutas_onnx: Dict[str, str],
+                      hilos: Optional[int] = None, tamanio_lote: int = 1) -> pd.DataFrame:
+    """
+    Compara el rendimiento y la concordancia del modelo PyTorch con una o varias versiones ONNX
+    sobre un conjunto fijo de imágenes locales. Las imágenes se cargan antes de medir.
+
+    Args:
+        rutas_imagenes (List[str]): Rutas de las imágenes locales.
+        ruta_pt (str): Ruta del modelo YOLO (.pt) de referencia.
+        rutas_onnx (Dict[str, str]): Nombre de cada variante -> ruta del modelo ONNX, por ejemplo
+            {"onnx": "yolo11x-cls.onnx", "onnx-int8": "yolo11x-cls-int8.onnx"}.
+        hilos (Optional[int]): Hilos de ONNX Runtime y de PyTorch.
+        tamanio_lote (int): Imágenes por llamada al modelo ONNX.
+
+    Returns:
+        pd.DataFrame: Una fila por backend con imágenes por segundo, aceleración, coincidencia del top-1
+            y solapamiento medio del top-5 con PyTorch.
+    """
+    from ultralytics import YOLO
+    import torch
+
+    imagenes = [Image.open(ruta).convert("RGB") for ruta in rutas_imagenes]
+    if hilos:
+        torch.set_num_threads(hilos)
+
+    # Referencia: PyTorch a través de ultralytics
+    modelo = YOLO(ruta_pt)
+    modelo(imagenes[0], verbose=False)
+    inicio = time.perf_counter()
+    top5_pt = [list(modelo(img, verbose=False)[0].probs.top5) for img in imagenes]
+    duracion = time.perf_counter() - inicio
+    resultados = [{"backend": "pytorch", "imagenes_por_segundo": len(imagenes) / duracion,
+                   "coincidencia_top1": 1.0, "solapamiento_top5": 1.0}]
+
+    for nombre, ruta in rutas_onnx.items():
+        sesion = crear_sesion(ruta, hilos)
+        clasificar_lote(sesion, imagenes[:1])
+        inicio = time.perf_counter()
+        top5_onnx = []
+        for i in range(0, len(imagenes), tamanio_lote):
+            indices, _ = clasificar_lote(sesion, imagenes[i:i + tamanio_lote])
+            top5_onnx.extend(indices.tolist())
+        duracion = time.perf_counter() - inicio
+
+        resultados.append({
+            "backend": nombre,
+            "imagenes_por_segundo": len(imagenes) / duracion,
+            "coincidencia_top1": np.mean([a[0] == b[0] for a, b in zip(top5_pt, top5_onnx)]),
+            "solapamiento_top5": np.mean([len(set(a) & set(b)) / 5 for a, b in zip(top5_pt, top5_onnx)]),
+        })
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados["aceleracion"] = df_resultados["imagenes_por_segundo"] / df_resultados.loc[0, "imagenes_por_segundo"]
+    return df_resultados
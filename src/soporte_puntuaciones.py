@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import pandas as pd
+from typing import Optional, Tuple
+
+
+# Fichero SQLite donde se guardan las evaluaciones del modelo de lenguaje (se puede sobreescribir con una variable de entorno)
+RUTA_ALMACEN = os.getenv(
+    "almacen_puntuaciones",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "puntuaciones.sqlite")
+)
+
+_lock = threading.RLock()
+_conexion = None
+_pid_conexion = None
+_estadisticas = {"aciertos": 0, "fallos": 0}
+
+
+def configurar_almacen(ruta: str) -> None:
+    """
+    Cambia el fichero SQLite del almacén de evaluaciones.
+
+    Args:
+        ruta (str): Ruta del nuevo fichero. Se crea si no existe.
+    """
+    global RUTA_ALMACEN, _conexion
+    with _lock:
+        if _conexion is not None:
+            _conexion.close()
+            _conexion = None
+        RUTA_ALMACEN = ruta
+
+
+def _obtener_conexion() -> sqlite3.Connection:
+    """
+    Abre (una vez por proceso) el almacén y crea la tabla si no existe.
+    Cada evaluación se identifica por el hash del contenido de la foto de cocina y de la de baño
+    (cadena vacía si falta la foto), el modelo y la versión del prompt.
+    """
+    global _conexion, _pid_conexion
+    if _conexion is None or _pid_conexion != os.getpid():
+        os.makedirs(os.path.dirname(os.path.abspath(RUTA_ALMACEN)), exist_ok=True)
+        _conexion = sqlite3.connect(RUTA_ALMACEN, timeout=30, check_same_thread=False)
+        _conexion.execute("PRAGMA journal_mode=WAL")
+        _conexion.execute(
+            """CREATE TABLE IF NOT EXISTS puntuaciones (
+                hash_cocina TEXT, hash_banio TEXT, modelo TEXT, version_prompt TEXT,
+                puntuacion_cocina INTEGER, mts_cocina INTEGER, puntuacion_banio INTEGER, mts_banio INTEGER,
+                PRIMARY KEY (hash_cocina, hash_banio, modelo, version_prompt)
+            )"""
+        )
+        _conexion.commit()
+        _pid_conexion = os.getpid()
+    return _conexion
+
+
+def guardar(hash_cocina: Optional[str], hash_banio: Optional[str], modelo: str, version_prompt: str,
+            evaluacion: Tuple[int, int, int, int]) -> None:
+    """
+    Guarda la evaluación de una propiedad.
+
+    Args:
+        hash_cocina (Optional[str]): Hash del contenido de la foto de cocina, o None si no tiene.
+        hash_banio (Optional[str]): Hash del contenido de la foto de baño, o None si no tiene.
+        modelo (str): Modelo que ha hecho la evaluación.
+        version_prompt (str): Versión del prompt usado.
+        evaluacion (Tuple[int, int, int, int]): (puntuacion_cocina, mts_cocina, puntuacion_banio, mts_banio).
+    """
+    with _lock:
+        conexion = _obtener_conexion()
+        conexion.execute(
+            "INSERT OR REPLACE INTO puntuaciones VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (hash_cocina or "", hash_banio or "", modelo, version_prompt, *[int(v) for v in evaluacion])
+        )
+        conexion.commit()
+
+
+def consultar(hash_cocina: Optional[str], hash_banio: Optional[str], modelo: str,
+              version_prompt: str) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Devuelve la evaluación guardada de una propiedad, o None si no se ha evaluado con ese modelo y prompt.
+
+    Args:
+        hash_cocina (Optional[str]): Hash del contenido de la foto de cocina, o None si no tiene.
+        hash_banio (Optional[str]): Hash del contenido de la foto de baño, o None si no tiene.
+        modelo (str): Modelo.
+        version_prompt (str): Versión del prompt.
+
+    Returns:
+        Optional[Tuple[int, int, int, int]]: (puntuacion_cocina, mts_cocina, puntuacion_banio, mts_banio).
+    """
+    with _lock:
+        fila = _obtener_conexion().execute(
+            """SELECT puntuacion_cocina, mts_cocina, puntuacion_banio, mts_banio FROM puntuaciones
+               WHERE hash_cocina = ? AND hash_banio = ? AND modelo = ? AND version_prompt = ?""",
+            (hash_cocina or "", hash_banio or "", modelo, version_prompt)
+        ).fetchone()
+        _estadisticas["aciertos" if fila else "fallos"] += 1
+    return tuple(fila) if fila else None
+
+
+def invalidar(version_prompt: Optional[str] = None, modelo: Optional[str] = None) -> int:
+    """
+    Borra evaluaciones del almacén. Sin argumentos borra todas; con `version_prompt` borra las de
+    cualquier otra versión del prompt (las que ya no se pueden servir), y con `modelo` sólo las de ese modelo.
+
+    Args:
+        version_prompt (Optional[str]): Versión del prompt vigente, cuyas evaluaciones se conservan.
+        modelo (Optional[str]): Limitar el borrado a las evaluaciones de este modelo.
+
+    Returns:
+        int: Número de evaluaciones borradas.
+    """
+    condiciones, parametros = [], []
+    if version_prompt is not None:
+        condiciones.append("version_prompt != ?")
+        parametros.append(version_prompt)
+    if modelo is not None:
+        condiciones.append("modelo = ?")
+        parametros.append(modelo)
+    consulta = "DELETE FROM puntuaciones" + (" WHERE " + " AND ".join(condiciones) if condiciones else "")
+    with _lock:
+        conexion = _obtener_conexion()
+        borradas = conexion.execute(consulta, parametros).rowcount
+        conexion.commit()
+    return borradas
+
+
+def reiniciar_estadisticas() -> None:
+    """
+    Pone a cero los contadores de aciertos y fallos del proceso actual.
+    """
+    with _lock:
+        _estadisticas.update(aciertos=0, fallos=0)
+
+
+def estadisticas_almacen() -> dict:
+    """
+    Devuelve las consultas resueltas por el almacén en el proceso actual y su contenido.
+
+    Returns:
+        dict: Aciertos, fallos, tasa de aciertos, número de evaluaciones guardadas y evaluaciones
+            por modelo y versión del prompt.
+    """
+    with _lock:
+        conexion = _obtener_conexion()
+        total = conexion.execute("SELECT COUNT(*) FROM puntuaciones").fetchone()[0]
+        por_version = pd.read_sql_query(
+            "SELECT modelo, version_prompt, COUNT(*) AS evaluaciones FROM puntuaciones GROUP BY modelo, version_prompt",
+            conexion
+        )
+        consultas = _estadisticas["aciertos"] + _estadisticas["fallos"]
+        return {
+            **_estadisticas,
+            "tasa_aciertos": _estadisticas["aciertos"] / consultas if consultas else 0.0,
+            "evaluaciones": total,
+            "por_version": por_version.to_dict("records"),
+        }
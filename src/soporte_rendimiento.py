@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from PIL import Image
+from typing import List, Optional
+
+
+# Directorio raíz del proyecto, desde el que se pueden importar los módulos como `src.soporte_*`
+DIRECTORIO_PROYECTO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Script que se ejecuta en un proceso limpio: importa el módulo, opcionalmente llama a una
+# función suya, y devuelve tiempos y memoria máxima (RSS) en JSON
+_SCRIPT_MEDICION = """
+import sys, json, time, resource, importlib
+
+def rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # En macOS ru_maxrss se expresa en bytes y en Linux en KB
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+modulo, funcion = sys.argv[1], sys.argv[2]
+rss_inicial = rss_mb()
+inicio = time.perf_counter()
+mod = importlib.import_module(modulo)
+resultado = {"segundos_importacion": time.perf_counter() - inicio, "mb_importacion": rss_mb() - rss_inicial}
+if funcion:
+    inicio = time.perf_counter()
+    getattr(mod, funcion)()
+    resultado["segundos_" + funcion] = time.perf_counter() - inicio
+    resultado["mb_" + funcion] = rss_mb() - rss_inicial
+print(json.dumps(resultado))
+"""
+
+
+def medir_importacion(modulo: str, funcion: Optional[str] = None, repeticiones: int = 3) -> dict:
+    """
+    Mide el tiempo y la memoria que cuesta importar un módulo en un proceso de Python limpio
+    y, opcionalmente, llamar a una de sus funciones (por ejemplo, `warmup`).
+
+    Args:
+        modulo (str): Nombre importable del módulo, por ejemplo "src.soporte_yolo".
+        funcion (Optional[str]): Función sin argumentos del módulo a ejecutar tras la importación.
+        repeticiones (int): Número de procesos a lanzar; se devuelve la mediana.
+
+    Returns:
+        dict: Segundos y MB de RSS añadidos por la importación (y por la función, si se indica). Si la
+            importación o la función fallan (por ejemplo, porque falta ultralytics o los pesos del modelo),
+            un diccionario con la última línea del error en "error".
+    """
+    mediciones = []
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [sys.executable, "-c", _SCRIPT_MEDICION, modulo, funcion or ""],
+            cwd=DIRECTORIO_PROYECTO, capture_output=True, text=True
+        )
+        if salida.returncode != 0:
+            return {"error": (salida.stderr.strip().splitlines() or ["sin salida"])[-1]}
+        mediciones.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+    return pd.DataFrame(mediciones).median().to_dict()
+
+
+def comparar_importaciones(modulos: List[str], funcion: Optional[str] = None, repeticiones: int = 3) -> pd.DataFrame:
+    """
+    Aplica `medir_importacion` a varios módulos y devuelve los resultados en un DataFrame.
+
+    Args:
+        modulos (List[str]): Nombres importables de los módulos.
+        funcion (Optional[str]): Función sin argumentos a ejecutar tras cada importación.
+        repeticiones (int): Número de procesos por módulo.
+
+    Returns:
+        pd.DataFrame: Una fila por módulo con sus tiempos y memoria.
+    """
+    return pd.DataFrame(
+        [{"modulo": modulo, **medir_importacion(modulo, funcion, repeticiones)} for modulo in modulos]
+    )
+
+
+def comparar_decodificacion(imagenes: List[str], tamanio: int = 224, repeticiones: int = 3) -> pd.DataFrame:
+    """
+    Compara la decodificación completa de cada foto con la decodificación reducida (modo draft de JPEG)
+    de `soporte_cache.decodificar`, incluyendo en ambos casos el redimensionado al tamaño del modelo.
+
+    Args:
+        imagenes (List[str]): Rutas locales o URLs de fotos de anuncios (las URLs se leen de la caché).
+        tamanio (int): Tamaño de entrada del modelo (224 para YOLO, 384 para BLIP).
+        repeticiones (int): Veces que se decodifica cada imagen; se toma el mejor tiempo.
+
+    Returns:
+        pd.DataFrame: Una fila por modo con los milisegundos medios de decodificación por imagen,
+            los MB medios de píxeles decodificados por imagen y la aceleración frente a la decodificación completa.
+    """
+    from src import soporte_cache as sc
+
+    contenidos = []
+    for imagen in imagenes:
+        if os.path.exists(imagen):
+            with open(imagen, "rb") as f:
+                contenidos.append(f.read())
+        else:
+            contenidos.append(sc.obtener_bytes(imagen))
+
+    resultados = []
+    for modo, tamanio_minimo in [("completa", None), ("reducida", tamanio)]:
+        tiempos, memoria = [], []
+        for datos in contenidos:
+            mejor = float("inf")
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                img = sc.decodificar(datos, tamanio_minimo)
+                pixeles = img.size[0] * img.size[1] * 3
+                escala = tamanio / min(img.size)
+                img.resize((round(img.size[0] * escala), round(img.size[1] * escala)), Image.BILINEAR)
+                mejor = min(mejor, time.perf_counter() - inicio)
+            tiempos.append(mejor)
+            memoria.append(pixeles / (1024 * 1024))
+        resultados.append({
+            "modo": modo,
+            "imagenes": len(contenidos),
+            "ms_por_imagen": 1000 * sum(tiempos) / len(tiempos),
+            "mb_por_imagen": sum(memoria) / len(memoria),
+        })
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados["aceleracion"] = df_resultados.loc[0, "ms_por_imagen"] / df_resultados["ms_por_imagen"]
+    return df_resultados
+
+
+def documentos_sinteticos(n: int = 100_000, semilla: int = 42, tamanio_bloque: int = 10_000):
+    """
+    Genera, en listas de `tamanio_bloque`, anuncios sintéticos con el mismo formato GeoJSON que las
+    colecciones de venta.
+
+    Args:
+        n (int): Número de documentos.
+        semilla (int): Semilla de los datos aleatorios.
+        tamanio_bloque (int): Documentos por lista.
+
+    Yields:
+        list: Documentos del bloque.
+    """
+    generador = np.random.default_rng(semilla)
+    distritos = np.array(["Centro", "Salamanca", "Chamberí", "Retiro", "Tetuán", "Latina", "Usera", "Vallecas"])
+    for inicio in range(0, n, tamanio_bloque):
+        m = min(tamanio_bloque, n - inicio)
+        lon, lat = -3.7 + generador.normal(0, 0.05, m), 40.42 + generador.normal(0, 0.04, m)
+        yield [{
+            "id": str(inicio + i),
+            "type": "Feature",
+            "properties": {
+                "codigo": int(inicio + i),
+                "precio": float(generador.integers(80_000, 1_500_000)),
+                "tamanio": float(generador.integers(30, 250)),
+                "habitaciones": int(generador.integers(0, 6)),
+                "banios": int(generador.integers(1, 4)),
+                "distrito": str(generador.choice(distritos)),
+                "descripcion": "Piso luminoso " * int(generador.integers(5, 40)),
+                "url_cocina": f"https://img.example.com/{inicio + i}/cocina.jpg",
+                "url_banio": f"https://img.example.com/{inicio + i}/banio.jpg",
+            },
+            "geometry": {"type": "Point", "coordinates": [float(lon[i]), float(lat[i])]},
+        } for i in range(m)]
+
+
+def crear_coleccion_sintetica(bd, nombre_coleccion: str, n: int = 100_000, semilla: int = 42) -> None:
+    """
+    Crea (reemplazándola) una colección de anuncios sintéticos (ver `documentos_sinteticos`), para medir
+    la importación sobre una instancia local de MongoDB.
+
+    Args:
+        bd (pymongo.database.Database): Base de datos (por ejemplo, de un mongod local).
+        nombre_coleccion (str): Nombre de la colección a crear.
+        n (int): Número de documentos.
+        semilla (int): Semilla de los datos aleatorios.
+    """
+    bd[nombre_coleccion].drop()
+    for documentos in documentos_sinteticos(n, semilla):
+        bd[nombre_coleccion].insert_many(documentos)
+
+
+def comparar_conversion_documentos(n: int = 100_000, tamanio_bloque: int = 20_000,
+                                   repeticiones: int = 3) -> pd.DataFrame:
+    """
+    Compara, sin servidor, el coste de convertir en DataFrame bloques de documentos ya leídos de MongoDB:
+    json_normalize sobre la lista de diccionarios frente a `soporte_mongo.documentos_a_dataframe`, que
+    construye las columnas tipadas directamente. Es la parte de `leer_en_bloques` que no depende de la red.
+
+    Args:
+        n (int): Número de documentos sintéticos.
+        tamanio_bloque (int): Documentos por bloque, como en `leer_en_bloques`.
+        repeticiones (int): Veces que se mide cada variante; se toma el mejor tiempo.
+
+    Returns:
+        pd.DataFrame: Una fila por variante con segundos, MB máximos (tracemalloc) y la aceleración
+            respecto a json_normalize.
+    """
+    import bson
+    from pandas import json_normalize
+    from src import soporte_mongo as sm
+
+    bloques = list(documentos_sinteticos(n, tamanio_bloque=tamanio_bloque))
+    for documentos in bloques:
+        for documento in documentos:
+            documento["_id"] = bson.ObjectId()
+
+    variantes = [
+        ("json_normalize", lambda documentos: json_normalize(documentos, sep="_")),
+        ("columnas_tipadas", lambda documentos: sm.documentos_a_dataframe(documentos, sep="_")),
+    ]
+    resultados = []
+    for nombre, convertir in variantes:
+        mejor, memoria = float("inf"), 0.0
+        for _ in range(repeticiones):
+            tracemalloc.start()
+            inicio = time.perf_counter()
+            df = pd.concat([convertir(documentos) for documentos in bloques], ignore_index=True)
+            mejor = min(mejor, time.perf_counter() - inicio)
+            memoria = max(memoria, tracemalloc.get_traced_memory()[1] / (1024 * 1024))
+            tracemalloc.stop()
+        resultados.append({"variante": nombre, "segundos": mejor, "mb_maximos": memoria,
+                           "filas": len(df), "columnas": df.shape[1]})
+        del df
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados["aceleracion"] = df_resultados.loc[0, "segundos"] / df_resultados["segundos"]
+    return df_resultados
+
+
+def comparar_importacion_mongo(bd, nombre_coleccion: str, campos: Optional[List[str]] = None,
+                               filtro: Optional[dict] = None, repeticiones: int = 1) -> pd.DataFrame:
+    """
+    Compara el tiempo y la memoria máxima de Python (tracemalloc) de importar una colección con la
+    lectura completa anterior (list(find()) + json_normalize y eliminar columnas después) y con la lectura
+    en bloques de `soporte_mongo.importar_a_dataframe`, con y sin proyección de campos. Las cifras sólo son
+    representativas contra un mongod real: con una base de datos simulada en memoria (p. ej. mongomock) no hay
+    red ni decodificación BSON, y el tiempo lo domina la copia de documentos del propio simulador.
+
+    Args:
+        bd (pymongo.database.Database): Base de datos.
+        nombre_coleccion (str): Colección a importar (por ejemplo, una creada con `crear_coleccion_sintetica`).
+        campos (Optional[List[str]]): Campos de la variante con proyección, p. ej. ["properties.precio"].
+        filtro (Optional[dict]): Filtro aplicado en todas las variantes.
+        repeticiones (int): Veces que se mide cada variante; se toma el mejor tiempo.
+
+    Returns:
+        pd.DataFrame: Una fila por variante con segundos, MB máximos, filas y columnas del resultado.
+    """
+    from pandas import json_normalize
+    from src import soporte_mongo as sm
+
+    def completa():
+        documentos = list(bd[nombre_coleccion].find(filtro or {}))
+        df = json_normalize(documentos, sep="_")
+        return df.drop(columns=[col for col in ["_id", "type", "id"] if col in df.columns])
+
+    variantes = [
+        ("completa", completa),
+        ("bloques", lambda: sm.importar_a_dataframe(bd, nombre_coleccion, filtro)),
+    ]
+    if campos:
+        variantes.append(("bloques_proyeccion", lambda: sm.importar_a_dataframe(bd, nombre_coleccion, filtro, campos)))
+
+    resultados = []
+    for nombre, funcion in variantes:
+        mejor, memoria = float("inf"), 0.0
+        for _ in range(repeticiones):
+            tracemalloc.start()
+            inicio = time.perf_counter()
+            df = funcion()
+            mejor = min(mejor, time.perf_counter() - inicio)
+            memoria = max(memoria, tracemalloc.get_traced_memory()[1] / (1024 * 1024))
+            tracemalloc.stop()
+        resultados.append({"variante": nombre, "segundos": mejor, "mb_maximos": memoria,
+                           "filas": len(df), "columnas": df.shape[1]})
+        del df
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados["aceleracion"] = df_resultados.loc[0, "segundos"] / df_resultados["segundos"]
+    return df_resultados
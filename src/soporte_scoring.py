@@ -1,13 +1,23 @@
 import os
+import json
 import time
+import hashlib
 import base64
+import random
+import asyncio
 import imghdr
-import requests
+import numpy as np
 import pandas as pd
-from typing import List, Tuple, Optional
-from anthropic import Anthropic
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional
+from anthropic import Anthropic, AsyncAnthropic, APIConnectionError, APIStatusError, RateLimitError
 from dotenv import load_dotenv
 from tqdm.notebook import tqdm
+from src import soporte_cache as sc
+from src import soporte_puntuaciones as sp
 
 
 # Obtiene la clave de la API desde las variables de entorno
@@ -30,24 +40,73 @@ def obtener_tipo_mime(contenido: bytes) -> str:
     formato = imghdr.what(None, contenido)
     return f"image/{formato}" if formato else "image/jpeg"
 
+# Preprocesado de las fotos antes de codificarlas en base64: lado largo máximo en píxeles y calidad JPEG.
+# Con lado_maximo=None se envían los bytes originales.
+config_imagenes = {"lado_maximo": 1024, "calidad": 85}
+
+
+def configurar_imagenes(lado_maximo: Optional[int] = 1024, calidad: int = 85) -> None:
+    """
+    Ajusta el preprocesado de las fotos que se envían al modelo.
+
+    Args:
+        lado_maximo (Optional[int]): Lado largo máximo en píxeles. None para enviar las fotos originales.
+        calidad (int): Calidad JPEG (1-95) de la recompresión.
+    """
+    config_imagenes.update(lado_maximo=lado_maximo, calidad=calidad)
+
+
+def reducir_imagen(contenido: bytes, lado_maximo: int = 1024, calidad: int = 85) -> bytes:
+    """
+    Reduce una foto para enviarla al modelo: la gira según su orientación EXIF, la escala para que su lado
+    largo no supere `lado_maximo`, la recomprime como JPEG con la calidad indicada y descarta sus metadatos
+    (EXIF, ICC, miniaturas).
+
+    Args:
+        contenido (bytes): Contenido original de la imagen.
+        lado_maximo (int): Lado largo máximo en píxeles.
+        calidad (int): Calidad JPEG (1-95).
+
+    Returns:
+        bytes: Imagen JPEG resultante. Si la foto ya cabía en `lado_maximo`, no había que girarla y la
+            recompresión no la hace más pequeña, se devuelven los bytes originales.
+    """
+    imagen = sc.decodificar(contenido, lado_maximo)
+    # Al descartar el EXIF se pierde la orientación: hay que aplicarla a los píxeles antes de guardar
+    girada = imagen.getexif().get(0x0112, 1) != 1
+    if girada:
+        imagen = ImageOps.exif_transpose(imagen)
+    redimensionada = max(imagen.size) > lado_maximo
+    if redimensionada:
+        imagen.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS)
+
+    salida = BytesIO()
+    imagen.save(salida, format="JPEG", quality=calidad, optimize=True)
+    reducida = salida.getvalue()
+    if not redimensionada and not girada and len(reducida) >= len(contenido):
+        return contenido
+    return reducida
+
+
 def url_a_base64_con_mime(url: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
     """
-    Descarga una imagen desde una URL y la convierte a base64 junto con su tipo MIME.
+    Obtiene una imagen desde la caché local (o la descarga), la reduce según `config_imagenes`
+    y la convierte a base64 junto con su tipo MIME.
     
     Args:
         url (Optional[str]): URL de la imagen. Puede ser None.
     
     Returns:
         Tuple[Optional[str], Optional[str]]: Codificación base64 y tipo MIME de la imagen.
-        Retorna (None, None) si la URL es None o hay un error.
+        Retorna (None, None) si la URL es None (o NaN) o hay un error.
     """
-    if url is None:
+    if not isinstance(url, str):
         return None, None
         
     try:
-        respuesta = requests.get(url)
-        respuesta.raise_for_status()
-        contenido = respuesta.content
+        contenido = sc.obtener_bytes(url)
+        if config_imagenes["lado_maximo"]:
+            contenido = reducir_imagen(contenido, config_imagenes["lado_maximo"], config_imagenes["calidad"])
         return base64.b64encode(contenido).decode('utf-8'), obtener_tipo_mime(contenido)
     except Exception as e:
         print(f"Error descargando imagen {url}: {e}")
@@ -92,59 +151,20 @@ def preparar_imagenes_lote(
     return resultados
 
 
-def analizar_lote_propiedades(
-    cliente,
-    imagenes_preparadas: List[Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]],
-    batch: int = 3
-) -> List[Tuple[int, int, int, int]]:
-    """
-    Analiza un lote de propiedades utilizando la API de Anthropic para evaluar cocinas y/o baños.
-    Procesa imágenes individuales si solo una está disponible.
+# Modelo y límite de tokens de salida usados para evaluar las propiedades
+MODELO_SCORING = "claude-3-haiku-20240307"
+MAX_TOKENS_SCORING = 300
 
-    Args:
-        cliente: Cliente de la API de Anthropic.
-        imagenes_preparadas: Lista de tuplas (cocina_base64, cocina_mime, banio_base64, banio_mime).
-            Cualquier elemento puede ser None si la imagen no está disponible.
-        batch (int): Tamaño del lote a procesar.
+# Límites que acotan el tamaño de lote: imágenes por petición que admite la API, tokens de salida
+# del modelo y tokens de salida que ocupa aproximadamente la evaluación de cada propiedad
+MAX_IMAGENES_PETICION = 100
+MAX_TOKENS_SALIDA_MODELO = 4096
+TOKENS_POR_PROPIEDAD = 50
+MAX_PROPIEDADES_LOTE = min(MAX_IMAGENES_PETICION // 2, MAX_TOKENS_SALIDA_MODELO // TOKENS_POR_PROPIEDAD)
 
-    Returns:
-        List[Tuple[int, int, int, int]]: Lista de tuplas con evaluaciones (puntuaciones y tamaños).
-        Para imágenes faltantes, los valores correspondientes serán 0.
-    """
-    try:
-        content = []
-        for idx, (cocina_base64, cocina_mime, banio_base64, banio_mime) in enumerate(imagenes_preparadas):
-            # Agregar imágenes disponibles
-            if cocina_base64 and cocina_mime:
-                content.extend([
-                    {
-                        "type": "image",
-                        "source": {"type": "base64", "media_type": cocina_mime, "data": cocina_base64}
-                    },
-                    {
-                        "type": "text",
-                        "text": f"Property {idx + 1} Kitchen: Analyze this kitchen image."
-                    }
-                ])
-            
-            if banio_base64 and banio_mime:
-                content.extend([
-                    {
-                        "type": "image",
-                        "source": {"type": "base64", "media_type": banio_mime, "data": banio_base64}
-                    },
-                    {
-                        "type": "text",
-                        "text": f"Property {idx + 1} Bathroom: Analyze this bathroom image."
-                    }
-                ])
-
-        if not content:
-            return []
-
-        content.append({
-            "type": "text",
-            "text": """You are an AI image analysis system specialized in evaluating property conditions. Your task is to analyze property images in batch and provide a precise evaluation.
+# Instrucciones de evaluación: formato de la respuesta y escala de puntuaciones. Hasta que se pasaron al prompt
+# de sistema se enviaban en cada petición después de las imágenes (ver `medir_cache_prompt`)
+INSTRUCCIONES_EVALUACION = """You are an AI image analysis system specialized in evaluating property conditions. Your task is to analyze property images in batch and provide a precise evaluation.
 
             Instructions for Analysis:
             Analyze each image:
@@ -161,35 +181,605 @@ def analizar_lote_propiedades(
             Sizes: Whole numbers in square meters (m²)
 
             Analysis Requirements:
-            A. For each property, provide a tuple of 4 numbers: (kitchen_rating, kitchen_size, bathroom_rating, bathroom_size)
-            B. If an image is missing, use (0, 0) for that room's values
-            C. Output format must be a list of tuples: [(4,10,0,0), (0,0,4,9), (3,12,4,9),...]
+            A. For each property, provide an object with its ID and 4 numbers: kitchen_rating, kitchen_size, bathroom_rating, bathroom_size
+            B. If an image is missing, use 0 for that room's rating and size
+            C. Output format must be a JSON array: [{"id": "1", "kitchen_rating": 4, "kitchen_size": 10, "bathroom_rating": 0, "bathroom_size": 0}, ...]
 
             Notes:
-            Remember, your output must be ONLY a list of tuples, with no additional text or explanation.
+            Remember, your output must be ONLY the JSON array, with no additional text or explanation.
+            Use exactly the property IDs given with the images, one object per property.
             Each property must have all 4 values, using 0 for missing images.
             """
-        })
 
-        mensaje = cliente.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=300,
-            messages=[{"role": "user", "content": content}]
-        )
-        
-        respuesta_texto = mensaje.content[0].text.strip()
-        resultados = eval(respuesta_texto)
+# Guía de evaluación que acompaña a las instrucciones en el prompt de sistema: descripción de cada puntuación,
+# referencias para estimar los m², casos especiales y ejemplos resueltos. Hace las evaluaciones más consistentes
+# y lleva el prefijo fijo por encima del mínimo de tokens que la API cachea con Haiku (ver `MIN_TOKENS_CACHE`)
+GUIA_EVALUACION = """Detailed Rating Guide (applies to every request; read it before looking at the images):
+
+Kitchen condition, what each rating looks like:
+1 - Very poor: the kitchen must be stripped out. Typical signs are broken or missing cabinet doors, worktops that are burnt, swollen or split, no fitted appliances or appliances that are clearly decades old, exposed pipes or wiring, damp stains or mould on walls and ceiling, tiles that are cracked or missing in large areas, and a layout that no longer works (for example, a sink or cooker standing on its own without cabinets).
+2 - Poor: the kitchen is usable but needs a full refit soon. Cabinets are dated (laminate peeling, handles missing, doors misaligned), the worktop is stained or chipped along its length, appliances are old and mismatched, the splashback is damaged or made of old small tiles with dark grout, lighting is a single bare fitting, and floors are worn through.
+3 - Fair: the structure is sound and everything works, but the finishes are clearly from an older renovation (roughly 15 to 25 years). Expect visible wear on cabinet edges, an older but intact worktop, working appliances of mixed ages, and tiles that are dated but undamaged. Repainting, new fronts or a new worktop would noticeably improve it.
+4 - Good: a recent or well kept kitchen with only minor issues. Cabinets and worktop are in good condition, appliances are integrated or modern, the splashback and floor are clean and intact, and lighting is adequate. Small scuffs, an older tap or a single outdated appliance do not lower the rating below 4.
+5 - Excellent: new or like new. Modern cabinets with uniform fronts, stone, quartz or high quality laminate worktops without marks, integrated modern appliances, good under-cabinet or recessed lighting, and no visible wear anywhere. Nothing needs to be done before moving in.
+
+Bathroom condition, what each rating looks like:
+1 - Very poor: the bathroom must be stripped out. Typical signs are broken sanitary ware, missing or rotten fittings, extensive mould, water damage on walls or ceiling, loose or missing tiles over large areas, and no working shower or bath.
+2 - Poor: usable but needs a full refit. Old coloured sanitary ware (pink, green, beige suites), cracked or heavily stained enamel, old taps with limescale, tiles with broken edges or dark, failing grout, a shower curtain over an old bath, and poor ventilation with visible damp.
+3 - Fair: sound and working, but dated. White sanitary ware in good order, older tiles that are intact, a bath or shower tray that is clean but old fashioned, basic lighting and storage. A partial update (new screen, taps, vanity unit) would clearly improve it.
+4 - Good: recently renovated or well maintained. Modern white sanitary ware, a shower screen or modern bath, intact and clean tiling, a vanity unit with storage, and good lighting. Minor wear such as a worn silicone line or a dated accessory does not lower the rating below 4.
+5 - Excellent: new or like new. Walk-in shower or modern bath, wall-hung or modern sanitary ware, large format tiles or high quality finishes, modern taps and fittings, good lighting and no visible wear.
+
+How to choose between two ratings:
+- Rate the condition of what is visible, not the style. A clean, intact kitchen with traditional wooden cabinets is not worse than a modern one in the same condition, but visible age and wear are.
+- Rate the room as a whole. A single new appliance does not make an old kitchen good, and a single stained tile does not make a new bathroom fair.
+- When the evidence sits between two ratings, choose the lower one only if something visible would need money to fix; otherwise choose the higher one.
+- Do not reward staging or photography. Bright lighting, wide-angle lenses and decoration do not change the condition of the fittings.
+- Do not guess about things you cannot see. If only part of the room is visible, rate the visible part.
+
+Estimating sizes in square meters:
+- Use objects of standard size as references. Kitchen base cabinets and appliances are usually 60 cm wide and 60 cm deep; a standard worktop is 60 to 65 cm deep and about 90 cm high; a refrigerator is about 60 to 70 cm wide; interior doors are about 70 to 80 cm wide and 2 m high; floor tiles are commonly 30x30, 45x45 or 60x60 cm and wall tiles 20x20, 25x40 or 30x60 cm.
+- In bathrooms, a standard bath is about 170 cm long and 70 cm wide, a shower tray is usually 70x70 to 80x120 cm, a toilet occupies about 40x70 cm, and a single washbasin unit is 50 to 80 cm wide.
+- Count the modules or tiles along each visible wall to estimate its length, estimate the depth of the room the same way, and multiply. Round to the nearest whole square meter.
+- Typical ranges in Spanish flats are 5 to 15 m² for kitchens (galley kitchens of 4 to 7 m² are common, open plan kitchens larger) and 3 to 8 m² for bathrooms (small toilets with a shower can be 2 to 3 m²). Values far outside these ranges need clear visual evidence.
+- In open plan kitchens, estimate only the kitchen zone (the area covered by cabinets, appliances and the space needed to work in front of them), not the whole living room.
+- If a photo shows only part of the room, estimate the whole room from what is visible and from the typical proportions of the room type; never report 0 when a photo of the room is present.
+
+Special cases:
+- If the photo labelled as a kitchen or bathroom actually shows another room, a floor plan, a facade or an empty image, treat that room as missing and use 0 for its rating and size.
+- If the photo is a render, a drawing or an advertising image rather than a real photo, rate it as shown but do not give more than 4.
+- If the room is empty because it is under construction or being renovated, rate the current visible state.
+- Each property is independent. Never copy ratings or sizes from one property to another, even when the photos look similar.
+- In contact sheets, each labelled tile belongs only to the property and room written on its label; tiles marked 'No photo' are missing images.
+
+Scoring examples (descriptions of real listing photos and the expected output for them):
+Example 1: Kitchen photo shows white handleless cabinets, a grey quartz worktop, an integrated oven and induction hob, a tall fridge column and recessed lights; about six base modules along one wall and a passage of roughly 1.5 m. Bathroom photo shows a walk-in shower with a glass screen, large grey tiles, a wall-hung toilet and a vanity unit of 80 cm; the room is about two baths long and one and a half baths wide.
+Expected: {"id": "1", "kitchen_rating": 5, "kitchen_size": 7, "bathroom_rating": 5, "bathroom_size": 4}
+Example 2: Kitchen photo shows dark wooden cabinets with worn edges, a laminate worktop with a burn mark, an old gas cooker and small brown wall tiles; an L-shaped layout of about eight modules in total. Bathroom photo shows a beige bath with a shower curtain, old beige tiles with dark grout and a pedestal basin; it is slightly longer than the bath and about 1.7 m wide.
+Expected: {"id": "2", "kitchen_rating": 2, "kitchen_size": 9, "bathroom_rating": 2, "bathroom_size": 4}
+Example 3: Kitchen photo shows cream cabinets in good order, a granite worktop, a mix of a newer fridge and an older oven, and intact but dated tiles; galley layout with four modules each side. There is no bathroom photo.
+Expected: {"id": "3", "kitchen_rating": 3, "kitchen_size": 6, "bathroom_rating": 0, "bathroom_size": 0}
+Example 4: There is no kitchen photo. The bathroom photo shows a new white shower tray of 80x120 cm with a screen, white sanitary ware and modern taps, with a worn silicone line along the tray; the room is about 1.5 m by 2 m.
+Expected: {"id": "4", "kitchen_rating": 0, "kitchen_size": 0, "bathroom_rating": 4, "bathroom_size": 3}
+Example 5: The photo labelled as the kitchen shows a living room with a sofa and no kitchen fittings. The bathroom photo shows a cracked pink washbasin, missing tiles around the bath and mould on the ceiling; the room is about 2 m by 2.5 m.
+Expected: {"id": "5", "kitchen_rating": 0, "kitchen_size": 0, "bathroom_rating": 1, "bathroom_size": 5}
+
+Common mistakes to avoid:
+- Giving the same rating to every property in a batch. Each room must be judged on its own photo.
+- Rating the furniture, the view or the decoration instead of the fixed fittings (cabinets, worktops, appliances, sanitary ware, tiles, floors).
+- Confusing a small room with a poor one. Size and condition are independent: a small new bathroom is a 5, a large old one can be a 2.
+- Overestimating sizes from wide-angle photos. Wide lenses make rooms look deeper than they are; rely on counted modules and tiles, not on the impression of space.
+- Reporting decimals, ranges or text. Every value must be a single whole number.
+- Adding explanations, comments or markdown code fences around the JSON array.
+
+Final check before answering:
+- One object per property ID given with the images, in the same order, and no other IDs.
+- Ratings are whole numbers from 1 to 5 when the room is shown, and 0 only when the room is missing.
+- Sizes are whole numbers in square meters, greater than 0 when the room is shown, and 0 only when the room is missing.
+- The answer is only the JSON array.
+"""
+
+
+def construir_contenido_lote(
+    imagenes_preparadas: List[Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]],
+    ids: Optional[List[str]] = None
+) -> List[dict]:
+    """
+    Construye el contenido del mensaje para evaluar un lote de propiedades: las imágenes disponibles
+    de cada propiedad, identificadas con su ID. Las instrucciones de evaluación se envían aparte, como
+    prompt de sistema (ver `parametros_peticion`).
+
+    Con `config_prompt["hoja_contacto"]`, las fotos de cada grupo de propiedades se envían compuestas
+    en una sola imagen (ver `componer_hoja_contacto`) en lugar de un bloque de imagen por foto.
+
+    Args:
+        imagenes_preparadas: Lista de tuplas (cocina_base64, cocina_mime, banio_base64, banio_mime).
+            Cualquier elemento puede ser None si la imagen no está disponible.
+        ids (Optional[List[str]]): ID de cada propiedad en el mensaje. Por defecto "1", "2", ...
+
+    Returns:
+        List[dict]: Bloques de contenido del mensaje. Lista vacía si no hay ninguna imagen.
+    """
+    ids = ids or [str(i + 1) for i in range(len(imagenes_preparadas))]
+    if config_prompt["hoja_contacto"]:
+        return _contenido_hojas_contacto(imagenes_preparadas, ids)
+    return _contenido_individual(imagenes_preparadas, ids)
+
+
+def _contenido_individual(imagenes_preparadas, ids: List[str]) -> List[dict]:
+    """
+    Contenido con un bloque de imagen por foto, cada uno seguido de su etiqueta de propiedad y habitación.
+    """
+    content = []
+    for idx, (cocina_base64, cocina_mime, banio_base64, banio_mime) in zip(ids, imagenes_preparadas):
+        # Agregar imágenes disponibles
+        if cocina_base64 and cocina_mime:
+            content.extend([
+                {
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": cocina_mime, "data": cocina_base64}
+                },
+                {
+                    "type": "text",
+                    "text": f"Property {idx} Kitchen: Analyze this kitchen image."
+                }
+            ])
         
-        if not isinstance(resultados, list) or not all(isinstance(t, tuple) and len(t) == 4 for t in resultados):
-            raise ValueError("Formato de respuesta inválido")
-            
-        return resultados
-    except Exception as e:
-        print(f"Error procesando lote: {e}")
+        if banio_base64 and banio_mime:
+            content.extend([
+                {
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": banio_mime, "data": banio_base64}
+                },
+                {
+                    "type": "text",
+                    "text": f"Property {idx} Bathroom: Analyze this bathroom image."
+                }
+            ])
+
+    return content
+
+
+def _fuente(tamanio: int):
+    """
+    Devuelve la fuente por defecto de PIL al tamaño indicado (o la fuente de mapa de bits en PIL < 10.1).
+    """
+    try:
+        return ImageFont.load_default(size=tamanio)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def componer_hoja_contacto(
+    imagenes_preparadas: List[Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]],
+    ids: List[str],
+    ancho_celda: int = 512,
+    alto_celda: int = 384
+) -> Image.Image:
+    """
+    Compone las fotos de varias propiedades en una sola imagen: una fila por propiedad, con la cocina a la
+    izquierda y el baño a la derecha. Cada celda lleva grabada una etiqueta con el ID de la propiedad y la
+    habitación, y las fotos que faltan se marcan como "No photo".
+
+    Args:
+        imagenes_preparadas: Lista de tuplas (cocina_base64, cocina_mime, banio_base64, banio_mime).
+        ids (List[str]): ID de cada propiedad.
+        ancho_celda (int): Ancho de cada celda en píxeles.
+        alto_celda (int): Alto de cada celda (sin la etiqueta) en píxeles.
+
+    Returns:
+        PIL.Image.Image: Hoja de contacto de 2 * ancho_celda de ancho.
+    """
+    alto_etiqueta = 32
+    alto_fila = alto_celda + alto_etiqueta
+    hoja = Image.new("RGB", (2 * ancho_celda, len(ids) * alto_fila), "white")
+    dibujo = ImageDraw.Draw(hoja)
+    fuente = _fuente(22)
+
+    for fila, (id_propiedad, (cocina_base64, _, banio_base64, _)) in enumerate(zip(ids, imagenes_preparadas)):
+        for columna, (datos, habitacion) in enumerate([(cocina_base64, "Kitchen"), (banio_base64, "Bathroom")]):
+            x, y = columna * ancho_celda, fila * alto_fila
+            dibujo.rectangle([x, y, x + ancho_celda - 1, y + alto_etiqueta - 1], fill="black")
+            dibujo.text((x + 8, y + 4), f"Property {id_propiedad} {habitacion}", fill="white", font=fuente)
+            if datos:
+                img = sc.decodificar(base64.b64decode(datos), max(ancho_celda, alto_celda))
+                img.thumbnail((ancho_celda, alto_celda), Image.LANCZOS)
+                hoja.paste(img, (x + (ancho_celda - img.width) // 2,
+                                 y + alto_etiqueta + (alto_celda - img.height) // 2))
+            else:
+                dibujo.text((x + ancho_celda // 2, y + alto_etiqueta + alto_celda // 2), "No photo",
+                            fill="gray", font=fuente, anchor="mm")
+        dibujo.line([(0, (fila + 1) * alto_fila - 1), (hoja.width, (fila + 1) * alto_fila - 1)], fill="black", width=2)
+    dibujo.line([(ancho_celda, 0), (ancho_celda, hoja.height)], fill="black", width=2)
+    return hoja
+
+
+def _contenido_hojas_contacto(imagenes_preparadas, ids: List[str]) -> List[dict]:
+    """
+    Contenido con una hoja de contacto por cada grupo de `config_prompt["propiedades_por_hoja"]` propiedades.
+    """
+    if not any(cocina or banio for cocina, _, banio, _ in imagenes_preparadas):
         return []
 
+    content = []
+    n = config_prompt["propiedades_por_hoja"]
+    for i in range(0, len(imagenes_preparadas), n):
+        hoja = componer_hoja_contacto(imagenes_preparadas[i:i + n], ids[i:i + n], *config_prompt["celda"])
+        salida = BytesIO()
+        hoja.save(salida, format="JPEG", quality=config_imagenes["calidad"], optimize=True)
+        content.extend([
+            {
+                "type": "image",
+                "source": {"type": "base64", "media_type": "image/jpeg",
+                           "data": base64.b64encode(salida.getvalue()).decode("utf-8")}
+            },
+            {
+                "type": "text",
+                "text": f"Contact sheet with properties {', '.join(ids[i:i + n])}: each row is one property, "
+                        "with its kitchen photo on the left and its bathroom photo on the right, labeled with the "
+                        "property ID. Tiles marked 'No photo' are missing images."
+            }
+        ])
+    return content
+
+
+# Si es True, las instrucciones de evaluación se marcan como prefijo cacheable (prompt caching), de modo que
+# las peticiones siguientes leen su procesamiento de la caché de la API en lugar de repetirlo. La API sólo
+# cachea prefijos que alcanzan el mínimo de tokens del modelo (ver `MIN_TOKENS_CACHE`); por debajo no se marcan.
+# Con hoja_contacto, las fotos de cada `propiedades_por_hoja` propiedades se envían en una sola imagen
+# compuesta, con celdas de `celda` (ancho, alto) píxeles.
+config_prompt = {"cache": True, "hoja_contacto": False, "propiedades_por_hoja": 3, "celda": (512, 384)}
+
+# Uso de tokens de cada petición: tokens de entrada, de salida, leídos de la caché y escritos en ella
+registro_uso = []
+
+
+def configurar_prompt(cache: bool = True, hoja_contacto: bool = False, propiedades_por_hoja: int = 3,
+                      celda: Tuple[int, int] = (512, 384)) -> None:
+    """
+    Ajusta cómo se construyen las peticiones de evaluación.
+
+    Args:
+        cache (bool): Si es True, las instrucciones se envían como prefijo cacheable.
+        hoja_contacto (bool): Si es True, las fotos se envían compuestas en hojas de contacto.
+        propiedades_por_hoja (int): Propiedades (filas) de cada hoja de contacto.
+        celda (Tuple[int, int]): Ancho y alto en píxeles de cada foto en la hoja de contacto.
+    """
+    config_prompt.update(cache=cache, hoja_contacto=hoja_contacto, propiedades_por_hoja=propiedades_por_hoja,
+                         celda=tuple(celda))
+
+
+# Tokens mínimos del prefijo para que la API lo cachee, por familia de modelo
+MIN_TOKENS_CACHE = {"haiku": 2048, "sonnet": 1024, "opus": 1024}
+
+
+def minimo_tokens_cache(modelo: str = MODELO_SCORING) -> int:
+    """
+    Devuelve los tokens mínimos que debe tener un prefijo para que la API lo cachee con el modelo indicado.
+    """
+    return next((minimo for familia, minimo in MIN_TOKENS_CACHE.items() if familia in modelo), 1024)
+
+
+def texto_sistema() -> str:
+    """
+    Devuelve el texto del prompt de sistema: las instrucciones de evaluación seguidas de la guía.
+    """
+    return f"{INSTRUCCIONES_EVALUACION}\n{GUIA_EVALUACION}"
+
+
+def tokens_prefijo(cliente=None) -> int:
+    """
+    Devuelve los tokens del prompt de sistema (el prefijo cacheable). Con un cliente se cuentan
+    con el endpoint de recuento de tokens de la API; sin él (o si falla) se estiman a razón de 4 caracteres
+    por token.
+
+    Args:
+        cliente (Anthropic, opcional): Cliente de la API.
+
+    Returns:
+        int: Tokens del prefijo.
+    """
+    if cliente is not None:
+        try:
+            return cliente.messages.count_tokens(
+                model=MODELO_SCORING, system=[{"type": "text", "text": texto_sistema()}],
+                messages=[{"role": "user", "content": "-"}]
+            ).input_tokens
+        except Exception as e:
+            print(f"No se han podido contar los tokens del prefijo, se estiman: {e}")
+    return len(texto_sistema()) // 4
+
+
+def prompt_sistema() -> List[dict]:
+    """
+    Devuelve el prompt de sistema con las instrucciones y la guía de evaluación, que es igual en todas las
+    peticiones y por tanto se puede cachear. El punto de caché sólo se añade si el prefijo alcanza el mínimo de
+    tokens del modelo: con menos, la API no lo cachea y marcarlo no tendría ningún efecto.
+
+    Returns:
+        List[dict]: Bloques del prompt de sistema.
+    """
+    bloque = {"type": "text", "text": texto_sistema()}
+    if config_prompt["cache"] and tokens_prefijo() >= minimo_tokens_cache():
+        bloque["cache_control"] = {"type": "ephemeral"}
+    return [bloque]
+
+
+def parametros_peticion(content: List[dict], max_tokens: int = MAX_TOKENS_SCORING) -> dict:
+    """
+    Devuelve los parámetros de una petición de evaluación: el modelo, el límite de tokens de salida,
+    las instrucciones como prompt de sistema (el prefijo fijo) y las imágenes del lote como mensaje.
+
+    Args:
+        content (List[dict]): Contenido del mensaje, de `construir_contenido_lote`.
+        max_tokens (int): Límite de tokens de salida.
+
+    Returns:
+        dict: Parámetros para `messages.create`.
+    """
+    return {
+        "model": MODELO_SCORING,
+        "max_tokens": max_tokens,
+        "system": prompt_sistema(),
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def registrar_uso(mensaje, n_propiedades: int, segundos: Optional[float] = None) -> None:
+    """
+    Guarda en `registro_uso` los tokens de una respuesta, incluidos los leídos de la caché de prompts
+    y los escritos en ella.
+
+    Args:
+        mensaje (anthropic.types.Message): Respuesta del modelo.
+        n_propiedades (int): Propiedades evaluadas en la petición.
+        segundos (Optional[float]): Latencia de la petición.
+    """
+    uso = mensaje.usage
+    registro_uso.append({
+        "propiedades": n_propiedades,
+        "segundos": segundos,
+        "tokens_entrada": uso.input_tokens,
+        "tokens_salida": uso.output_tokens,
+        "tokens_cache_lectura": getattr(uso, "cache_read_input_tokens", None) or 0,
+        "tokens_cache_escritura": getattr(uso, "cache_creation_input_tokens", None) or 0,
+    })
+
+
+def resumen_uso(registro: Optional[List[dict]] = None) -> dict:
+    """
+    Resume el uso de tokens de las peticiones registradas.
+
+    Args:
+        registro (Optional[List[dict]]): Registros a resumir. Por defecto, `registro_uso`.
+
+    Returns:
+        dict: Peticiones, tokens totales de cada tipo, proporción de tokens de entrada servidos desde la caché
+            y coste de entrada en tokens equivalentes (la escritura en caché cuesta 1,25 veces un token normal
+            y la lectura 0,1 veces).
+    """
+    df_uso = pd.DataFrame(registro_uso if registro is None else registro)
+    if df_uso.empty:
+        return {"peticiones": 0}
+    totales = df_uso[["propiedades", "tokens_entrada", "tokens_salida",
+                      "tokens_cache_lectura", "tokens_cache_escritura"]].sum()
+    entrada = totales["tokens_entrada"] + totales["tokens_cache_lectura"] + totales["tokens_cache_escritura"]
+    return {
+        "peticiones": len(df_uso),
+        **{clave: int(valor) for clave, valor in totales.items()},
+        "proporcion_cache": totales["tokens_cache_lectura"] / entrada if entrada else 0.0,
+        "coste_entrada_equivalente": float(totales["tokens_entrada"] + 1.25 * totales["tokens_cache_escritura"]
+                                           + 0.1 * totales["tokens_cache_lectura"]),
+        "segundos_por_peticion": df_uso["segundos"].mean(),
+    }
+
+
+def interpretar_respuesta(respuesta_texto: str) -> Dict[str, Tuple[int, int, int, int]]:
+    """
+    Convierte el texto de la respuesta del modelo (un array JSON con un objeto por propiedad)
+    en las evaluaciones de cada propiedad, por su ID. Las entradas incompletas o con valores
+    fuera de rango se descartan, de modo que esas propiedades se tratan como no evaluadas.
+
+    Args:
+        respuesta_texto (str): Texto devuelto por el modelo.
+
+    Returns:
+        Dict[str, Tuple[int, int, int, int]]: (kitchen_rating, kitchen_size, bathroom_rating, bathroom_size) por ID.
+
+    Raises:
+        ValueError: Si la respuesta no contiene un array JSON.
+    """
+    inicio, fin = respuesta_texto.find("["), respuesta_texto.rfind("]")
+    if inicio == -1 or fin < inicio:
+        raise ValueError("Formato de respuesta inválido")
+    try:
+        entradas = json.loads(respuesta_texto[inicio:fin + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Formato de respuesta inválido: {e}")
+
+    resultados = {}
+    for entrada in entradas:
+        # Una entrada mal formada (sin ID, sin alguna clave o con valores no numéricos) sólo descarta esa propiedad
+        try:
+            id_propiedad = str(entrada["id"])
+            evaluacion = tuple(int(entrada[clave]) for clave in
+                               ("kitchen_rating", "kitchen_size", "bathroom_rating", "bathroom_size"))
+        except (TypeError, KeyError, ValueError):
+            continue
+        if 0 <= evaluacion[0] <= 5 and 0 <= evaluacion[2] <= 5 and evaluacion[1] >= 0 and evaluacion[3] >= 0:
+            resultados[id_propiedad] = evaluacion
+    return resultados
+
 
-def analizar_propiedades(df: pd.DataFrame, batch: int = 3) -> Tuple[pd.DataFrame, List[Tuple[int, int, int, int]]]:
+def tokens_salida(n_propiedades: int) -> int:
+    """
+    Devuelve el límite de tokens de salida para una petición con `n_propiedades` propiedades.
+    """
+    return min(MAX_TOKENS_SALIDA_MODELO, max(MAX_TOKENS_SCORING, TOKENS_POR_PROPIEDAD * n_propiedades))
+
+
+def version_prompt() -> str:
+    """
+    Devuelve la versión del prompt de evaluación: un hash del contenido que se envía para una propiedad
+    con foto de cocina y de baño, sin las imágenes, y del preprocesado de las fotos. Cambia si cambian las
+    instrucciones, los textos que acompañan a cada imagen, el tamaño y calidad con que se envían las fotos
+    o el modo de hojas de contacto,
+    de modo que las evaluaciones guardadas con otro prompt dejan de servirse.
+
+    Returns:
+        str: Hash hexadecimal (16 caracteres).
+    """
+    contenido = _contenido_individual([("-", "image/jpeg", "-", "image/jpeg")], ["1"])
+    hojas = {clave: config_prompt[clave] for clave in ("hoja_contacto", "propiedades_por_hoja", "celda")}
+    prompt = [texto_sistema(), contenido, config_imagenes, hojas]
+    return hashlib.sha256(json.dumps(prompt, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _hashes_propiedad(url_cocina, url_banio) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """
+    Devuelve el hash del contenido de las fotos de cocina y baño de una propiedad (None si no tiene la foto),
+    o None si alguna de las fotos no se puede descargar.
+    """
+    try:
+        return tuple(sc.hash_contenido(url) if isinstance(url, str) else None for url in (url_cocina, url_banio))
+    except Exception:
+        return None
+
+
+def consultar_cache_puntuaciones(df: pd.DataFrame, indices, hilos: int = 8) -> Tuple[dict, dict]:
+    """
+    Busca en el almacén de evaluaciones las propiedades indicadas, por el contenido de sus fotos,
+    el modelo y la versión del prompt actuales.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        indices: Índices de las filas a buscar.
+        hilos (int): Hilos para obtener las fotos (de la caché de imágenes o descargándolas).
+
+    Returns:
+        Tuple[dict, dict]: Evaluaciones encontradas por índice, y hashes de las fotos por índice
+            (para guardar después las evaluaciones que falten).
+    """
+    with ThreadPoolExecutor(max_workers=hilos) as executor:
+        hashes = list(executor.map(_hashes_propiedad, df.loc[indices, 'url_cocina'], df.loc[indices, 'url_banio']))
+
+    version = version_prompt()
+    en_cache, hashes_por_indice = {}, {}
+    for idx, hashes_fotos in zip(indices, hashes):
+        if hashes_fotos is None:
+            continue
+        hashes_por_indice[idx] = hashes_fotos
+        evaluacion = sp.consultar(*hashes_fotos, MODELO_SCORING, version)
+        if evaluacion is not None:
+            en_cache[idx] = evaluacion
+    return en_cache, hashes_por_indice
+
+
+def guardar_cache_puntuaciones(evaluaciones: dict, hashes: dict) -> None:
+    """
+    Guarda en el almacén las evaluaciones obtenidas de la API. Sólo deben pasarse evaluaciones interpretadas
+    de una respuesta del modelo: cualquier otro valor (como los ceros de una foto que no se ha podido
+    preparar) se serviría después como si fuera la evaluación de esas fotos.
+
+    Args:
+        evaluaciones (dict): Evaluación de cada índice.
+        hashes (dict): Hashes de las fotos de cada índice, devueltos por `consultar_cache_puntuaciones`.
+    """
+    version = version_prompt()
+    for idx, evaluacion in evaluaciones.items():
+        if idx in hashes:
+            sp.guardar(*hashes[idx], MODELO_SCORING, version, evaluacion)
+
+
+# Contadores de las peticiones síncronas: peticiones enviadas, lotes divididos tras una respuesta
+# incompleta o errónea, y propiedades que no se han podido evaluar ni individualmente
+estadisticas_lotes = {"peticiones": 0, "divisiones": 0, "propiedades_fallidas": 0}
+
+
+def analizar_lote_propiedades(
+    cliente,
+    imagenes_preparadas: List[Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]],
+    batch: int = 3
+) -> List[Optional[Tuple[int, int, int, int]]]:
+    """
+    Analiza un lote de propiedades utilizando la API de Anthropic para evaluar cocinas y/o baños.
+    Procesa imágenes individuales si solo una está disponible. Si la petición falla o la respuesta no
+    incluye una evaluación válida para alguna propiedad, las propiedades sin evaluar se dividen en dos
+    mitades que se vuelven a enviar, hasta llegar a propiedades individuales.
+
+    Args:
+        cliente: Cliente de la API de Anthropic.
+        imagenes_preparadas: Lista de tuplas (cocina_base64, cocina_mime, banio_base64, banio_mime).
+            Cualquier elemento puede ser None si la imagen no está disponible.
+        batch (int): Tamaño del lote a procesar.
+
+    Returns:
+        List[Optional[Tuple[int, int, int, int]]]: Evaluación de cada propiedad, en el mismo orden que
+        `imagenes_preparadas` (None si no se ha podido evaluar). Para imágenes faltantes, los valores
+        correspondientes serán 0.
+    """
+    evaluaciones = [None] * len(imagenes_preparadas)
+    pendientes = [list(range(len(imagenes_preparadas)))]
+    while pendientes:
+        posiciones = pendientes.pop()
+        ids = [str(i + 1) for i in range(len(posiciones))]
+        try:
+            content = construir_contenido_lote([imagenes_preparadas[p] for p in posiciones], ids)
+            if not content:
+                continue
+            estadisticas_lotes["peticiones"] += 1
+            inicio = time.perf_counter()
+            mensaje = cliente.messages.create(**parametros_peticion(content, tokens_salida(len(posiciones))))
+            registrar_uso(mensaje, len(posiciones), time.perf_counter() - inicio)
+            resultados = interpretar_respuesta(mensaje.content[0].text)
+        except Exception as e:
+            print(f"Error procesando lote: {e}")
+            resultados = {}
+
+        for id_propiedad, p in zip(ids, posiciones):
+            evaluaciones[p] = resultados.get(id_propiedad)
+        sin_evaluar = [p for p in posiciones if evaluaciones[p] is None]
+        if sin_evaluar and len(posiciones) > 1:
+            estadisticas_lotes["divisiones"] += 1
+            mitad = len(sin_evaluar) // 2
+            pendientes.extend([mitades for mitades in (sin_evaluar[mitad:], sin_evaluar[:mitad]) if mitades])
+        else:
+            estadisticas_lotes["propiedades_fallidas"] += len(sin_evaluar)
+    return evaluaciones
+
+
+class TamanioLoteAdaptativo:
+    """
+    Ajusta el número de propiedades por petición: lo aumenta un 50 % tras cada lote completo respondido
+    correctamente sin dividirse, hasta `maximo`, y lo reduce a la mitad cuando un lote tiene que dividirse.
+    """
+
+    def __init__(self, inicial: int = 3, maximo: int = MAX_PROPIEDADES_LOTE):
+        self.maximo = max(1, min(maximo, MAX_PROPIEDADES_LOTE))
+        self.actual = max(1, min(inicial, self.maximo))
+        self.historial = []
+
+    def registrar(self, n_propiedades: int, correcto: bool) -> None:
+        """
+        Registra el resultado de un lote y actualiza el tamaño del siguiente.
+        """
+        self.historial.append((n_propiedades, correcto))
+        if not correcto:
+            self.actual = max(1, n_propiedades // 2)
+        elif n_propiedades >= self.actual:
+            self.actual = min(self.maximo, self.actual + max(1, self.actual // 2))
+
+
+def agrupar_propiedades_duplicadas(df: pd.DataFrame, indices: pd.Index, distancia_maxima: int = 4) -> pd.Series:
+    """
+    Agrupa las propiedades cuyas fotos de cocina y baño son casi idénticas a las de otra propiedad
+    (misma foto publicada con otra URL), usando el hash perceptual de cada imagen.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        indices (pd.Index): Índices de las filas a agrupar.
+        distancia_maxima (int): Distancia de Hamming máxima para considerar dos fotos duplicadas.
+
+    Returns:
+        pd.Series: Para cada índice, el índice de la primera propiedad de su grupo (él mismo si no es duplicada).
+    """
+    urls_cocinas = [url if isinstance(url, str) else None for url in df.loc[indices, 'url_cocina']]
+    urls_banios = [url if isinstance(url, str) else None for url in df.loc[indices, 'url_banio']]
+    representantes = sc.agrupar_duplicados(
+        [url for url in urls_cocinas + urls_banios if url is not None], distancia_maxima
+    )
+
+    claves = [(representantes.get(c), representantes.get(b)) for c, b in zip(urls_cocinas, urls_banios)]
+    primero_por_clave = {}
+    grupos = []
+    for idx, clave in zip(indices, claves):
+        grupos.append(primero_por_clave.setdefault(clave, idx))
+    return pd.Series(grupos, index=indices)
+
+
+def analizar_propiedades(df: pd.DataFrame, batch: int = 3, deduplicar: bool = False, distancia_maxima: int = 4,
+                         usar_cache: bool = True,
+                         batch_maximo: Optional[int] = None) -> Tuple[pd.DataFrame, List[Tuple[int, int, int, int]]]:
     """
     Analiza las propiedades de un DataFrame en lotes, evaluando imágenes de cocina y/o baño.
     Procesa propiedades incluso si solo tienen una de las dos imágenes disponibles.
@@ -197,6 +787,14 @@ def analizar_propiedades(df: pd.DataFrame, batch: int = 3) -> Tuple[pd.DataFrame
     Args:
         df (pd.DataFrame): DataFrame que debe contener las columnas "url_cocina" y "url_banio".
         batch (int, opcional): Tamaño del lote a procesar. Por defecto es 3.
+        deduplicar (bool, opcional): Si es True, las propiedades cuyas fotos de cocina y baño son casi idénticas
+            a las de otra (por hash perceptual) no se envían a la API y reciben las puntuaciones de esa otra.
+        distancia_maxima (int, opcional): Distancia de Hamming máxima para considerar dos fotos duplicadas.
+        usar_cache (bool, opcional): Si es True, las propiedades cuyas fotos ya se evaluaron con el mismo modelo
+            y prompt reciben la evaluación guardada sin llamar a la API, y las nuevas evaluaciones se guardan.
+        batch_maximo (int, opcional): Si se indica, el lote empieza en `batch` y crece mientras las respuestas
+            sean correctas, hasta este tamaño (acotado por los límites de imágenes y tokens del modelo).
+            Los lotes con respuestas erróneas se dividen y se reintentan en cualquier caso.
 
     Returns:
         Tuple[pd.DataFrame, List[Tuple[int, int, int, int]]]:
@@ -208,6 +806,7 @@ def analizar_propiedades(df: pd.DataFrame, batch: int = 3) -> Tuple[pd.DataFrame
         - Lista de tuplas con los resultados.
     """
     cliente = Anthropic(api_key=anthropic_key)
+    estadisticas_lotes.update(peticiones=0, divisiones=0, propiedades_fallidas=0)
 
     # Inicializar columnas si no existen
     for col in ['puntuacion_cocina', 'puntuacion_banio', 'mts_cocina', 'mts_banio']:
@@ -222,32 +821,789 @@ def analizar_propiedades(df: pd.DataFrame, batch: int = 3) -> Tuple[pd.DataFrame
     indices_validos = df[df['url_cocina'].notna() | df['url_banio'].notna()].index
     resultados_totales = []
 
-    # Procesar en lotes
-    for i in tqdm(range(0, len(indices_validos), batch), desc="Procesando lotes"):
-        indices_lote = indices_validos[i:i + batch]
-        urls_cocinas = df.loc[indices_lote, 'url_cocina'].tolist()
-        urls_banios = df.loc[indices_lote, 'url_banio'].tolist()
+    # Puntuar una sola propiedad por grupo de fotos duplicadas
+    if deduplicar:
+        grupos = agrupar_propiedades_duplicadas(df, indices_validos, distancia_maxima)
+        duplicadas = grupos[grupos.index != grupos.values]
+        indices_validos = grupos.index[grupos.index == grupos.values]
+        print(f"Propiedades con fotos duplicadas de otra propiedad: {len(duplicadas)} de {len(grupos)} "
+              f"({len(duplicadas) / max(len(grupos), 1):.1%}).")
 
-        # Preparar imágenes disponibles
-        imagenes_preparadas = preparar_imagenes_lote(urls_cocinas, urls_banios, allow_partial=True)
-        
-        if not imagenes_preparadas:
-            # Si la preparación falla, asignar ceros a este lote
-            for idx in indices_lote:
+    # Servir desde el almacén las propiedades ya evaluadas con las mismas fotos, modelo y prompt
+    if usar_cache:
+        en_cache, hashes = consultar_cache_puntuaciones(df, indices_validos)
+        if en_cache:
+            df.loc[list(en_cache), ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']] = \
+                pd.DataFrame(list(en_cache.values())).values
+            resultados_totales.extend(en_cache.values())
+        indices_validos = indices_validos[~indices_validos.isin(list(en_cache))]
+        print(f"Propiedades servidas desde el almacén de evaluaciones: {len(en_cache)} de "
+              f"{len(en_cache) + len(indices_validos)}.")
+
+    # Procesar en lotes; con batch_maximo el tamaño del lote se adapta a las respuestas
+    tamanio_lote = TamanioLoteAdaptativo(batch, batch_maximo or batch)
+    barra = tqdm(total=len(indices_validos), desc="Procesando propiedades")
+    posicion = 0
+    while posicion < len(indices_validos):
+        indices_lote = indices_validos[posicion:posicion + tamanio_lote.actual]
+        posicion += len(indices_lote)
+
+        # Preparar imágenes disponibles; si la preparación falla, asignar ceros a esas propiedades
+        indices, imagenes_preparadas = _preparar_lote_indexado(df, indices_lote)
+        for idx in indices_lote:
+            if idx not in indices:
                 df.loc[idx, ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']] = [0, 0, 0, 0]
                 resultados_totales.append((0, 0, 0, 0))
+
+        if imagenes_preparadas:
+            # Analizar el lote
+            divisiones = estadisticas_lotes["divisiones"]
+            resultados = analizar_lote_propiedades(cliente, imagenes_preparadas, len(imagenes_preparadas))
+            tamanio_lote.registrar(len(imagenes_preparadas), estadisticas_lotes["divisiones"] == divisiones)
+            evaluadas = {idx: resultado for idx, resultado in zip(indices, resultados) if resultado is not None}
+            resultados_totales.extend(evaluadas.values())
+
+            # Actualizar resultados en el DataFrame
+            for idx, (cocina_p, cocina_m, banio_p, banio_m) in evaluadas.items():
+                df.loc[idx, ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']] = [
+                    cocina_p, cocina_m, banio_p, banio_m
+                ]
+            if usar_cache:
+                guardar_cache_puntuaciones(evaluadas, hashes)
+            time.sleep(1)  # Evitar saturar la API
+
+        barra.update(len(indices_lote))
+    barra.close()
+
+    if batch_maximo:
+        print(f"Propiedades por petición: media {np.mean([n for n, _ in tamanio_lote.historial] or [0]):.1f}, "
+              f"final {tamanio_lote.actual}. Lotes divididos: {estadisticas_lotes['divisiones']}.")
+    if estadisticas_lotes["propiedades_fallidas"]:
+        print(f"Propiedades sin puntuar por errores en la API: {estadisticas_lotes['propiedades_fallidas']}.")
+
+    # Repartir las puntuaciones a las propiedades duplicadas
+    if deduplicar and len(duplicadas):
+        columnas = ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']
+        df.loc[duplicadas.index, columnas] = df.loc[duplicadas.values, columnas].values
+
+    return df, resultados_totales
+
+
+class PlanificadorLimites:
+    """
+    Pausa el envío de peticiones a la API según los límites de uso. Tras cada respuesta lee las cabeceras
+    `anthropic-ratelimit-*` y, si queda poca cuota de peticiones o de tokens, retrasa las siguientes peticiones
+    hasta la hora de renovación indicada. Ante un error 429 respeta la cabecera `retry-after`.
+    """
+
+    def __init__(self, margen_peticiones: int = 1, margen_tokens: int = 5000):
+        self.margen_peticiones = margen_peticiones
+        self.margen_tokens = margen_tokens
+        self.reanudar_en = 0.0
+        self.pausas = 0
+        self.errores_429 = 0
+
+    @staticmethod
+    def _segundos_hasta(fecha: str) -> float:
+        try:
+            reinicio = datetime.fromisoformat(fecha.replace("Z", "+00:00"))
+            return max(0.0, (reinicio - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            return 1.0
+
+    def pausar(self, segundos: float) -> None:
+        """
+        Impide enviar nuevas peticiones durante los segundos indicados.
+        """
+        if segundos > 0:
+            self.pausas += 1
+            self.reanudar_en = max(self.reanudar_en, time.monotonic() + segundos)
+
+    async def esperar_turno(self) -> None:
+        """
+        Espera hasta que se pueda enviar una nueva petición.
+        """
+        while (espera := self.reanudar_en - time.monotonic()) > 0:
+            await asyncio.sleep(espera)
+
+    def actualizar(self, cabeceras) -> None:
+        """
+        Actualiza la pausa a partir de las cabeceras de límites de uso de una respuesta.
+        """
+        for recurso, margen in [("requests", self.margen_peticiones), ("tokens", self.margen_tokens),
+                                ("input-tokens", self.margen_tokens), ("output-tokens", self.margen_tokens)]:
+            restante = cabeceras.get(f"anthropic-ratelimit-{recurso}-remaining")
+            reinicio = cabeceras.get(f"anthropic-ratelimit-{recurso}-reset")
+            if restante is not None and reinicio and int(restante) <= margen:
+                self.pausar(self._segundos_hasta(reinicio))
+
+
+async def llamar_con_reintentos(cliente, content: List[dict], planificador: PlanificadorLimites,
+                                reintentos: int = 5, espera_base: float = 1.0, max_tokens: int = MAX_TOKENS_SCORING):
+    """
+    Envía una petición con el cliente asíncrono respetando los límites de uso y reintentando con espera
+    exponencial (con variación aleatoria) ante límites de uso, errores de conexión o errores del servidor.
+
+    Args:
+        cliente (AsyncAnthropic): Cliente asíncrono de la API.
+        content (List[dict]): Contenido del mensaje.
+        planificador (PlanificadorLimites): Planificador compartido por todas las peticiones.
+        reintentos (int): Número máximo de reintentos.
+        espera_base (float): Segundos de espera del primer reintento; se duplica en cada uno.
+        max_tokens (int): Límite de tokens de salida.
+
+    Returns:
+        anthropic.types.Message: Respuesta del modelo.
+    """
+    for intento in range(reintentos + 1):
+        await planificador.esperar_turno()
+        try:
+            respuesta = await cliente.messages.with_raw_response.create(**parametros_peticion(content, max_tokens))
+            planificador.actualizar(respuesta.headers)
+            return await respuesta.parse()
+        except RateLimitError as e:
+            # La pausa se registra también en el último intento, para que el lote reencolado la respete
+            planificador.errores_429 += 1
+            retry_after = e.response.headers.get("retry-after")
+            planificador.pausar(float(retry_after) if retry_after else espera_base * 2 ** intento)
+            if intento == reintentos:
+                raise
+        except (APIConnectionError, APIStatusError) as e:
+            if intento == reintentos or (isinstance(e, APIStatusError) and e.status_code < 500):
+                raise
+            await asyncio.sleep(espera_base * 2 ** intento * (1 + random.random() / 4))
+
+
+def _preparar_lote_indexado(df: pd.DataFrame, indices_lote) -> Tuple[list, list]:
+    """
+    Prepara las imágenes de un lote conservando el índice de cada propiedad preparada.
+    """
+    indices, imagenes = [], []
+    for idx in indices_lote:
+        preparadas = preparar_imagenes_lote([df.at[idx, 'url_cocina']], [df.at[idx, 'url_banio']], allow_partial=True)
+        if preparadas:
+            indices.append(idx)
+            imagenes.append(preparadas[0])
+    return indices, imagenes
+
+
+async def _analizar_propiedades_async(df: pd.DataFrame, indices_validos, batch: int, max_concurrencia: int,
+                                      reintentos: int,
+                                      base_url: Optional[str] = None) -> Tuple[dict, dict]:
+    """
+    Evalúa los lotes con `max_concurrencia` tareas que toman lotes de una cola compartida hasta que todos
+    están resueltos. Cada tarea prepara las imágenes de un lote y envía su petición:
+    - Si la respuesta no se puede interpretar, le faltan propiedades o la API rechaza la petición por
+      inválida (400) o demasiado grande (413), las propiedades sin evaluar se dividen en dos mitades que
+      vuelven a la cola.
+    - Si la petición agota los reintentos por límites de uso, errores de conexión o del servidor (5xx,
+      incluida la sobrecarga 529), el mismo lote vuelve a la cola (hasta `reintentos` veces) y se envía
+      cuando lo permite el planificador: dividirlo sólo multiplicaría las peticiones mientras la API está
+      limitando.
+    - Con cualquier otro error de la API (autenticación, permisos...) el lote se da por perdido y se avisa.
+    Devuelve las evaluaciones del modelo por índice de fila y, aparte, los ceros asignados a las propiedades
+    cuyas imágenes no se han podido preparar (que no deben guardarse en el almacén de evaluaciones).
+    """
+    cliente = AsyncAnthropic(api_key=anthropic_key, base_url=base_url, max_retries=0)
+    planificador = PlanificadorLimites()
+    cola = asyncio.Queue()
+    for i in range(0, len(indices_validos), batch):
+        cola.put_nowait((indices_validos[i:i + batch], 0))
+
+    resultados, ceros = {}, {}
+    contadores = {"reencolados": 0, "divisiones": 0}
+    barra = tqdm(total=len(indices_validos), desc="Procesando propiedades")
+
+    def reencolar(indices_lote, reencolados, error):
+        if reencolados < reintentos:
+            contadores["reencolados"] += 1
+            cola.put_nowait((indices_lote, reencolados + 1))
+            return
+        print(f"Error procesando lote tras {reencolados} reencolados: {error}")
+        barra.update(len(indices_lote))
+
+    async def procesar(indices_lote, reencolados):
+        indices, imagenes = await asyncio.to_thread(_preparar_lote_indexado, df, indices_lote)
+        # Si la preparación falla, asignar ceros a las propiedades sin imágenes
+        for idx in indices_lote:
+            if idx not in indices:
+                ceros[idx] = (0, 0, 0, 0)
+        if not imagenes:
+            barra.update(len(indices_lote))
+            return
+
+        ids = [str(i + 1) for i in range(len(imagenes))]
+        try:
+            inicio = time.perf_counter()
+            mensaje = await llamar_con_reintentos(
+                cliente, construir_contenido_lote(imagenes, ids), planificador, reintentos,
+                max_tokens=tokens_salida(len(imagenes))
+            )
+            registrar_uso(mensaje, len(imagenes), time.perf_counter() - inicio)
+            evaluaciones = interpretar_respuesta(mensaje.content[0].text)
+        except (RateLimitError, APIConnectionError) as e:
+            return reencolar(indices_lote, reencolados, e)
+        except APIStatusError as e:
+            if e.status_code >= 500:
+                return reencolar(indices_lote, reencolados, e)
+            if e.status_code not in (400, 413):
+                print(f"Error de la API, se descarta el lote: {e}")
+                barra.update(len(indices_lote))
+                return
+            print(f"Petición rechazada ({e.status_code}), se divide el lote: {e}")
+            evaluaciones = {}
+        except ValueError as e:
+            print(f"Respuesta inválida, se divide el lote: {e}")
+            evaluaciones = {}
+
+        resultados.update({idx: evaluaciones[i] for idx, i in zip(indices, ids) if i in evaluaciones})
+        sin_evaluar = [idx for idx in indices if idx not in resultados]
+        if sin_evaluar and len(indices) > 1:
+            contadores["divisiones"] += 1
+            mitad = len(sin_evaluar) // 2
+            for mitades in (sin_evaluar[:mitad], sin_evaluar[mitad:]):
+                if mitades:
+                    cola.put_nowait((mitades, reencolados))
+            barra.update(len(indices_lote) - len(sin_evaluar))
+        else:
+            barra.update(len(indices_lote))
+
+    async def trabajador():
+        # Cada tarea espera en la cola (en lugar de terminar al verla vacía) hasta recibir la señal de fin,
+        # porque otras tareas pueden volver a encolar lotes en cualquier momento
+        while True:
+            elemento = await cola.get()
+            try:
+                if elemento is None:
+                    return
+                await procesar(*elemento)
+            except Exception as e:
+                print(f"Error procesando lote: {e}")
+                barra.update(len(elemento[0]))
+            finally:
+                cola.task_done()
+
+    trabajadores = [asyncio.create_task(trabajador()) for _ in range(max_concurrencia)]
+    try:
+        await cola.join()
+    finally:
+        for _ in trabajadores:
+            cola.put_nowait(None)
+        await asyncio.gather(*trabajadores, return_exceptions=True)
+        barra.close()
+        await cliente.close()
+    if planificador.pausas:
+        print(f"Pausas por límites de uso: {planificador.pausas} (errores 429: {planificador.errores_429}, "
+              f"lotes reencolados: {contadores['reencolados']}).")
+    if contadores["divisiones"]:
+        print(f"Lotes divididos por respuestas inválidas o incompletas: {contadores['divisiones']}.")
+    return resultados, ceros
+
+
+def _ejecutar_corrutina(corrutina):
+    """
+    Ejecuta una corrutina hasta completarla, también desde un notebook de Jupyter (que ya tiene un bucle
+    de eventos en marcha), en cuyo caso se ejecuta en un hilo aparte.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(corrutina)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, corrutina).result()
+
+
+def analizar_propiedades_concurrente(df: pd.DataFrame, batch: int = 3, max_concurrencia: int = 8, reintentos: int = 5,
+                                     usar_cache: bool = True,
+                                     base_url: Optional[str] = None) -> Tuple[pd.DataFrame, List[Tuple[int, int, int, int]]]:
+    """
+    Versión concurrente de `analizar_propiedades`: mantiene varias peticiones en vuelo con el cliente asíncrono,
+    ajusta el ritmo de envío según las cabeceras de límites de uso, reintenta con espera exponencial y asigna
+    todos los resultados al DataFrame de una sola vez al final.
+
+    Args:
+        df (pd.DataFrame): DataFrame que debe contener las columnas "url_cocina" y "url_banio".
+        batch (int, opcional): Tamaño del lote a procesar. Por defecto es 3.
+        max_concurrencia (int, opcional): Número máximo de peticiones en vuelo. Por defecto es 8.
+        reintentos (int, opcional): Reintentos por petición ante límites de uso o errores transitorios, y veces
+            que un lote que los agota vuelve a la cola.
+        usar_cache (bool, opcional): Si es True, sirve desde el almacén las propiedades ya evaluadas con las
+            mismas fotos, modelo y prompt, y guarda las nuevas evaluaciones.
+        base_url (str, opcional): URL base de la API (por ejemplo, un servidor local de pruebas).
+
+    Returns:
+        Tuple[pd.DataFrame, List[Tuple[int, int, int, int]]]:
+        - DataFrame actualizado con las columnas "puntuacion_cocina", "mts_cocina", "puntuacion_banio" y "mts_banio".
+          Las filas de lotes que fallan tras todos los reintentos quedan sin puntuar (None).
+        - Lista de tuplas con los resultados, en el orden de las filas.
+    """
+    columnas = ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']
+    for col in columnas:
+        if col not in df.columns:
+            df[col] = None
+
+    # Asignar ceros donde no hay URLs
+    df.loc[df['url_cocina'].isna(), ['puntuacion_cocina', 'mts_cocina']] = [0, 0]
+    df.loc[df['url_banio'].isna(), ['puntuacion_banio', 'mts_banio']] = [0, 0]
+
+    indices_validos = df[df['url_cocina'].notna() | df['url_banio'].notna()].index
+    en_cache, hashes = consultar_cache_puntuaciones(df, indices_validos, max_concurrencia) if usar_cache else ({}, {})
+    pendientes = indices_validos[~indices_validos.isin(list(en_cache))]
+    resultados, ceros = _ejecutar_corrutina(
+        _analizar_propiedades_async(df, pendientes, batch, max_concurrencia, reintentos, base_url)
+    )
+    # Sólo se guardan las evaluaciones del modelo, no los ceros de las fotos que no se han podido preparar
+    if usar_cache:
+        guardar_cache_puntuaciones(resultados, hashes)
+        print(f"Propiedades servidas desde el almacén de evaluaciones: {len(en_cache)} de {len(indices_validos)}.")
+        resultados.update(en_cache)
+    resultados.update(ceros)
+
+    # Asignación en bloque de todos los resultados
+    indices_puntuados = [idx for idx in indices_validos if idx in resultados]
+    resultados_totales = [tuple(resultados[idx]) for idx in indices_puntuados]
+    if indices_puntuados:
+        df.loc[indices_puntuados, columnas] = pd.DataFrame(resultados_totales, columns=columnas).values
+
+    sin_puntuar = len(indices_validos) - len(indices_puntuados)
+    if sin_puntuar:
+        print(f"Propiedades sin puntuar por errores en la API: {sin_puntuar}.")
+    return df, resultados_totales
+
+
+# Tamaño máximo aproximado de las peticiones de cada trabajo por lotes (el límite de la API es 256 MB)
+MAX_BYTES_TRABAJO = 200 * 1024 * 1024
+
+
+def _guardar_estado(ruta_estado: str, estado: dict) -> None:
+    """
+    Guarda el estado de los trabajos por lotes de forma atómica.
+    """
+    temporal = f"{ruta_estado}.tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(estado, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, ruta_estado)
+
+
+def _cargar_estado(ruta_estado: str) -> dict:
+    """
+    Carga el estado de los trabajos por lotes, o uno vacío si aún no existe.
+    """
+    if os.path.exists(ruta_estado):
+        with open(ruta_estado, encoding="utf-8") as f:
+            return json.load(f)
+    return {"modelo": MODELO_SCORING, "trabajos": [], "ceros": [], "resultados": {}, "errores": {}}
+
+
+def _codigos_a_reenviar(estado: dict, max_reenvios: int) -> set:
+    """
+    Devuelve los 'codigo' de las peticiones con errores (fallidas, caducadas o con respuesta incompleta) que
+    aún no tienen resultado ni están en un trabajo sin terminar, y que no han agotado `max_reenvios`.
+    Actualiza en el estado el número de reenvíos de cada uno y quita los errores que quedan resueltos
+    por el reenvío.
+    """
+    en_curso = {codigo for trabajo in estado["trabajos"] if not trabajo.get("resultados_descargados")
+                for codigos in trabajo["lotes"].values() for codigo in codigos}
+    lotes = {custom_id: codigos for trabajo in estado["trabajos"] for custom_id, codigos in trabajo["lotes"].items()}
+    reenvios = estado.setdefault("reenvios", {})
+
+    fallidos = {codigo for custom_id in estado["errores"] for codigo in lotes.get(custom_id, [])
+                if codigo not in estado["resultados"] and codigo not in en_curso}
+    a_reenviar = {codigo for codigo in fallidos if reenvios.get(codigo, 0) < max_reenvios}
+    for codigo in a_reenviar:
+        reenvios[codigo] = reenvios.get(codigo, 0) + 1
+    for custom_id in list(estado["errores"]):
+        if all(codigo in a_reenviar or codigo in estado["resultados"] for codigo in lotes.get(custom_id, [])):
+            del estado["errores"][custom_id]
+    return a_reenviar
+
+
+def enviar_trabajos_lotes(df: pd.DataFrame, ruta_estado: str, batch: int = 3, base_url: Optional[str] = None,
+                          max_bytes_trabajo: int = MAX_BYTES_TRABAJO, max_reenvios: int = 3) -> dict:
+    """
+    Envía la evaluación de todas las propiedades como trabajos por lotes de la API (Message Batches), sin
+    esperar la respuesta. Cada petición contiene `batch` propiedades, igual que en `analizar_lote_propiedades`,
+    y se identifica con un custom_id que se asocia en el estado a los 'codigo' de sus propiedades.
+    Si el catálogo supera el tamaño máximo de un trabajo, se reparte en varios.
+
+    El estado se guarda en `ruta_estado` tras enviar cada trabajo, de modo que si el proceso se interrumpe,
+    al volver a llamar a la función sólo se envían las propiedades que aún no estaban en ningún trabajo y las
+    de peticiones fallidas, caducadas o con respuesta incompleta (hasta `max_reenvios` veces cada una).
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "codigo", "url_cocina" y "url_banio".
+        ruta_estado (str): Fichero JSON donde se guarda el estado de los trabajos.
+        batch (int, opcional): Propiedades por petición. Por defecto es 3.
+        base_url (str, opcional): URL base de la API (por ejemplo, un servidor local de pruebas).
+        max_bytes_trabajo (int, opcional): Tamaño máximo aproximado de las peticiones de cada trabajo.
+        max_reenvios (int, opcional): Veces que se vuelve a enviar una propiedad cuya petición ha fallado.
+
+    Returns:
+        dict: Estado de los trabajos.
+    """
+    cliente = Anthropic(api_key=anthropic_key, base_url=base_url)
+    estado = _cargar_estado(ruta_estado)
+
+    # Propiedades ya enviadas en ejecuciones anteriores, salvo las de peticiones con errores
+    enviados = set(estado["ceros"])
+    for trabajo in estado["trabajos"]:
+        for codigos in trabajo["lotes"].values():
+            enviados.update(codigos)
+    a_reenviar = _codigos_a_reenviar(estado, max_reenvios)
+    if a_reenviar:
+        print(f"Propiedades de peticiones con errores que se vuelven a enviar: {len(a_reenviar)}.")
+    enviados -= a_reenviar
+    pendientes = df[~df["codigo"].astype(str).isin(enviados)]
+    numero_lote = sum(len(trabajo["lotes"]) for trabajo in estado["trabajos"])
+
+    peticiones, lotes, bytes_trabajo = [], {}, 0
+
+    def enviar():
+        trabajo = cliente.messages.batches.create(requests=peticiones)
+        estado["trabajos"].append({"id": trabajo.id, "estado": trabajo.processing_status, "lotes": dict(lotes)})
+        _guardar_estado(ruta_estado, estado)
+        print(f"Trabajo {trabajo.id} enviado con {len(peticiones)} peticiones.")
+
+    for i in tqdm(range(0, len(pendientes), batch), desc="Preparando peticiones"):
+        lote = pendientes.iloc[i:i + batch]
+        codigos, imagenes = [], []
+        for codigo, url_cocina, url_banio in zip(lote["codigo"].astype(str), lote["url_cocina"], lote["url_banio"]):
+            preparadas = preparar_imagenes_lote([url_cocina], [url_banio], allow_partial=True)
+            if preparadas:
+                codigos.append(codigo)
+                imagenes.append(preparadas[0])
+            else:
+                estado["ceros"].append(codigo)
+        if not imagenes:
             continue
 
-        # Analizar el lote
-        resultados = analizar_lote_propiedades(cliente, imagenes_preparadas, batch)
-        resultados_totales.extend(resultados)
+        custom_id = f"lote-{numero_lote:06d}"
+        numero_lote += 1
+        peticion = {
+            "custom_id": custom_id,
+            "params": parametros_peticion(construir_contenido_lote(imagenes), tokens_salida(len(imagenes))),
+        }
+        tamanio = len(json.dumps(peticion))
+        if peticiones and bytes_trabajo + tamanio > max_bytes_trabajo:
+            enviar()
+            peticiones, lotes, bytes_trabajo = [], {}, 0
+        peticiones.append(peticion)
+        lotes[custom_id] = codigos
+        bytes_trabajo += tamanio
+
+    if peticiones:
+        enviar()
+    _guardar_estado(ruta_estado, estado)
+    return estado
+
+
+def esperar_trabajos_lotes(ruta_estado: str, intervalo: int = 60, base_url: Optional[str] = None,
+                           esperar: bool = True) -> dict:
+    """
+    Consulta el estado de los trabajos por lotes enviados hasta que todos terminan, y descarga los resultados
+    de cada trabajo terminado. Los resultados se guardan en el estado, por lo que no se vuelven a descargar.
+
+    Args:
+        ruta_estado (str): Fichero JSON con el estado de los trabajos.
+        intervalo (int, opcional): Segundos entre consultas.
+        base_url (str, opcional): URL base de la API (por ejemplo, un servidor local de pruebas).
+        esperar (bool, opcional): Si es False, hace una sola consulta y devuelve el estado actual.
+
+    Returns:
+        dict: Estado de los trabajos.
+    """
+    cliente = Anthropic(api_key=anthropic_key, base_url=base_url)
+    estado = _cargar_estado(ruta_estado)
+
+    while True:
+        for trabajo in estado["trabajos"]:
+            if trabajo["estado"] == "ended" and trabajo.get("resultados_descargados"):
+                continue
+            consulta = cliente.messages.batches.retrieve(trabajo["id"])
+            trabajo["estado"] = consulta.processing_status
+            trabajo["peticiones"] = consulta.request_counts.model_dump()
+            if trabajo["estado"] != "ended":
+                continue
+
+            for respuesta in cliente.messages.batches.results(trabajo["id"]):
+                codigos = trabajo["lotes"].get(respuesta.custom_id, [])
+                if respuesta.result.type != "succeeded":
+                    estado["errores"][respuesta.custom_id] = respuesta.result.type
+                    continue
+                try:
+                    registrar_uso(respuesta.result.message, len(codigos))
+                    evaluaciones = interpretar_respuesta(respuesta.result.message.content[0].text)
+                    ids = [str(i + 1) for i in range(len(codigos))]
+                    estado["resultados"].update(
+                        {codigo: list(evaluaciones[i]) for codigo, i in zip(codigos, ids) if i in evaluaciones}
+                    )
+                    if len(evaluaciones) < len(codigos):
+                        estado["errores"][respuesta.custom_id] = "respuesta incompleta"
+                    else:
+                        estado["errores"].pop(respuesta.custom_id, None)
+                except Exception as e:
+                    estado["errores"][respuesta.custom_id] = str(e)
+            trabajo["resultados_descargados"] = True
+        _guardar_estado(ruta_estado, estado)
+
+        en_curso = [t["id"] for t in estado["trabajos"] if t["estado"] != "ended"]
+        if not en_curso or not esperar:
+            return estado
+        print(f"Trabajos en curso: {len(en_curso)}. Nueva consulta en {intervalo} s.")
+        time.sleep(intervalo)
+
+
+def aplicar_resultados_lotes(df: pd.DataFrame, ruta_estado: str) -> pd.DataFrame:
+    """
+    Asigna al DataFrame, por 'codigo', las evaluaciones de los trabajos por lotes guardadas en el estado.
+
+    Args:
+        df (pd.DataFrame): DataFrame con la columna "codigo".
+        ruta_estado (str): Fichero JSON con el estado de los trabajos.
+
+    Returns:
+        pd.DataFrame: DataFrame con las columnas "puntuacion_cocina", "mts_cocina", "puntuacion_banio" y "mts_banio".
+            Las propiedades sin resultado (errores o trabajos no terminados) quedan sin puntuar (None).
+    """
+    estado = _cargar_estado(ruta_estado)
+    columnas = ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']
+    for col in columnas:
+        if col not in df.columns:
+            df[col] = None
+
+    resultados = {codigo: (0, 0, 0, 0) for codigo in estado["ceros"]}
+    resultados.update({codigo: tuple(valores) for codigo, valores in estado["resultados"].items()})
+    df_resultados = pd.DataFrame.from_dict(resultados, orient="index", columns=columnas)
+
+    codigos = df["codigo"].astype(str)
+    mascara = codigos.isin(df_resultados.index)
+    df.loc[mascara, columnas] = df_resultados.loc[codigos[mascara]].values
+    print(f"Propiedades puntuadas: {mascara.sum()} de {len(df)}. Peticiones con errores: {len(estado['errores'])}.")
+    return df
+
+
+def analizar_propiedades_por_lotes(df: pd.DataFrame, ruta_estado: str, batch: int = 3, intervalo: int = 60,
+                                   base_url: Optional[str] = None, max_reenvios: int = 3) -> pd.DataFrame:
+    """
+    Evalúa todo el catálogo con trabajos por lotes de la API: envía las peticiones pendientes, espera a que
+    terminen los trabajos y asigna los resultados por 'codigo'. Se puede volver a llamar tras un reinicio
+    del proceso: continúa desde el estado guardado en `ruta_estado` y vuelve a enviar las propiedades de
+    las peticiones que fallaron o caducaron.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "codigo", "url_cocina" y "url_banio".
+        ruta_estado (str): Fichero JSON donde se guarda el estado de los trabajos.
+        batch (int, opcional): Propiedades por petición. Por defecto es 3.
+        intervalo (int, opcional): Segundos entre consultas del estado de los trabajos.
+        base_url (str, opcional): URL base de la API (por ejemplo, un servidor local de pruebas).
+        max_reenvios (int, opcional): Veces que se vuelve a enviar una propiedad cuya petición ha fallado.
+
+    Returns:
+        pd.DataFrame: DataFrame actualizado con las evaluaciones.
+    """
+    enviar_trabajos_lotes(df, ruta_estado, batch, base_url, max_reenvios=max_reenvios)
+    esperar_trabajos_lotes(ruta_estado, intervalo, base_url)
+    return aplicar_resultados_lotes(df, ruta_estado)
 
-        # Actualizar resultados en el DataFrame
-        for idx, (cocina_p, cocina_m, banio_p, banio_m) in zip(indices_lote, resultados):
-            df.loc[idx, ['puntuacion_cocina', 'mts_cocina', 'puntuacion_banio', 'mts_banio']] = [
-                cocina_p, cocina_m, banio_p, banio_m
-            ]
 
-        time.sleep(1)  # Evitar saturar la API
+def _muestra_valida(df: pd.DataFrame, muestra: int, semilla: int) -> pd.DataFrame:
+    """
+    Devuelve una muestra aleatoria de las propiedades con al menos una foto.
+    """
+    df_muestra = df[df['url_cocina'].notna() | df['url_banio'].notna()]
+    return df_muestra.sample(min(muestra, len(df_muestra)), random_state=semilla)
+
+
+def _evaluar_muestra(cliente, df_muestra: pd.DataFrame, batch: int, descripcion: str) -> Tuple[dict, dict]:
+    """
+    Evalúa una muestra de propiedades en lotes, una petición cada vez, con la configuración actual.
+    Devuelve las evaluaciones por índice y las métricas de las peticiones.
+    """
+    puntuadas, tamanios, tiempos, tokens = {}, [], [], []
+    for i in tqdm(range(0, len(df_muestra), batch), desc=descripcion):
+        indices, imagenes = _preparar_lote_indexado(df_muestra, df_muestra.index[i:i + batch])
+        if not imagenes:
+            continue
+        content = construir_contenido_lote(imagenes)
+        try:
+            inicio = time.perf_counter()
+            mensaje = cliente.messages.create(**parametros_peticion(content, tokens_salida(len(imagenes))))
+            tiempos.append(time.perf_counter() - inicio)
+            tamanios.append(len(json.dumps(content)))
+            tokens.append(mensaje.usage.input_tokens)
+            resultado = interpretar_respuesta(mensaje.content[0].text)
+            puntuadas.update({idx: resultado[str(j + 1)] for j, idx in enumerate(indices) if str(j + 1) in resultado})
+        except Exception as e:
+            print(f"Error procesando lote: {e}")
+
+    return puntuadas, {
+        "peticiones": len(tiempos),
+        "kb_por_peticion": np.mean(tamanios) / 1024 if tamanios else np.nan,
+        "segundos_por_peticion": np.mean(tiempos) if tiempos else np.nan,
+        "tokens_entrada_por_peticion": np.mean(tokens) if tokens else np.nan,
+        "propiedades_por_segundo": len(puntuadas) / sum(tiempos) if tiempos else np.nan,
+    }
+
+
+def _agregar_concordancia(filas: List[dict], evaluaciones: List[dict]) -> None:
+    """
+    Añade a cada fila la concordancia de sus evaluaciones con las de la primera (la referencia),
+    en las propiedades evaluadas en ambos casos.
+    """
+    for fila, puntuadas in zip(filas, evaluaciones):
+        comunes = [idx for idx in puntuadas if idx in evaluaciones[0]]
+        referencia = np.array([evaluaciones[0][idx] for idx in comunes], dtype=float).reshape(-1, 4)
+        actual = np.array([puntuadas[idx] for idx in comunes], dtype=float).reshape(-1, 4)
+        fila["propiedades_comparadas"] = len(comunes)
+        fila["coincidencia_puntuaciones"] = (referencia[:, [0, 2]] == actual[:, [0, 2]]).mean() if comunes else np.nan
+        fila["error_medio_mts"] = np.abs(referencia[:, [1, 3]] - actual[:, [1, 3]]).mean() if comunes else np.nan
+
+
+def comparar_tamanios_imagenes(df: pd.DataFrame, lados: List[Optional[int]] = (None, 1568, 1024, 768, 512),
+                               calidad: int = 85, batch: int = 3, muestra: int = 30,
+                               semilla: int = 42) -> pd.DataFrame:
+    """
+    Evalúa una muestra de propiedades enviando las fotos a varios tamaños y compara el tamaño de las peticiones,
+    la latencia, los tokens de entrada y la concordancia de las evaluaciones con las del primer tamaño
+    (por defecto, las fotos originales). No usa ni modifica el almacén de evaluaciones.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        lados (List[Optional[int]]): Lados largos máximos a comparar (None para las fotos originales).
+        calidad (int): Calidad JPEG de la recompresión.
+        batch (int): Propiedades por petición.
+        muestra (int): Número de propiedades evaluadas.
+        semilla (int): Semilla de la muestra.
+
+    Returns:
+        pd.DataFrame: Una fila por tamaño con KB por petición, segundos por petición, tokens de entrada por
+            petición, coincidencia exacta de las puntuaciones y error medio en m² frente a la referencia.
+    """
+    cliente = Anthropic(api_key=anthropic_key)
+    df_muestra = _muestra_valida(df, muestra, semilla)
+
+    config_original = dict(config_imagenes)
+    evaluaciones, filas = [], []
+    try:
+        for lado in lados:
+            configurar_imagenes(lado, calidad)
+            puntuadas, metricas = _evaluar_muestra(cliente, df_muestra, batch, f"Lado {lado or 'original'}")
+            evaluaciones.append(puntuadas)
+            filas.append({"lado_maximo": lado or "original", **metricas})
+    finally:
+        config_imagenes.update(config_original)
+
+    _agregar_concordancia(filas, evaluaciones)
+    df_resultados = pd.DataFrame(filas)
+    df_resultados["reduccion_bytes"] = 1 - df_resultados["kb_por_peticion"] / df_resultados.loc[0, "kb_por_peticion"]
+    return df_resultados
+
+
+def comparar_hoja_contacto(df: pd.DataFrame, batch: int = 3, muestra: int = 30, semilla: int = 42,
+                           propiedades_por_hoja: int = 3) -> pd.DataFrame:
+    """
+    Evalúa una muestra de propiedades enviando las fotos una a una y en hojas de contacto, y compara el tamaño
+    de las peticiones, la latencia, los tokens de entrada, las propiedades evaluadas por segundo y la
+    concordancia de las evaluaciones de las hojas de contacto con las de las fotos individuales.
+    No usa ni modifica el almacén de evaluaciones.
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        batch (int): Propiedades por petición.
+        muestra (int): Número de propiedades evaluadas.
+        semilla (int): Semilla de la muestra.
+        propiedades_por_hoja (int): Propiedades de cada hoja de contacto.
+
+    Returns:
+        pd.DataFrame: Una fila por modo ("individual", "hoja_contacto") con sus métricas.
+    """
+    cliente = Anthropic(api_key=anthropic_key)
+    df_muestra = _muestra_valida(df, muestra, semilla)
+
+    config_original = dict(config_prompt)
+    evaluaciones, filas = [], []
+    try:
+        for modo, hoja_contacto in [("individual", False), ("hoja_contacto", True)]:
+            config_prompt.update(hoja_contacto=hoja_contacto, propiedades_por_hoja=propiedades_por_hoja)
+            puntuadas, metricas = _evaluar_muestra(cliente, df_muestra, batch, modo)
+            evaluaciones.append(puntuadas)
+            filas.append({"modo": modo, **metricas})
+    finally:
+        config_prompt.update(config_original)
+
+    _agregar_concordancia(filas, evaluaciones)
+    df_resultados = pd.DataFrame(filas)
+    df_resultados["reduccion_bytes"] = 1 - df_resultados["kb_por_peticion"] / df_resultados.loc[0, "kb_por_peticion"]
+    return df_resultados
+
+
+def medir_cache_prompt(df: pd.DataFrame, batch: int = 3, muestra: int = 12, semilla: int = 42,
+                       base_url: Optional[str] = None) -> pd.DataFrame:
+    """
+    Evalúa la misma muestra de propiedades con el prompt anterior (sólo las instrucciones, enviadas en el mensaje
+    después de las imágenes) y con el prompt de sistema sin y con prompt caching, enviando las peticiones una a
+    una. Compara tokens de entrada, tokens servidos desde la caché, coste de entrada y latencia por petición, y la
+    concordancia de las evaluaciones con las del prompt anterior. No usa ni modifica el almacén de evaluaciones.
+
+    Si el prompt de sistema no alcanza el mínimo de tokens que la API cachea con el modelo, avisa de que los dos
+    últimos modos son equivalentes (el prefijo no se marca como cacheable y no habrá lecturas de la caché).
+
+    Args:
+        df (pd.DataFrame): DataFrame con las columnas "url_cocina" y "url_banio".
+        batch (int): Propiedades por petición.
+        muestra (int): Número de propiedades evaluadas.
+        semilla (int): Semilla de la muestra.
+        base_url (str, opcional): URL base de la API (por ejemplo, un servidor local de pruebas).
+
+    Returns:
+        pd.DataFrame: Una fila por modo ("instrucciones_en_mensaje", "sin_cache", "con_cache") con el resumen de
+            `resumen_uso`, el coste de entrada por petición, la concordancia con el primer modo y los tokens
+            del prefijo frente al mínimo cacheable.
+    """
+    cliente = Anthropic(api_key=anthropic_key, base_url=base_url)
+    tokens, minimo = tokens_prefijo(cliente), minimo_tokens_cache()
+    if tokens < minimo:
+        print(f"Aviso: el prompt de sistema tiene {tokens} tokens, por debajo del mínimo de {minimo} que la API "
+              f"cachea con {MODELO_SCORING}. El prefijo no se marca como cacheable y ambos modos son equivalentes.")
+    df_muestra = _muestra_valida(df, muestra, semilla)
+    lotes = [_preparar_lote_indexado(df_muestra, df_muestra.index[i:i + batch])
+             for i in range(0, len(df_muestra), batch)]
+
+    def peticion_anterior(content, max_tokens):
+        content = content + [{"type": "text", "text": INSTRUCCIONES_EVALUACION}]
+        return {"model": MODELO_SCORING, "max_tokens": max_tokens, "messages": [{"role": "user", "content": content}]}
+
+    config_original = dict(config_prompt)
+    evaluaciones, filas = [], []
+    try:
+        for modo, cache, parametros in [("instrucciones_en_mensaje", False, peticion_anterior),
+                                        ("sin_cache", False, parametros_peticion),
+                                        ("con_cache", True, parametros_peticion)]:
+            config_prompt["cache"] = cache
+            inicio_registro = len(registro_uso)
+            puntuadas = {}
+            for indices, imagenes in tqdm(lotes, desc=modo):
+                if not imagenes:
+                    continue
+                try:
+                    inicio = time.perf_counter()
+                    mensaje = cliente.messages.create(
+                        **parametros(construir_contenido_lote(imagenes), tokens_salida(len(imagenes)))
+                    )
+                    registrar_uso(mensaje, len(imagenes), time.perf_counter() - inicio)
+                    resultado = interpretar_respuesta(mensaje.content[0].text)
+                    puntuadas.update({idx: resultado[str(j + 1)] for j, idx in enumerate(indices)
+                                      if str(j + 1) in resultado})
+                except Exception as e:
+                    print(f"Error procesando lote: {e}")
+            evaluaciones.append(puntuadas)
+            filas.append({"modo": modo, **resumen_uso(registro_uso[inicio_registro:])})
+    finally:
+        config_prompt.update(config_original)
 
-    return df, resultados_totales
\ No newline at end of file
+    _agregar_concordancia(filas, evaluaciones)
+    df_resultados = pd.DataFrame(filas)
+    df_resultados["coste_entrada_por_peticion"] = df_resultados["coste_entrada_equivalente"] / df_resultados["peticiones"]
+    df_resultados["tokens_prefijo"] = tokens
+    df_resultados["minimo_cache"] = minimo
+    return df_resultados
@@ -1,17 +1,452 @@
+import os
 import pandas as pd
-import requests
-from PIL import Image
-from ultralytics import YOLO
+import numpy as np
 import ast
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
 from tqdm import tqdm
+from src import soporte_cache as sc
+from src import soporte_detecciones as sd
 
-# Carga del modelo YOLO
-model = YOLO("../transformers/yolo11x-cls.pt")
+# Los modelos YOLO (y la propia librería ultralytics) se cargan la primera vez que se usan,
+# de modo que importar este módulo no reserva memoria ni tiempo de arranque.
 # Documentación de soporte: https://docs.ultralytics.com/models/yolo11/#performance-metrics
 
+# Directorio de los modelos, relativo a este fichero para que funcione desde cualquier directorio de trabajo
+directorio_modelos = os.getenv(
+    "directorio_modelos", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transformers")
+)
+# Modelos de clasificación disponibles por tamaño
+rutas_modelos = {tamanio: os.path.join(directorio_modelos, f"yolo11{tamanio}-cls.pt") for tamanio in ["s", "m", "l", "x"]}
+modelos_cargados = {}
+_lock_modelos = threading.Lock()
+
+# Configuración del modo cascada: se clasifica con el modelo pequeño y sólo se recurre al grande
+# cuando su top-5 es ambiguo para la regla de cocina/baño
+config_cascada = {
+    "activa": False,
+    "modelo_pequenio": "s",
+    "modelo_grande": "x",
+    # Suma mínima de probabilidad de las etiquetas coincidentes para aceptar la habitación del modelo pequeño
+    "umbral_confirmacion": 0.5,
+    # Probabilidad mínima del top-1 para aceptar que la imagen no es cocina ni baño sin ninguna coincidencia
+    "umbral_descarte": 0.5,
+}
+estadisticas_cascada = {"imagenes": 0, "escaladas": 0}
+
+# Tamaño mínimo al que se decodifican las fotos (entrada del clasificador): evita decodificar
+# los JPEG a resolución completa para reducirlos después a 224 px
+tamanio_decodificacion = 224
+# Tensor de entrada (1, 3, 224, 224) de cada hilo para el backend PyTorch, reutilizado entre imágenes
+_entradas_torch = threading.local()
+
+# Deduplicación por hash perceptual: las fotos casi idénticas (reutilizadas entre anuncios con otra URL)
+# se clasifican una sola vez y el resultado se reparte a todas las URLs del grupo
+config_deduplicacion = {"activa": False, "distancia_maxima": 4, "metodo": "phash"}
+indice_perceptual = sc.IndicePerceptual(config_deduplicacion["distancia_maxima"])
+resultados_representantes = {}
+estadisticas_deduplicacion = {"inferencias_evitadas": 0}
+
+# Backend de inferencia: "pytorch" (ultralytics) u "onnx" (ONNX Runtime en CPU, ver soporte_onnx)
+config_backend = {"backend": "pytorch", "cuantizado": False, "hilos": None}
+sesiones_onnx = {}
+
 # Listas de objetos relacionados con cocina y baño
 kitchen_items = ["microwave", "oven", "refrigerator", "stove", "kitchen", "oven", "plate_rack"]
 bathroom_items = ["toilet", "toilet_seat", "shower", "bathtub", "bathroom", "toothbrush", "medicine_chest"]
+# Número de coincidencias necesarias para asignar una habitación
+coincidencias_minimas = 2
+
+# Prioridad de las etiquetas de imagen de Idealista (menor valor = se clasifica antes)
+prioridad_tags = {"kitchen": 0, "bathroom": 0, "unknown": 1, "Sin Tag": 1}
+prioridad_por_defecto = 2
+# Etiquetas que casi nunca corresponden a una cocina o un baño: se clasifican sólo como último recurso,
+# en el orden de la lista (fachada y vistas al final)
+tags_irrelevantes = ["plan", "garage", "pool", "garden", "communalAreas", "terrace", "views", "facade"]
+
+
+def configurar_modelos(directorio=None, **rutas):
+    """
+    Cambia la ubicación de los modelos YOLO. Los modelos ya cargados cuya ruta cambia se descartan
+    y se volverán a cargar en el siguiente uso.
+
+    Parámetros:
+        directorio (str, opcional): Directorio con los ficheros yolo11{s,m,l,x}-cls.pt.
+        **rutas: Rutas concretas por tamaño, por ejemplo x="/modelos/yolo11x-cls.pt".
+
+    Devuelve:
+        dict: Rutas de los modelos resultantes.
+    """
+    global directorio_modelos
+    with _lock_modelos:
+        nuevas = {}
+        if directorio is not None:
+            directorio_modelos = directorio
+            nuevas.update({tamanio: os.path.join(directorio, f"yolo11{tamanio}-cls.pt") for tamanio in rutas_modelos})
+        nuevas.update(rutas)
+        for tamanio, ruta in nuevas.items():
+            if rutas_modelos.get(tamanio) != ruta:
+                rutas_modelos[tamanio] = ruta
+                modelos_cargados.pop(tamanio, None)
+    return dict(rutas_modelos)
+
+
+def cargar_modelo(tamanio="x"):
+    """
+    Devuelve el modelo YOLO de clasificación del tamaño indicado, cargándolo la primera vez que se pide.
+    Es seguro llamarla desde varios hilos: cada modelo se carga una sola vez.
+
+    Parámetros:
+        tamanio (str): Tamaño del modelo ("s", "m", "l" o "x").
+
+    Devuelve:
+        YOLO: Modelo de clasificación.
+    """
+    modelo = modelos_cargados.get(tamanio)
+    if modelo is None:
+        with _lock_modelos:
+            modelo = modelos_cargados.get(tamanio)
+            if modelo is None:
+                from ultralytics import YOLO
+                modelo = YOLO(rutas_modelos[tamanio])
+                modelos_cargados[tamanio] = modelo
+    return modelo
+
+
+def warmup(tamanios=None):
+    """
+    Carga los modelos indicados y ejecuta una inferencia sobre una imagen vacía, para que la primera
+    imagen real no pague el coste de inicialización.
+
+    Parámetros:
+        tamanios (list, opcional): Tamaños a precargar. Por defecto, el x y, si la cascada está activa,
+            los dos modelos de la cascada.
+
+    Devuelve:
+        dict: Segundos empleados en la carga y primera inferencia de cada modelo.
+    """
+    if tamanios is None:
+        tamanios = ["x"]
+        if config_cascada["activa"]:
+            tamanios = [config_cascada["modelo_pequenio"], config_cascada["modelo_grande"]]
+
+    imagen_vacia = Image.new("RGB", (224, 224))
+    tiempos = {}
+    for tamanio in tamanios:
+        inicio = time.perf_counter()
+        clasificar_imagen(imagen_vacia, tamanio)
+        tiempos[tamanio] = time.perf_counter() - inicio
+    return tiempos
+
+
+def configurar_cascada(activa=True, modelo_pequenio=None, modelo_grande=None, umbral_confirmacion=None, umbral_descarte=None):
+    """
+    Activa o desactiva el modo cascada y ajusta sus modelos y umbrales de confianza.
+    Los parámetros que se dejan en None mantienen su valor actual.
+
+    Parámetros:
+        activa (bool): Si es True, las imágenes se clasifican primero con el modelo pequeño.
+        modelo_pequenio (str, opcional): Tamaño del modelo rápido ("s", "m" o "l").
+        modelo_grande (str, opcional): Tamaño del modelo al que se escalan los casos ambiguos.
+        umbral_confirmacion (float, opcional): Probabilidad acumulada mínima de las etiquetas coincidentes
+            para aceptar la cocina/baño detectado por el modelo pequeño.
+        umbral_descarte (float, opcional): Probabilidad mínima del top-1 para aceptar que la imagen no es
+            ni cocina ni baño cuando el top-5 no tiene ninguna coincidencia.
+
+    Devuelve:
+        dict: Configuración resultante.
+    """
+    config_cascada["activa"] = activa
+    for clave, valor in [("modelo_pequenio", modelo_pequenio), ("modelo_grande", modelo_grande),
+                         ("umbral_confirmacion", umbral_confirmacion), ("umbral_descarte", umbral_descarte)]:
+        if valor is not None:
+            config_cascada[clave] = valor
+    return dict(config_cascada)
+
+
+def configurar_deduplicacion(activa=True, distancia_maxima=4, metodo="phash"):
+    """
+    Activa o desactiva la deduplicación por hash perceptual y reinicia el índice de imágenes vistas.
+
+    Parámetros:
+        activa (bool): Si es True, las fotos casi idénticas a otra ya clasificada reutilizan su resultado.
+        distancia_maxima (int): Distancia de Hamming máxima entre hashes para considerar dos fotos duplicadas.
+        metodo (str): "phash" o "dhash".
+
+    Devuelve:
+        dict: Configuración resultante.
+    """
+    global indice_perceptual
+    config_deduplicacion.update({"activa": activa, "distancia_maxima": distancia_maxima, "metodo": metodo})
+    indice_perceptual = sc.IndicePerceptual(distancia_maxima)
+    resultados_representantes.clear()
+    estadisticas_deduplicacion["inferencias_evitadas"] = 0
+    return dict(config_deduplicacion)
+
+
+def resumen_deduplicacion():
+    """
+    Devuelve la frecuencia de fotos duplicadas encontradas y las inferencias evitadas por la deduplicación.
+    En el modo por fragmentos, cada proceso tiene su propio índice y este resumen sólo refleja el proceso principal.
+
+    Devuelve:
+        dict: Imágenes indexadas, grupos, duplicadas, tasa de duplicados e inferencias evitadas.
+    """
+    return {**indice_perceptual.resumen(), **estadisticas_deduplicacion}
+
+
+def configurar_backend(backend="onnx", cuantizado=False, hilos=None):
+    """
+    Selecciona el backend de inferencia de los modelos de clasificación. Con "onnx", cada modelo se exporta
+    a ONNX (y se cuantiza a int8 si se pide) la primera vez que se usa, y se ejecuta con ONNX Runtime en CPU.
+
+    Parámetros:
+        backend (str): "pytorch" u "onnx".
+        cuantizado (bool): Si es True, usa la versión int8 del modelo ONNX.
+        hilos (int, opcional): Hilos de ONNX Runtime por sesión. Por defecto, los núcleos disponibles.
+
+    Devuelve:
+        dict: Configuración resultante.
+    """
+    if backend not in ["pytorch", "onnx"]:
+        raise ValueError(f"Backend no soportado: {backend}")
+    with _lock_modelos:
+        config_backend.update({"backend": backend, "cuantizado": cuantizado, "hilos": hilos})
+        sesiones_onnx.clear()
+    return dict(config_backend)
+
+
+def cargar_sesion_onnx(tamanio="x"):
+    """
+    Devuelve la sesión de ONNX Runtime del modelo del tamaño indicado, exportándolo si es necesario.
+
+    Parámetros:
+        tamanio (str): Tamaño del modelo ("s", "m", "l" o "x").
+
+    Devuelve:
+        onnxruntime.InferenceSession: Sesión del modelo.
+    """
+    from src import soporte_onnx as so
+
+    clave = (rutas_modelos[tamanio], config_backend["cuantizado"])
+    sesion = sesiones_onnx.get(clave)
+    if sesion is None:
+        with _lock_modelos:
+            sesion = sesiones_onnx.get(clave)
+            if sesion is None:
+                ruta_onnx = so.exportar_onnx(rutas_modelos[tamanio], cuantizar=config_backend["cuantizado"])
+                sesion = so.crear_sesion(ruta_onnx, config_backend["hilos"])
+                sesiones_onnx[clave] = sesion
+    return sesion
+
+
+def _tensor_entrada(img):
+    """
+    Preprocesa una imagen como lo hace ultralytics en clasificación (`soporte_onnx.preprocesar`) escribiendo
+    en el tensor de entrada del hilo actual, que se reutiliza entre imágenes en lugar de crear uno por llamada.
+
+    Devuelve:
+        torch.Tensor: Tensor float32 (1, 3, 224, 224) con valores en [0, 1].
+    """
+    import torch
+    from src import soporte_onnx as so
+
+    entrada = getattr(_entradas_torch, "tensor", None)
+    if entrada is None:
+        entrada = _entradas_torch.tensor = torch.empty((1, 3, tamanio_decodificacion, tamanio_decodificacion))
+    so.preprocesar(img, tamanio_decodificacion, salida=entrada[0].numpy())
+    return entrada
+
+
+def _inferir(img, tamanio="x"):
+    """
+    Ejecuta el modelo del tamaño indicado con el backend configurado.
+
+    Devuelve:
+        list: Índices de clase del top-5.
+        list: Probabilidades del top-5.
+        dict: Nombres de las clases del modelo.
+    """
+    if config_backend["backend"] == "onnx":
+        from src import soporte_onnx as so
+        sesion = cargar_sesion_onnx(tamanio)
+        indices, probs = so.clasificar_lote(sesion, [img])
+        return [int(i) for i in indices[0]], [float(p) for p in probs[0]], so.nombres_clases(sesion)
+
+    modelo = cargar_modelo(tamanio)
+    # Con un tensor ya preprocesado, ultralytics no aplica sus transformaciones ni crea otro tensor por imagen
+    results = modelo(_tensor_entrada(img), verbose=False)
+
+    if not hasattr(results[0], "probs"):
+        return [], [], modelo.names
+    probs = results[0].probs
+    return [int(class_id) for class_id in probs.top5], [float(conf) for conf in probs.top5conf], modelo.names
+
+
+def identificador_modelo(tamanio="x"):
+    """
+    Devuelve el identificador con el que se guardan en el almacén las clasificaciones de un modelo,
+    que incluye el fichero del modelo y el backend (y si está cuantizado).
+
+    Parámetros:
+        tamanio (str): Tamaño del modelo ("s", "m", "l" o "x").
+
+    Devuelve:
+        str: Identificador del modelo, por ejemplo "yolo11x-cls|pytorch".
+    """
+    nombre = os.path.splitext(os.path.basename(rutas_modelos[tamanio]))[0]
+    backend = config_backend["backend"]
+    if backend == "onnx" and config_backend["cuantizado"]:
+        backend += "-int8"
+    return f"{nombre}|{backend}"
+
+
+def clasificar_imagen(img, tamanio="x"):
+    """
+    Clasifica una imagen con el modelo YOLO del tamaño indicado, usando el backend configurado.
+
+    Parámetros:
+        img (PIL.Image.Image): Imagen a clasificar.
+        tamanio (str): Tamaño del modelo ("s", "m", "l" o "x").
+
+    Devuelve:
+        list: Etiquetas del top-5.
+        list: Probabilidades del top-5.
+    """
+    indices, probs, nombres = _inferir(img, tamanio)
+    return [nombres[i] for i in indices], probs
+
+
+_nombres_por_modelo = {}
+
+
+def clasificar_url(image_url, tamanio="x"):
+    """
+    Clasifica la imagen de una URL. Si la imagen (identificada por el hash de su contenido) ya se había
+    clasificado con el mismo modelo, devuelve el resultado guardado en el almacén de detecciones sin
+    ejecutar el modelo; si no, la clasifica y guarda el resultado.
+
+    Parámetros:
+        image_url (str): URL de la imagen.
+        tamanio (str): Tamaño del modelo ("s", "m", "l" o "x").
+
+    Devuelve:
+        list: Etiquetas del top-5.
+        list: Probabilidades del top-5.
+    """
+    contenido_hash = sc.hash_contenido(image_url)
+    modelo = identificador_modelo(tamanio)
+
+    guardado = sd.consultar(contenido_hash, modelo)
+    if guardado is not None:
+        if modelo not in _nombres_por_modelo:
+            _nombres_por_modelo[modelo] = sd.obtener_nombres(modelo)
+        nombres = _nombres_por_modelo[modelo]
+        return [nombres[int(i)] for i in guardado[0]], [float(p) for p in guardado[1]]
+
+    img = sc.obtener_imagen(image_url, tamanio_minimo=tamanio_decodificacion)
+    indices, probs, nombres = _inferir(img, tamanio)
+    if modelo not in _nombres_por_modelo:
+        sd.guardar_nombres(modelo, nombres)
+        _nombres_por_modelo[modelo] = nombres
+    sd.guardar(contenido_hash, modelo, indices, probs, url=image_url)
+    return [nombres[i] for i in indices], probs
+
+
+def derivar_habitacion(detected_labels, confianzas=None, items_cocina=None, items_banio=None,
+                       coincidencias=None, probabilidad_minima=0.0):
+    """
+    Aplica la regla de cocina/baño a las etiquetas detectadas: requiere al menos `coincidencias_minimas`
+    coincidencias (2 por defecto) para clasificar la habitación, comprobando primero la cocina.
+
+    Parámetros:
+        detected_labels (list): Etiquetas detectadas en la imagen.
+        confianzas (list, opcional): Probabilidades de las etiquetas. Sólo se usan con probabilidad_minima.
+        items_cocina (list, opcional): Etiquetas de cocina. Por defecto, `kitchen_items`.
+        items_banio (list, opcional): Etiquetas de baño. Por defecto, `bathroom_items`.
+        coincidencias (int, opcional): Coincidencias necesarias. Por defecto, `coincidencias_minimas`.
+        probabilidad_minima (float): Probabilidad mínima para que una etiqueta cuente como coincidencia.
+
+    Devuelve:
+        str: Tipo de habitación ("kitchen", "bathroom" o None).
+    """
+    items_cocina = kitchen_items if items_cocina is None else items_cocina
+    items_banio = bathroom_items if items_banio is None else items_banio
+    coincidencias = coincidencias_minimas if coincidencias is None else coincidencias
+    if confianzas is not None and probabilidad_minima > 0:
+        detected_labels = [l for l, c in zip(detected_labels, confianzas) if c >= probabilidad_minima]
+
+    # Verificar coincidencias con elementos de cocina
+    kitchen_matches = 0
+    for item in detected_labels:
+        if item in items_cocina:
+            kitchen_matches += 1
+            if kitchen_matches >= coincidencias:
+                return "kitchen"
+
+    # Verificar coincidencias con elementos de baño
+    bathroom_matches = 0
+    for item in detected_labels:
+        if item in items_banio:
+            bathroom_matches += 1
+            if bathroom_matches >= coincidencias:
+                return "bathroom"
+
+    # Si no se detecta ningún tipo de habitación con el mínimo de coincidencias
+    return None
+
+
+def es_ambigua(detected_labels, confianzas):
+    """
+    Indica si el top-5 de un modelo es ambiguo para la regla de cocina/baño y debe escalarse al modelo grande.
+
+    Parámetros:
+        detected_labels (list): Etiquetas del top-5.
+        confianzas (list): Probabilidades del top-5.
+
+    Devuelve:
+        bool: True si la clasificación no es fiable con los umbrales de `config_cascada`.
+    """
+    if not detected_labels:
+        return True
+
+    prob_cocina = sum(c for l, c in zip(detected_labels, confianzas) if l in kitchen_items)
+    prob_banio = sum(c for l, c in zip(detected_labels, confianzas) if l in bathroom_items)
+    habitacion = derivar_habitacion(detected_labels)
+
+    if habitacion == "kitchen":
+        return prob_cocina < config_cascada["umbral_confirmacion"]
+    if habitacion == "bathroom":
+        return prob_banio < config_cascada["umbral_confirmacion"]
+    if prob_cocina == 0 and prob_banio == 0:
+        return confianzas[0] < config_cascada["umbral_descarte"]
+    # Una sola coincidencia: a un paso de cambiar de clase
+    return True
+
+
+def clasificar_con_cascada(img, clasificar=None):
+    """
+    Clasifica una imagen con el modelo pequeño y la escala al modelo grande si el resultado es ambiguo.
+
+    Parámetros:
+        img (PIL.Image.Image o str): Imagen a clasificar (o su URL, si se usa `clasificar_url`).
+        clasificar (callable, opcional): Función (img, tamanio) -> (etiquetas, probabilidades).
+            Por defecto, `clasificar_imagen`.
+
+    Devuelve:
+        list: Etiquetas del top-5 del último modelo utilizado.
+        list: Probabilidades del top-5 del último modelo utilizado.
+    """
+    clasificar = clasificar or clasificar_imagen
+    estadisticas_cascada["imagenes"] += 1
+    detected_labels, confianzas = clasificar(img, config_cascada["modelo_pequenio"])
+    if es_ambigua(detected_labels, confianzas):
+        estadisticas_cascada["escaladas"] += 1
+        detected_labels, confianzas = clasificar(img, config_cascada["modelo_grande"])
+    return detected_labels, confianzas
 
 
 def detectar_habitacion(image_url):
@@ -19,6 +454,8 @@ def detectar_habitacion(image_url):
     Detecta el tipo de habitación (cocina o baño) en una imagen dada su URL.
     Requiere al menos 2 coincidencias para clasificar la habitación y detiene 
     el procesamiento tan pronto como se encuentran 2 coincidencias para un tipo de habitación.
+    Si el modo cascada está activo (ver `configurar_cascada`), usa primero el modelo pequeño.
+    Las imágenes ya clasificadas se leen del almacén de detecciones sin volver a ejecutar el modelo.
 
     Parámetros:
         image_url (str): URL de la imagen a procesar.
@@ -28,65 +465,116 @@ def detectar_habitacion(image_url):
         list: Lista de todas las etiquetas detectadas en la imagen.
     """
     try:
-        response = requests.get(image_url, stream=True, timeout=10)
-        response.raise_for_status()
-        img = Image.open(response.raw)
+        # Si la foto es casi idéntica a otra ya clasificada, reutilizar su resultado
+        if config_deduplicacion["activa"]:
+            representante = indice_perceptual.agregar(
+                image_url, sc.hash_perceptual(image_url, config_deduplicacion["metodo"])
+            )
+            if representante in resultados_representantes:
+                if representante != image_url:
+                    estadisticas_deduplicacion["inferencias_evitadas"] += 1
+                # Sólo se guardan las etiquetas: la habitación se deriva con la regla vigente
+                detected_labels = resultados_representantes[representante]
+                return derivar_habitacion(detected_labels), detected_labels
 
         # Realizar detección con el modelo YOLO
-        results = model(img, verbose=False)
-
-        detected_labels = []
-        if hasattr(results[0], "probs"):
-            detected_labels = [model.names[int(class_id)] for class_id in results[0].probs.top5]
-
-        # Verificar coincidencias con elementos de cocina
-        kitchen_matches = 0
-        for item in detected_labels:
-            if item in kitchen_items:
-                kitchen_matches += 1
-                if kitchen_matches >= 2:
-                    return "kitchen", detected_labels
-
-        # Verificar coincidencias con elementos de baño
-        bathroom_matches = 0
-        for item in detected_labels:
-            if item in bathroom_items:
-                bathroom_matches += 1
-                if bathroom_matches >= 2:
-                    return "bathroom", detected_labels
-
-        # Si no se detecta ningún tipo de habitación con al menos 2 coincidencias
-        return None, detected_labels
+        if config_cascada["activa"]:
+            detected_labels, _ = clasificar_con_cascada(image_url, clasificar_url)
+        else:
+            detected_labels, _ = clasificar_url(image_url)
+
+        if config_deduplicacion["activa"]:
+            resultados_representantes[representante] = detected_labels
+        return derivar_habitacion(detected_labels), detected_labels
     except Exception as e:
         print(f"Error processing {image_url}: {e}")
         return None, []
 
 
-def procesar_urls(urls_as_string):
+def convertir_lista(valor):
+    """
+    Convierte una lista guardada como string (por ejemplo, al leer un CSV) en una lista de Python.
+
+    Parámetros:
+        valor (str o list): Lista o cadena con la representación de una lista.
+
+    Devuelve:
+        list: Lista de Python.
+    """
+    if isinstance(valor, list):
+        return valor
+    return ast.literal_eval(valor)
+
+
+def ordenar_urls_por_tags(urls, tags, saltar_irrelevantes=True):
+    """
+    Ordena las URLs de un anuncio según la etiqueta de Idealista de cada foto, de modo que
+    las etiquetadas como cocina o baño se clasifican primero.
+
+    Parámetros:
+        urls (list): Lista de URLs de las imágenes del anuncio.
+        tags (list): Lista de etiquetas de las imágenes, en el mismo orden que las URLs.
+        saltar_irrelevantes (bool): Si es True, las fotos con etiquetas de `tags_irrelevantes` se separan
+            para clasificarlas sólo si no se encuentran la cocina o el baño en el resto.
+
+    Devuelve:
+        list: URLs prioritarias, ordenadas por la prioridad de su etiqueta (orden estable).
+        list: URLs descartadas en primera instancia (vacía si saltar_irrelevantes es False).
+    """
+    prioritarias, descartadas = [], []
+    for url, tag in zip(urls, tags):
+        if tag in tags_irrelevantes:
+            prioridad = prioridad_por_defecto + 1 + tags_irrelevantes.index(tag)
+            (descartadas if saltar_irrelevantes else prioritarias).append((prioridad, url))
+        else:
+            prioritarias.append((prioridad_tags.get(tag, prioridad_por_defecto), url))
+
+    prioritarias = [url for _, url in sorted(prioritarias, key=lambda x: x[0])]
+    descartadas = [url for _, url in sorted(descartadas, key=lambda x: x[0])]
+    return prioritarias, descartadas
+
+
+def procesar_urls(urls_as_string, tags_as_string=None, saltar_irrelevantes=True):
     """
     Procesa una lista de URLs para identificar las imágenes correspondientes
     a una cocina y un baño, basándose en la detección del tipo de habitación.
+    Si se indican las etiquetas de Idealista, las fotos se clasifican por orden de prioridad
+    de su etiqueta y, si no se encuentran ambas habitaciones, se recurre al resto de fotos.
 
     Parámetros:
-        urls_as_string (str): Cadena que contiene una lista de URLs en formato string.
+        urls_as_string (str o list): Lista de URLs (o cadena que la contiene en formato string).
+        tags_as_string (str o list, opcional): Lista de etiquetas de las imágenes, en el mismo orden que las URLs.
+        saltar_irrelevantes (bool): Si es True, las fotos con etiquetas irrelevantes se dejan para el final.
 
     Devuelve:
         str: URL de la imagen identificada como cocina (o None si no se detecta).
         str: URL de la imagen identificada como baño (o None si no se detecta).
-        list: Lista de detecciones con información de las URLs procesadas y las etiquetas detectadas.
+        list: Lista de detecciones con información de las URLs procesadas y las etiquetas detectadas
+            ('duplicada' indica que el resultado se ha reutilizado de una foto casi idéntica, sin inferencia).
     """
     try:
-        urls = ast.literal_eval(urls_as_string)
+        urls = convertir_lista(urls_as_string)
+        tags = convertir_lista(tags_as_string) if tags_as_string is not None else None
     except Exception as e:
         print(f"Error al convertir las URLs: {e}")
         return None, None, []
 
+    if tags is not None and len(tags) == len(urls):
+        prioritarias, descartadas = ordenar_urls_por_tags(urls, tags, saltar_irrelevantes)
+        tag_por_url = dict(zip(urls, tags))
+    else:
+        prioritarias, descartadas = urls, []
+        tag_por_url = {}
+
     kitchen_url, bathroom_url = None, None
     all_detections = []
 
-    for url in urls:
+    # Las URLs descartadas sólo se llegan a clasificar si no se encuentran ambas habitaciones antes
+    for url in prioritarias + descartadas:
+        reutilizadas = estadisticas_deduplicacion["inferencias_evitadas"]
         detected_room, detections = detectar_habitacion(url)
-        all_detections.append({"url": url, "detecciones": detections, "habitación": detected_room})
+        all_detections.append({"url": url, "tag": tag_por_url.get(url), "detecciones": detections, "habitación": detected_room,
+                               "duplicada": estadisticas_deduplicacion["inferencias_evitadas"] > reutilizadas})
 
         if detected_room == "kitchen" and not kitchen_url:
             kitchen_url = url
@@ -99,7 +587,141 @@ def procesar_urls(urls_as_string):
     return kitchen_url, bathroom_url, all_detections
 
 
-def identificar_urls_habitaciones(df, columna_urls, drop_nulls=True):
+# Variables de configuración que se copian a los procesos del modo por fragmentos
+_variables_configuracion = [
+    "rutas_modelos", "config_cascada", "config_backend", "tamanio_decodificacion", "kitchen_items",
+    "bathroom_items", "coincidencias_minimas", "prioridad_tags", "prioridad_por_defecto", "tags_irrelevantes",
+    "config_deduplicacion",
+]
+
+
+def calcular_inferencias_evitadas(urls, detections):
+    """
+    Calcula cuántas fotos ha ahorrado examinar el orden por etiquetas frente a recorrerlas en el orden del
+    anuncio. La referencia es el número de fotos que habría examinado ese recorrido hasta encontrar ambas
+    habitaciones: la posición (en el orden original) de la última foto necesaria, tomando como cocina y baño
+    las primeras fotos del anuncio que se han clasificado como tales. Si falta alguna de las dos, el recorrido
+    original habría examinado todas las fotos.
+
+    La cifra es una cota superior del ahorro: las fotos que el orden por etiquetas se ha saltado no tienen
+    habitación conocida, y cualquiera de ellas anterior al punto de parada de la referencia podría haber sido la
+    cocina o el baño y haber detenido antes el recorrido original. Las fotos resueltas por deduplicación se
+    cuentan como examinadas en ambos recorridos (ver `contar_reutilizadas` para las inferencias que ha evitado
+    la deduplicación).
+
+    Parámetros:
+        urls (list): URLs del anuncio en su orden original.
+        detections (list): Detecciones devueltas por `procesar_urls` (una por foto examinada).
+
+    Devuelve:
+        int: Fotos de referencia menos fotos examinadas (negativo si el orden por etiquetas ha sido peor).
+    """
+    habitacion_por_url = {d["url"]: d["habitación"] for d in detections}
+    posiciones = {}
+    for posicion, url in enumerate(urls):
+        habitacion = habitacion_por_url.get(url)
+        if habitacion in ("kitchen", "bathroom") and habitacion not in posiciones:
+            posiciones[habitacion] = posicion
+
+    referencia = max(posiciones.values()) + 1 if len(posiciones) == 2 else len(urls)
+    return referencia - len(detections)
+
+
+def contar_reutilizadas(detections):
+    """
+    Devuelve cuántas de las fotos examinadas de un anuncio se han resuelto reutilizando el resultado de una
+    foto casi idéntica (deduplicación), sin ejecutar el modelo.
+    """
+    return sum(bool(d.get("duplicada")) for d in detections)
+
+
+def _procesar_anuncios(lista_urls, lista_tags, saltar_irrelevantes=True, progreso=None):
+    """
+    Aplica `procesar_urls` a una secuencia de anuncios.
+
+    Devuelve:
+        list: Tuplas (url_cocina, url_banio, inferencias_evitadas, reutilizadas) de cada anuncio, en el mismo
+            orden (ver `calcular_inferencias_evitadas` y `contar_reutilizadas`).
+        list: Detecciones de todos los anuncios, en el mismo orden.
+    """
+    resultados, all_detections = [], []
+    for urls, tags in zip(lista_urls, lista_tags):
+        kitchen_url, bathroom_url, detections = procesar_urls(urls, tags, saltar_irrelevantes)
+        all_detections.extend(detections)
+        try:
+            evitadas = calcular_inferencias_evitadas(convertir_lista(urls), detections)
+        except Exception:
+            evitadas = 0
+        resultados.append((kitchen_url, bathroom_url, evitadas, contar_reutilizadas(detections)))
+        if progreso is not None:
+            progreso.update()
+    return resultados, all_detections
+
+
+def _configuracion_almacenes():
+    """
+    Devuelve la ubicación de la caché de imágenes y del almacén de detecciones del proceso actual, que los
+    procesos del modo por fragmentos (arrancados con spawn) no heredan si se han cambiado con
+    `sc.configurar_cache` o `sd.configurar_almacen`.
+    """
+    return {"cache": (sc.DIRECTORIO_CACHE, sc.TAMANIO_MAXIMO_MB), "detecciones": sd.RUTA_ALMACEN}
+
+
+def _inicializar_proceso(configuracion, hilos, almacenes=None):
+    """
+    Prepara un proceso del modo por fragmentos: copia la configuración del proceso principal (incluidas la
+    caché de imágenes y el almacén de detecciones) y limita los hilos de inferencia. Cada proceso carga su
+    propia instancia del modelo en el primer uso.
+    """
+    globals().update(configuracion)
+    if almacenes is not None:
+        sc.configurar_cache(*almacenes["cache"])
+        sd.configurar_almacen(almacenes["detecciones"])
+    globals()["indice_perceptual"] = sc.IndicePerceptual(config_deduplicacion["distancia_maxima"])
+    config_backend["hilos"] = hilos
+    os.environ["OMP_NUM_THREADS"] = str(hilos)
+    if config_backend["backend"] == "pytorch":
+        import torch
+        torch.set_num_threads(hilos)
+
+
+def _procesar_fragmento(argumentos):
+    lista_urls, lista_tags, saltar_irrelevantes = argumentos
+    return _procesar_anuncios(lista_urls, lista_tags, saltar_irrelevantes)
+
+
+def _procesar_en_paralelo(lista_urls, lista_tags, saltar_irrelevantes, n_procesos, hilos_por_proceso=None):
+    """
+    Reparte los anuncios en fragmentos contiguos entre varios procesos y une los resultados en el orden original.
+    """
+    hilos = hilos_por_proceso or max(1, (os.cpu_count() or 1) // n_procesos)
+    configuracion = {nombre: globals()[nombre] for nombre in _variables_configuracion}
+    if config_deduplicacion["activa"]:
+        print("Aviso: con varios procesos, cada uno deduplica sólo las fotos que clasifica él mismo, de modo que "
+              "la deduplicación encuentra menos duplicados que con un solo proceso.")
+
+    # Más fragmentos que procesos para repartir mejor la carga; map conserva el orden de los fragmentos
+    n_fragmentos = max(1, min(len(lista_urls), n_procesos * 4))
+    fragmentos = [
+        ([lista_urls[i] for i in posiciones], [lista_tags[i] for i in posiciones], saltar_irrelevantes)
+        for posiciones in np.array_split(np.arange(len(lista_urls)), n_fragmentos)
+    ]
+
+    resultados, all_detections = [], []
+    with ProcessPoolExecutor(
+        max_workers=n_procesos, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_inicializar_proceso, initargs=(configuracion, hilos, _configuracion_almacenes())
+    ) as executor:
+        for resultados_fragmento, detecciones_fragmento in tqdm(
+            executor.map(_procesar_fragmento, fragmentos), total=len(fragmentos), desc="Fragmentos"
+        ):
+            resultados.extend(resultados_fragmento)
+            all_detections.extend(detecciones_fragmento)
+    return resultados, all_detections
+
+
+def identificar_urls_habitaciones(df, columna_urls, drop_nulls=True, columna_tags=None, saltar_irrelevantes=True,
+                                  n_procesos=1, hilos_por_proceso=None):
     """
     Identifica las URLs correspondientes a cocinas y baños en un DataFrame,
     basándose en la detección del tipo de habitación en las imágenes asociadas.
@@ -108,21 +730,48 @@ def identificar_urls_habitaciones(df, columna_urls, drop_nulls=True):
         df (pd.DataFrame): DataFrame que contiene una columna con listas de URLs a procesar.
         columna_urls (str): Nombre de la columna que contiene las listas de URLs.
         drop_nulls (bool): Si es True, elimina las filas donde no se detectan URLs de cocina o baño.
+        columna_tags (str, opcional): Nombre de la columna con las etiquetas de Idealista de las imágenes
+            (por ejemplo, 'tags_imagenes'). Si se indica, las fotos se clasifican por prioridad de etiqueta
+            y se añade la columna 'inferencias_evitadas' con una cota superior de las fotos ahorradas frente a
+            recorrerlas en el orden del anuncio (ver `calcular_inferencias_evitadas`). Con la deduplicación
+            activa se añade 'reutilizadas_deduplicacion' con las fotos que no han necesitado inferencia por ser
+            casi idénticas a otra ya clasificada.
+        saltar_irrelevantes (bool): Si es True, las fotos con etiquetas irrelevantes se dejan para el final.
+        n_procesos (int): Número de procesos. Si es mayor que 1, los anuncios se reparten en fragmentos
+            entre procesos, cada uno con su propia instancia del modelo, y los resultados se unen
+            en el orden original del DataFrame. Todos usan la caché de imágenes y el almacén de detecciones
+            configurados, pero cada uno tiene su propio índice de deduplicación (ver `configurar_deduplicacion`).
+        hilos_por_proceso (int, opcional): Hilos de inferencia de cada proceso. Por defecto, los núcleos
+            disponibles divididos entre el número de procesos.
 
     Devuelve:
         pd.DataFrame: DataFrame original actualizado con columnas 'url_cocina' y 'url_banio'.
         pd.DataFrame: DataFrame con todas las detecciones realizadas, incluyendo las etiquetas detectadas.
         pd.DataFrame: DataFrame con filas donde 'url_cocina' o 'url_banio' contienen valores nulos.
     """
-    tqdm.pandas()
-    all_detections = []
-
-    def process_row(urls):
-        kitchen_url, bathroom_url, detections = procesar_urls(urls)
-        all_detections.extend(detections)
-        return pd.Series([kitchen_url, bathroom_url])
-
-    df[["url_cocina", "url_banio"]] = df[columna_urls].progress_apply(process_row)
+    lista_urls = df[columna_urls].tolist()
+    lista_tags = df[columna_tags].tolist() if columna_tags is not None else [None] * len(df)
+
+    if n_procesos > 1:
+        resultados, all_detections = _procesar_en_paralelo(
+            lista_urls, lista_tags, saltar_irrelevantes, n_procesos, hilos_por_proceso
+        )
+    else:
+        with tqdm(total=len(df)) as progreso:
+            resultados, all_detections = _procesar_anuncios(lista_urls, lista_tags, saltar_irrelevantes, progreso)
+
+    df_resultados = pd.DataFrame(resultados, index=df.index, columns=[
+        "url_cocina", "url_banio", "inferencias_evitadas", "reutilizadas_deduplicacion"
+    ])
+    df["url_cocina"] = df_resultados["url_cocina"]
+    df["url_banio"] = df_resultados["url_banio"]
+    if columna_tags is not None:
+        df["inferencias_evitadas"] = df_resultados["inferencias_evitadas"]
+        print(f"Inferencias evitadas gracias a las etiquetas (cota superior): {df['inferencias_evitadas'].sum()} "
+              f"({df['inferencias_evitadas'].mean():.2f} por anuncio).")
+    if config_deduplicacion["activa"]:
+        df["reutilizadas_deduplicacion"] = df_resultados["reutilizadas_deduplicacion"]
+        print(f"Fotos resueltas por deduplicación, sin inferencia: {df['reutilizadas_deduplicacion'].sum()}.")
 
     df_nulos = df[df[['url_cocina', 'url_banio']].isnull().any(axis=1)].copy()
     
@@ -146,4 +795,113 @@ def asignar_URL(df):
         pd.DataFrame: DataFrame modificado con la nueva columna 'URL'.
     """
     df["URL"] = df["codigo"].apply(lambda x: f"https://www.idealista.com/inmueble/{x}/")
-    return df
\ No newline at end of file
+    return df
+
+
+def evaluar_cascada(df_etiquetado, columna_url="url", columna_etiqueta="habitación"):
+    """
+    Compara la precisión y el rendimiento del modo cascada con el del modelo grande en solitario
+    sobre una muestra etiquetada, con el backend configurado en `configurar_backend`. Las imágenes se
+    cargan y ambos modelos se ejecutan una vez sobre la primera antes de medir, de modo que los tiempos
+    sólo incluyen la inferencia (y no la carga o exportación de los modelos).
+
+    Parámetros:
+        df_etiquetado (pd.DataFrame): DataFrame con una columna de URLs y otra con la habitación real
+            ("kitchen", "bathroom" o None/NaN).
+        columna_url (str): Nombre de la columna con las URLs.
+        columna_etiqueta (str): Nombre de la columna con la habitación real.
+
+    Devuelve:
+        pd.DataFrame: Una fila por modo con el backend, la precisión, las imágenes por segundo, la tasa
+            de escalado al modelo grande y la aceleración frente al modelo grande.
+    """
+    imagenes, reales = [], []
+    for url, etiqueta in zip(df_etiquetado[columna_url], df_etiquetado[columna_etiqueta]):
+        try:
+            imagenes.append(sc.obtener_imagen(url, tamanio_minimo=tamanio_decodificacion))
+            reales.append(etiqueta if isinstance(etiqueta, str) else None)
+        except Exception as e:
+            print(f"Error processing {url}: {e}")
+
+    # Cargar ambos modelos con el backend configurado y hacer una inferencia de calentamiento antes de medir
+    modelo_grande = config_cascada["modelo_grande"]
+    if imagenes:
+        for tamanio in [config_cascada["modelo_pequenio"], modelo_grande]:
+            _inferir(imagenes[0], tamanio)
+
+    resultados = []
+    for modo, clasificar in [(modelo_grande, lambda img: clasificar_imagen(img, modelo_grande)),
+                             ("cascada", clasificar_con_cascada)]:
+        estadisticas_cascada.update({"imagenes": 0, "escaladas": 0})
+        inicio = time.perf_counter()
+        predichas = [derivar_habitacion(clasificar(img)[0]) for img in imagenes]
+        duracion = time.perf_counter() - inicio
+
+        aciertos = sum(p == r for p, r in zip(predichas, reales))
+        resultados.append({
+            "modo": modo,
+            "backend": identificador_modelo(modelo_grande).split("|")[1],
+            "imagenes": len(imagenes),
+            "precision": aciertos / len(imagenes) if imagenes else None,
+            "imagenes_por_segundo": len(imagenes) / duracion if duracion else None,
+            "tasa_escalado": (estadisticas_cascada["escaladas"] / estadisticas_cascada["imagenes"]
+                              if modo == "cascada" and estadisticas_cascada["imagenes"] else None),
+        })
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados["aceleracion"] = df_resultados["imagenes_por_segundo"] / df_resultados.loc[0, "imagenes_por_segundo"]
+    return df_resultados
+
+
+def reetiquetar_detecciones(df_detecciones, items_cocina=None, items_banio=None, coincidencias=None, probabilidad_minima=0.0):
+    """
+    Vuelve a derivar la habitación de cada imagen de `df_detecciones` a partir de las probabilidades
+    guardadas en el almacén de detecciones, sin descargar imágenes ni ejecutar el modelo. Permite probar
+    otras listas de etiquetas, otro número de coincidencias o un umbral de probabilidad.
+
+    Para recalcular 'url_cocina' y 'url_banio' con la nueva regla, basta con modificar `kitchen_items`,
+    `bathroom_items` o `coincidencias_minimas` y volver a llamar a `identificar_urls_habitaciones`: las imágenes
+    ya clasificadas se leen del almacén y sólo se ejecuta el modelo sobre las que no se habían procesado.
+
+    Parámetros:
+        df_detecciones (pd.DataFrame): DataFrame de detecciones devuelto por `identificar_urls_habitaciones`.
+        items_cocina (list, opcional): Etiquetas de cocina. Por defecto, `kitchen_items`.
+        items_banio (list, opcional): Etiquetas de baño. Por defecto, `bathroom_items`.
+        coincidencias (int, opcional): Coincidencias necesarias. Por defecto, `coincidencias_minimas`.
+        probabilidad_minima (float): Probabilidad mínima para que una etiqueta cuente como coincidencia.
+
+    Devuelve:
+        pd.DataFrame: Copia de df_detecciones con las columnas 'detecciones' y 'habitación' recalculadas
+            (se mantienen las originales de las imágenes que no están en el almacén).
+    """
+    # En modo cascada, si la imagen se escaló, el resultado válido es el del modelo grande
+    if config_cascada["activa"]:
+        modelos = [identificador_modelo(config_cascada["modelo_grande"]), identificador_modelo(config_cascada["modelo_pequenio"])]
+    else:
+        modelos = [identificador_modelo("x")]
+    nombres = {modelo: sd.obtener_nombres(modelo) for modelo in modelos}
+
+    df_resultado = df_detecciones.copy()
+    etiquetas_nuevas, habitaciones_nuevas = [], []
+    for url, etiquetas, habitacion in zip(df_resultado["url"], df_resultado["detecciones"], df_resultado["habitación"]):
+        contenido_hash = sd.hash_de_url(url)
+        guardado, modelo = None, None
+        if contenido_hash is not None:
+            for modelo in modelos:
+                guardado = sd.consultar(contenido_hash, modelo)
+                if guardado is not None:
+                    break
+        if guardado is None:
+            etiquetas_nuevas.append(etiquetas)
+            habitaciones_nuevas.append(habitacion)
+            continue
+
+        etiquetas = [nombres[modelo][int(i)] for i in guardado[0]]
+        etiquetas_nuevas.append(etiquetas)
+        habitaciones_nuevas.append(derivar_habitacion(
+            etiquetas, [float(p) for p in guardado[1]], items_cocina, items_banio, coincidencias, probabilidad_minima
+        ))
+
+    df_resultado["detecciones"] = etiquetas_nuevas
+    df_resultado["habitación"] = habitaciones_nuevas
+    return df_resultado
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Los módulos de soporte se importan como en los notebooks: `from src import ...`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# soporte_scoring exige la clave de la API al importarse; las pruebas usan un servidor local
+os.environ.setdefault("anthropic_key", "clave-de-pruebas")
@@ -0,0 +1,199 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def evaluar(ids):
+    """Respuesta por defecto: una evaluación válida para cada ID de la petición."""
+    return json.dumps([
+        {"id": i, "kitchen_rating": 4, "kitchen_size": 10, "bathroom_rating": 3, "bathroom_size": 5} for i in ids
+    ])
+
+
+def ids_peticion(contenido):
+    """IDs de las propiedades de una petición, según los textos que acompañan a cada foto."""
+    ids = []
+    for bloque in contenido:
+        if bloque.get("type") == "text":
+            for i in re.findall(r"Property (\w+) ", bloque["text"]):
+                if i not in ids:
+                    ids.append(i)
+    return ids
+
+
+def mensaje(texto, modelo="claude-3-haiku-20240307", uso=None):
+    return {
+        "id": "msg_local", "type": "message", "role": "assistant", "model": modelo,
+        "content": [{"type": "text", "text": texto}], "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": uso or {"input_tokens": 100, "output_tokens": 20},
+    }
+
+
+def tokens_texto(bloques):
+    """Tokens aproximados (4 caracteres por token) de los bloques de texto de un prompt."""
+    if isinstance(bloques, str):
+        return len(bloques) // 4
+    return sum(len(bloque.get("text", "")) // 4 for bloque in bloques or [])
+
+
+class ServidorAnthropic:
+    """
+    Servidor local que imita los endpoints de la API de Anthropic que usa soporte_scoring:
+    mensajes (con errores 429, 529 y 413 inyectados y prompt caching), recuento de tokens y trabajos por lotes
+    (Message Batches). Cada imagen cuenta como 100 tokens de entrada, y un prompt de sistema marcado con
+    cache_control que alcanza `minimo_cache` tokens se escribe en la caché la primera vez y se lee después.
+
+    Args:
+        errores_429 (int): Número de peticiones de mensajes que se responden con un 429 antes de atender.
+        errores_529 (int): Número de peticiones de mensajes que se responden con un 529 (API sobrecargada)
+            después de los 429.
+        max_propiedades (int): Propiedades máximas por petición; las mayores se rechazan con un 413.
+        respuesta (callable): Función (ids) -> texto de la respuesta del modelo.
+        resultado_lote (callable): Función (numero_trabajo, custom_id) -> tipo de resultado del trabajo
+            ("succeeded", "errored" o "expired").
+        latencia (float): Segundos que tarda cada respuesta de mensajes.
+        minimo_cache (int): Tokens mínimos del prefijo para que se cachee.
+    """
+
+    def __init__(self, errores_429=0, respuesta=evaluar, resultado_lote=None, latencia=0.0, minimo_cache=2048,
+                 errores_529=0, max_propiedades=None):
+        self.errores_429 = errores_429
+        self.errores_529 = errores_529
+        self.max_propiedades = max_propiedades
+        self.respuesta = respuesta
+        self.resultado_lote = resultado_lote or (lambda numero, custom_id: "succeeded")
+        self.latencia = latencia
+        self.minimo_cache = minimo_cache
+        self.prefijos_cacheados = set()
+        self.peticiones = []
+        self.respuestas_429 = 0
+        self.respuestas_529 = 0
+        self.respuestas_413 = 0
+        self.en_vuelo = 0
+        self.max_en_vuelo = 0
+        self.trabajos = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._http = ThreadingHTTPServer(("127.0.0.1", 0), self._manejador())
+        self.url = f"http://127.0.0.1:{self._http.server_address[1]}"
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._http.shutdown()
+        self._http.server_close()
+
+    def _trabajo(self, id_trabajo):
+        trabajo = self.trabajos[id_trabajo]
+        terminado = trabajo["consultas"] > 0
+        return {
+            "id": id_trabajo, "type": "message_batch", "processing_status": "ended" if terminado else "in_progress",
+            "request_counts": {"processing": 0 if terminado else len(trabajo["peticiones"]), "succeeded": 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2026-01-01T00:00:00Z", "expires_at": "2026-01-02T00:00:00Z",
+            "ended_at": "2026-01-01T01:00:00Z" if terminado else None, "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{id_trabajo}/results" if terminado else None,
+        }
+
+    def _uso(self, cuerpo):
+        contenido = cuerpo["messages"][0]["content"]
+        imagenes = sum(bloque.get("type") == "image" for bloque in contenido)
+        uso = {"input_tokens": 100 * imagenes + tokens_texto(contenido), "output_tokens": 20}
+        sistema = cuerpo.get("system") or []
+        prefijo = tokens_texto(sistema)
+        if not isinstance(sistema, str) and any("cache_control" in bloque for bloque in sistema) \
+                and prefijo >= self.minimo_cache:
+            clave = json.dumps(sistema, sort_keys=True)
+            with self._lock:
+                leido = clave in self.prefijos_cacheados
+                self.prefijos_cacheados.add(clave)
+            uso["cache_read_input_tokens" if leido else "cache_creation_input_tokens"] = prefijo
+        else:
+            uso["input_tokens"] += prefijo
+        return uso
+
+    def _resultados(self, id_trabajo):
+        trabajo = self.trabajos[id_trabajo]
+        lineas = []
+        for peticion in trabajo["peticiones"]:
+            tipo = self.resultado_lote(trabajo["numero"], peticion["custom_id"])
+            if tipo == "succeeded":
+                ids = ids_peticion(peticion["params"]["messages"][0]["content"])
+                resultado = {"type": "succeeded", "message": mensaje(self.respuesta(ids))}
+            elif tipo == "errored":
+                resultado = {"type": "errored", "error": {
+                    "type": "error", "error": {"type": "api_error", "message": "Error interno"}}}
+            else:
+                resultado = {"type": tipo}
+            lineas.append(json.dumps({"custom_id": peticion["custom_id"], "result": resultado}))
+        return "\n".join(lineas).encode()
+
+    def _manejador(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _enviar(self, cuerpo, estado=200, tipo="application/json", cabeceras=None):
+                datos = cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode()
+                self.send_response(estado)
+                self.send_header("content-type", tipo)
+                self.send_header("content-length", str(len(datos)))
+                for clave, valor in (cabeceras or {}).items():
+                    self.send_header(clave, valor)
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def do_POST(self):
+                cuerpo = json.loads(self.rfile.read(int(self.headers["content-length"])))
+                if self.path.startswith("/v1/messages/batches"):
+                    with servidor._lock:
+                        id_trabajo = f"msgbatch_{len(servidor.trabajos)}"
+                        servidor.trabajos[id_trabajo] = {
+                            "numero": len(servidor.trabajos), "peticiones": cuerpo["requests"], "consultas": 0
+                        }
+                    return self._enviar(servidor._trabajo(id_trabajo))
+
+                if self.path.startswith("/v1/messages/count_tokens"):
+                    contenido = cuerpo["messages"][0]["content"]
+                    return self._enviar({"input_tokens": tokens_texto(cuerpo.get("system")) + tokens_texto(contenido)})
+
+                ids = ids_peticion(cuerpo["messages"][0]["content"])
+                with servidor._lock:
+                    if servidor.respuestas_429 < servidor.errores_429:
+                        servidor.respuestas_429 += 1
+                        error = {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limited"}}
+                        return self._enviar(error, 429, cabeceras={"retry-after": "0"})
+                    if servidor.respuestas_529 < servidor.errores_529:
+                        servidor.respuestas_529 += 1
+                        error = {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}
+                        return self._enviar(error, 529)
+                    if servidor.max_propiedades is not None and len(ids) > servidor.max_propiedades:
+                        servidor.respuestas_413 += 1
+                        error = {"type": "error", "error": {"type": "request_too_large", "message": "Too large"}}
+                        return self._enviar(error, 413)
+                    servidor.peticiones.append(ids)
+                    servidor.en_vuelo += 1
+                    servidor.max_en_vuelo = max(servidor.max_en_vuelo, servidor.en_vuelo)
+                try:
+                    time.sleep(servidor.latencia)
+                    self._enviar(mensaje(servidor.respuesta(ids), cuerpo["model"], servidor._uso(cuerpo)))
+                finally:
+                    with servidor._lock:
+                        servidor.en_vuelo -= 1
+
+            def do_GET(self):
+                partes = self.path.split("?")[0].strip("/").split("/")
+                id_trabajo = partes[3]
+                if len(partes) == 5:
+                    return self._enviar(servidor._resultados(id_trabajo), tipo="application/binary")
+                respuesta = servidor._trabajo(id_trabajo)
+                servidor.trabajos[id_trabajo]["consultas"] += 1
+                self._enviar(respuesta)
+
+        return Manejador
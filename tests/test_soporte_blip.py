@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+from src import soporte_blip as sb
+
+
+def test_preprocesado_en_buffer_igual_que_el_procesador():
+    # La carpeta de modelos "transformers" del repositorio se importa como paquete vacío si la librería no está
+    blip = pytest.importorskip("transformers.models.blip")
+
+    class Procesador:
+        image_processor = blip.BlipImageProcessor(size={"height": 384, "width": 384})
+
+    generador = np.random.default_rng(0)
+    salida = np.empty((3, 384, 384), dtype=np.float32)
+    for ancho, alto in [(640, 480), (300, 500), (384, 384)]:
+        imagen = Image.fromarray(generador.integers(0, 256, (alto, ancho, 3), dtype=np.uint8))
+        esperado = Procesador.image_processor(images=imagen, return_tensors="np")["pixel_values"][0]
+
+        assert sb._preprocesar_imagen(Procesador, imagen, salida)
+        np.testing.assert_allclose(salida, esperado, atol=1e-5)
+
+    assert not sb._preprocesar_imagen(Procesador, None, salida)
+
+
+def test_frecuencias_por_grupo_equivalen_a_sumar_cada_grupo(tmp_path):
+    descripciones = ["a white kitchen with a sink", None, "a kitchen with a stove", "a bathroom with a sink",
+                     "a white bathroom", "a sink and a sink"]
+    indice = sb.IndiceDescripciones(descripciones, anuncios=["a1", "a1", "a2", "a2", None, "a3"],
+                                    habitaciones=["kitchen", "kitchen", "kitchen", "bathroom", "bathroom", None])
+    indice.guardar(str(tmp_path / "indice"))
+
+    for indice in [indice, sb.IndiceDescripciones.cargar(str(tmp_path / "indice"))]:
+        for por, grupos in [("anuncio", ["a1", "a2", "ND", "a3"]), ("habitacion", ["kitchen", "bathroom", "ND"])]:
+            frecuencias = indice.frecuencias(top=3, por=por)
+
+            assert frecuencias.index.tolist() == ["a", "sink", "with"]
+            assert frecuencias.columns.tolist() == grupos
+            for grupo in grupos:
+                textos = [d for d, g in zip(descripciones, indice.metadatos[por].fillna("ND")) if g == grupo and d]
+                palabras = " ".join(textos).split()
+                assert frecuencias[grupo].tolist() == [palabras.count(t) for t in ["a", "sink", "with"]]
+            pd.testing.assert_series_equal(frecuencias.sum(axis=1), indice.frecuencias(top=3), check_names=False)
+
+
+@pytest.mark.parametrize("aciertos, n", [(8, 10), (10, 10), (0, 25), (37, 66), (1, 3)])
+def test_intervalo_wilson_igual_que_scipy(aciertos, n):
+    from scipy.stats import binomtest
+
+    esperado = binomtest(aciertos, n).proportion_ci(confidence_level=0.95, method="wilson")
+
+    np.testing.assert_allclose(sb.intervalo_wilson(aciertos, n), (esperado.low, esperado.high), atol=1e-12)
+
+
+def test_intervalo_wilson_valores_conocidos():
+    np.testing.assert_allclose(sb.intervalo_wilson(8, 10), (0.4902, 0.9433), atol=1e-4)
+    assert sb.intervalo_wilson(0, 0) == (0.0, 1.0)
+
+
+@pytest.fixture
+def blip(monkeypatch):
+    """Sustituye BLIP por descripciones fijas: URL -> descripción (None si falla)."""
+    descripcion_por_url = {}
+
+    def generar_descripciones(df, columna, **kwargs):
+        return [descripcion_por_url[url] for url in df[columna]]
+
+    monkeypatch.setattr(sb, "generar_descripciones", generar_descripciones)
+    return descripcion_por_url
+
+
+def test_auditar_precision_usa_el_intervalo_de_wilson(blip):
+    df = pd.DataFrame({"url_cocina": [f"c{i}" for i in range(100)] + [None] * 5})
+    blip.update({f"c{i}": "a kitchen with a sink" if i % 4 else "a living room" for i in range(100)})
+    blip["c1"] = None
+
+    resumen, muestra = sb.auditar_precision(df, {"url_cocina": "kitchen"}, margen=0.2)
+
+    fila = resumen.iloc[0]
+    evaluada = muestra[muestra["descripcion"].notna()]
+    assert (fila["poblacion"], len(muestra)) == (100, sb.tamanio_muestra(100, 0.2))
+    assert fila["muestra"] == len(evaluada) and fila["aciertos"] == evaluada["correcta"].sum()
+    assert fila["precision"] == pytest.approx(evaluada["correcta"].mean())
+    np.testing.assert_allclose((fila["limite_inferior"], fila["limite_superior"]),
+                               sb.intervalo_wilson(fila["aciertos"], fila["muestra"]))
+
+
+def test_auditar_precision_estratificada(blip):
+    # Centro: 150 fotos, 4 de cada 5 bien clasificadas; Usera: 50 fotos, 1 de cada 2
+    df = pd.DataFrame({"url_cocina": [f"c{i}" for i in range(200)],
+                       "distrito": ["Centro"] * 150 + ["Usera"] * 50})
+    blip.update({f"c{i}": "a kitchen" if (i % 5 if i < 150 else i % 2) else "a bedroom" for i in range(200)})
+
+    resumen, muestra = sb.auditar_precision(df, {"url_cocina": "kitchen"}, margen=0.1, columna_estrato="distrito")
+
+    # Asignación proporcional del tamaño de muestra entre estratos
+    n = sb.tamanio_muestra(200, 0.1)
+    assert muestra["estrato"].value_counts().to_dict() == {"Centro": round(n * 0.75), "Usera": round(n * 0.25)}
+
+    # Estimador estratificado con corrección por población finita e intervalo normal
+    p = muestra.groupby("estrato")["correcta"].mean()
+    cuenta = muestra.groupby("estrato").size()
+    pesos = pd.Series({"Centro": 0.75, "Usera": 0.25})
+    precision = (pesos * p).sum()
+    varianza = (pesos ** 2 * p * (1 - p) / cuenta).sum() * (1 - len(muestra) / 200)
+    semiamplitud = 1.959963984540054 * np.sqrt(varianza)
+    fila = resumen.iloc[0]
+    assert fila["precision"] == pytest.approx(precision)
+    assert (fila["limite_inferior"], fila["limite_superior"]) == pytest.approx(
+        (precision - semiamplitud, precision + semiamplitud))
+
+
+def test_auditar_precision_estratificada_sin_varianza_usa_wilson(blip):
+    df = pd.DataFrame({"url_cocina": [f"c{i}" for i in range(60)], "distrito": ["Centro", "Usera"] * 30})
+    blip.update({f"c{i}": "a kitchen" for i in range(60)})
+
+    resumen, muestra = sb.auditar_precision(df, {"url_cocina": "kitchen"}, margen=0.2, columna_estrato="distrito")
+
+    fila = resumen.iloc[0]
+    assert fila["precision"] == 1.0
+    np.testing.assert_allclose((fila["limite_inferior"], fila["limite_superior"]),
+                               sb.intervalo_wilson(len(muestra), len(muestra)))
+    assert fila["limite_inferior"] < 1.0
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("sklearn")
+from src import soporte_modelo_local as sml
+from src import soporte_scoring as ss
+
+
+DIMENSION = 4
+
+
+def embeddings_sinteticos(n, semilla=0):
+    """Embeddings aleatorios de cocina y baño para n propiedades, por URL."""
+    generador = np.random.default_rng(semilla)
+    cocinas = {f"https://img.example/c{i}.jpg": generador.normal(size=DIMENSION).astype(np.float32) for i in range(n)}
+    banios = {f"https://img.example/b{i}.jpg": generador.normal(size=DIMENSION).astype(np.float32) for i in range(n)}
+    return cocinas, banios
+
+
+def puntuaciones_sinteticas(X, semilla=0):
+    """Puntuaciones (n, 4) que dependen linealmente de las variables, con ruido, en sus rangos."""
+    generador = np.random.default_rng(semilla)
+    pesos = generador.normal(size=(X.shape[1], 4))
+    y = X @ pesos + generador.normal(scale=0.3, size=(len(X), 4)) + [3, 8, 3, 5]
+    return np.column_stack([np.clip(np.rint(y[:, 0]), 1, 5), np.clip(np.rint(y[:, 1]), 1, None),
+                            np.clip(np.rint(y[:, 2]), 1, 5), np.clip(np.rint(y[:, 3]), 1, None)])
+
+
+@pytest.fixture
+def propiedades(monkeypatch):
+    """Propiedades con embeddings ya en la caché del proceso, de modo que no se carga ningún modelo YOLO."""
+    cocinas, banios = embeddings_sinteticos(40)
+    monkeypatch.setattr(sml, "_embeddings", {"s": {**cocinas, **banios}})
+    return pd.DataFrame({"url_cocina": list(cocinas), "url_banio": list(banios)})
+
+
+def test_embeddings_de_otro_tamanio_no_se_mezclan(monkeypatch):
+    monkeypatch.setattr(sml, "_embeddings", {
+        "m": {"https://img.example/c0.jpg": np.ones(8, dtype=np.float32)},
+        "s": {"https://img.example/c0.jpg": np.ones(DIMENSION, dtype=np.float32)},
+    })
+
+    embeddings = sml.calcular_embeddings(["https://img.example/c0.jpg", None], "s")
+
+    assert embeddings.shape == (2, DIMENSION)
+    assert embeddings[1].tolist() == [0.0] * DIMENSION
+
+
+def test_informe_calibracion_con_variables_sinteticas(propiedades):
+    X = sml.construir_variables(propiedades)
+    y = puntuaciones_sinteticas(X)
+    modelo = sml.ModeloLocalPuntuaciones(n_modelos=5, alpha=1.0).entrenar(X[:30], y[:30])
+
+    informe = sml.informe_calibracion(modelo, X[30:], y[30:], n_grupos=5, tasas_escalado=[0.0, 0.2, 0.5])
+
+    calibracion, escalado = informe["calibracion"], informe["escalado"]
+    assert len(calibracion) == 5 and calibracion["propiedades"].sum() == 10
+    assert calibracion["incertidumbre_media"].is_monotonic_increasing
+    assert escalado["escaladas"].tolist() == [0.0, 0.2, 0.5]
+    assert np.isinf(escalado.loc[0, "umbral_incertidumbre"])
+    # Las propiedades escaladas se toman como correctas: la precisión no baja al escalar más
+    assert escalado["puntuaciones_exactas"].is_monotonic_increasing
+    assert escalado["error_puntuacion"].is_monotonic_decreasing
+    assert informe["resumen"].loc[0, "propiedades"] == 10
+
+    # Con menos propiedades que grupos, un grupo por propiedad
+    assert len(sml.informe_calibracion(modelo, X[:3], y[:3], n_grupos=5)["calibracion"]) == 3
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Sustituye la API por una puntuación fija y registra las propiedades escaladas."""
+    escaladas = []
+
+    def analizar_propiedades(df, **kwargs):
+        escaladas.extend(df.index)
+        df[sml.COLUMNAS_PUNTUACION] = [5, 20, 5, 10]
+        return df, []
+
+    monkeypatch.setattr(ss, "analizar_propiedades", analizar_propiedades)
+    return escaladas
+
+
+def test_puntuar_con_modelo_local_escala_las_mas_inciertas(propiedades, api):
+    X = sml.construir_variables(propiedades)
+    modelo = sml.ModeloLocalPuntuaciones(n_modelos=5, alpha=1.0).entrenar(X, puntuaciones_sinteticas(X))
+    _, incertidumbre = modelo.predecir(X)
+
+    df = sml.puntuar_con_modelo_local(propiedades.copy(), modelo, tasa_escalado=0.1)
+
+    assert sorted(api) == sorted(np.argsort(-incertidumbre)[:4])
+    assert (df["origen_puntuacion"] == "api").sum() == 4
+    assert df.loc[api, sml.COLUMNAS_PUNTUACION].to_numpy().tolist() == [[5, 20, 5, 10]] * 4
+    assert df["incertidumbre_local"].notna().all()
+
+
+def test_puntuar_con_modelo_local_usa_el_umbral(propiedades, api):
+    X = sml.construir_variables(propiedades)
+    modelo = sml.ModeloLocalPuntuaciones(n_modelos=5, alpha=1.0).entrenar(X, puntuaciones_sinteticas(X))
+    _, incertidumbre = modelo.predecir(X)
+    umbral = np.median(incertidumbre)
+
+    # Las propiedades sin foto de cocina tienen 0 en la cocina y no dependen del modelo para ella
+    propiedades.loc[:4, "url_cocina"] = None
+    df = sml.puntuar_con_modelo_local(propiedades.copy(), modelo, umbral_incertidumbre=umbral)
+
+    _, incertidumbre = modelo.predecir(sml.construir_variables(propiedades))
+    assert sorted(api) == np.flatnonzero(incertidumbre > umbral).tolist()
+    assert (df["origen_puntuacion"] == "local").sum() == 40 - len(api)
+    locales = df[df["origen_puntuacion"] == "local"]
+    assert (locales.loc[locales.index < 5, ["puntuacion_cocina", "mts_cocina"]] == 0).all().all()
@@ -0,0 +1,250 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+pymongo = pytest.importorskip("pymongo")
+from shapely.geometry import Point
+
+# Servidor MongoDB local de pruebas; sin él, las pruebas se omiten
+URI_PRUEBAS = os.getenv("MONGO_URI_PRUEBAS", "mongodb://localhost:27017")
+os.environ.setdefault("mongo_uri", URI_PRUEBAS)
+
+from src import soporte_mongo as sm
+
+
+@pytest.fixture
+def bd():
+    cliente = pymongo.MongoClient(URI_PRUEBAS, serverSelectionTimeoutMS=1000)
+    try:
+        cliente.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        cliente.close()
+        pytest.skip(f"No hay un servidor MongoDB en {URI_PRUEBAS} (variable MONGO_URI_PRUEBAS).")
+    nombre = f"pruebas_soporte_mongo_{os.getpid()}"
+    yield sm.conectar_a_mongo(nombre, URI_PRUEBAS)
+    cliente.drop_database(nombre)
+    cliente.close()
+
+
+def anuncios(codigos, precio=100_000):
+    return gpd.GeoDataFrame(
+        {"codigo": codigos, "precio": [precio + i for i in range(len(codigos))]},
+        geometry=[Point(-0.88 + i / 100, 41.65) for i in range(len(codigos))], crs="EPSG:4326"
+    )
+
+
+def test_upsert_idempotente_aunque_cambie_el_indice(bd):
+    gdf = anuncios(["a1", "a2", "a3"])
+    assert sm.upsert_geodataframe_a_mongo(bd, gdf, "venta")["insertados"] == 3
+
+    # El mismo contenido filtrado, reordenado y reindexado no crea ni modifica documentos
+    reindexado = gdf.iloc[::-1].reset_index(drop=True)
+    recuento = sm.upsert_geodataframe_a_mongo(bd, reindexado, "venta")
+
+    assert (recuento["insertados"], recuento["actualizados"], recuento["sin_cambios"]) == (0, 0, 3)
+    assert bd["venta"].count_documents({}) == 3
+    assert sorted(bd["venta"].distinct("id")) == ["a1", "a2", "a3"]
+
+
+def test_upsert_elimina_los_anuncios_retirados(bd):
+    sm.upsert_geodataframe_a_mongo(bd, anuncios(["a1", "a2", "a3"]), "venta")
+
+    recuento = sm.upsert_geodataframe_a_mongo(bd, anuncios(["a1", "a3"], precio=90_000), "venta",
+                                              eliminar_ausentes=True)
+
+    assert recuento["eliminados"] == 1
+    assert recuento["actualizados"] == 2
+    assert sorted(bd["venta"].distinct("properties.codigo")) == ["a1", "a3"]
+
+
+def test_upsert_sustituye_el_documento_completo(bd):
+    df = pd.DataFrame({"codigo": [1, 2], "precio": [700, 800], "planta": [3, 5]})
+    sm.upsert_dataframe_a_mongo(bd, df, "alquiler")
+
+    # La columna desaparece del origen: también debe desaparecer de los documentos guardados
+    recuento = sm.upsert_dataframe_a_mongo(bd, df.drop(columns="planta"), "alquiler")
+
+    assert recuento["actualizados"] == 2
+    assert bd["alquiler"].count_documents({"planta": {"$exists": True}}) == 0
+
+
+def test_eliminar_ausentes_borra_en_bloques(bd):
+    df = pd.DataFrame({"codigo": list(range(10)), "precio": list(range(10))})
+    sm.upsert_dataframe_a_mongo(bd, df, "alquiler")
+    bd["alquiler"].insert_one({"precio": 1})
+
+    recuento = sm.upsert_dataframe_a_mongo(bd, df.iloc[:3], "alquiler", tamanio_bloque=2, eliminar_ausentes=True)
+
+    # Los siete anuncios retirados y el documento sin clave, borrados por _id en bloques de dos
+    assert recuento["eliminados"] == 8
+    assert sorted(bd["alquiler"].distinct("codigo")) == [0, 1, 2]
+
+
+def test_upsert_dataframe_exige_una_clave_unica(bd):
+    with pytest.raises(ValueError):
+        sm.upsert_dataframe_a_mongo(bd, pd.DataFrame({"codigo": [1, 1], "precio": [1, 2]}), "alquiler")
+    with pytest.raises(ValueError):
+        sm.upsert_dataframe_a_mongo(bd, pd.DataFrame({"precio": [1, 2]}), "alquiler")
+
+    df = pd.DataFrame({"codigo": [1, 2], "precio": [700, 800]})
+    sm.upsert_dataframe_a_mongo(bd, df, "alquiler")
+    assert sm.upsert_dataframe_a_mongo(bd, df, "alquiler")["sin_cambios"] == 2
+
+
+def test_documentos_a_dataframe_equivale_a_json_normalize():
+    documentos = [
+        {"_id": 1, "id": "a1", "properties": {"precio": 100_000.0, "habitaciones": 2, "destacado": True},
+         "geometry": {"type": "Point", "coordinates": [-0.88, 41.65]}},
+        {"_id": 2, "id": "a2", "properties": {"precio": None, "habitaciones": 3, "destacado": False},
+         "geometry": {"type": "Point", "coordinates": [-0.87, 41.65]}},
+        {"_id": 3, "id": "a3", "properties": {"precio": 90_000.0, "extra": {"planta": 4}},
+         "geometry": {"type": "Point", "coordinates": [-0.86, 41.65]}},
+    ]
+
+    df = sm.documentos_a_dataframe(documentos)
+
+    pd.testing.assert_frame_equal(df, pd.json_normalize(documentos, sep="_"), check_dtype=False)
+    assert df["_id"].dtype == "int64"
+    assert df["properties_precio"].dtype == "float64"
+    assert df["properties_habitaciones"].dtype == "float64"
+    assert df["properties_extra_planta"].isna().tolist() == [True, True, False]
+
+
+def test_decodificar_geometrias_conserva_agujeros_y_multipoligonos():
+    from shapely.geometry import mapping
+
+    exterior = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]]
+    agujero = [[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [2.0, 1.0], [1.0, 1.0]]
+    triangulo = [[5.0, 5.0], [6.0, 5.0], [5.0, 6.0], [5.0, 5.0]]
+    geometrias = [
+        {"type": "Polygon", "coordinates": [exterior, agujero]},
+        {"type": "Point", "coordinates": [-3.7, 40.4]},
+        {"type": "MultiPolygon", "coordinates": [[exterior, agujero], [triangulo]]},
+        None,
+        {"type": "Polygon", "coordinates": [triangulo]},
+        {"type": "LineString", "coordinates": [[0.0, 0.0], [1.0, 1.0]]},
+        {"type": "MultiPolygon", "coordinates": [[triangulo]]},
+    ]
+    tipos = pd.Series([g["type"] if g else None for g in geometrias])
+    coordenadas = pd.Series([g["coordinates"] if g else None for g in geometrias])
+
+    decodificadas = sm.decodificar_geometrias(tipos, coordenadas)
+
+    assert decodificadas[3] is None
+    assert decodificadas[0].area == 16 - 1 and len(decodificadas[0].interiors) == 1
+    assert [len(p.interiors) for p in decodificadas[2].geoms] == [1, 0]
+    for original, geometria in zip(geometrias, decodificadas):
+        if original is not None:
+            # Ida y vuelta a GeoJSON: mismo tipo y mismas coordenadas, anillo a anillo
+            geojson = json.loads(json.dumps(mapping(geometria)))
+            assert geojson == original
+
+
+def test_rectangulo_geojson_sigue_los_paralelos():
+    rectangulo = sm.rectangulo_geojson(-10, 40, 10, 41, paso_grados=0.1)
+    anillo = rectangulo["coordinates"][0]
+
+    # Los lados este-oeste se dividen en tramos de 0,1° sobre los paralelos de los límites
+    assert anillo[0] == anillo[-1] == [-10, 40]
+    assert {lat for _, lat in anillo} == {40, 41}
+    assert len(anillo) == 2 * 201 + 1
+    assert max(abs(b[0] - a[0]) for a, b in zip(anillo, anillo[1:]) if a[1] == b[1]) <= 0.1 + 1e-9
+
+
+def test_consultar_en_rectangulo_sigue_la_vista_plana(bd):
+    # Con sólo cuatro vértices, el lado sur (arco de círculo máximo) llega hasta unos 40,43° en lon 0
+    gdf = gpd.GeoDataFrame({"codigo": ["dentro", "fuera"]}, geometry=[Point(0, 40.2), Point(0, 39.9)],
+                           crs="EPSG:4326")
+    sm.upsert_geodataframe_a_mongo(bd, gdf, "venta")
+    sm.crear_indices_geoespaciales(bd)
+
+    resultado = sm.consultar_en_rectangulo(bd, "venta", -10, 40, 10, 41)
+
+    assert resultado["codigo"].tolist() == ["dentro"]
+
+
+def test_geometrias_invalidas_no_interrumpen_indices_ni_escrituras(bd, capsys):
+    lazo = {"type": "Polygon", "coordinates": [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]}
+    cuadrado = {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}
+    bd["distritos"].insert_many([{"id": "lazo", "geometry": lazo}, {"id": "bueno", "geometry": cuadrado}])
+    sm.upsert_geodataframe_a_mongo(bd, anuncios(["a1"]), "venta")
+
+    indices = sm.crear_indices_geoespaciales(bd)
+
+    assert indices["distritos"] is None and indices["venta"]
+    assert sm.geometrias_invalidas(bd["distritos"])["id"].tolist() == ["lazo"]
+    assert "lazo" in capsys.readouterr().out
+
+    # Con el índice creado, MongoDB rechaza el punto fuera de rango pero escribe el resto del bloque
+    gdf = anuncios(["a2", "a3"])
+    gdf.loc[1, "geometry"] = Point(200, 41.65)
+    recuento = sm.upsert_geodataframe_a_mongo(bd, gdf, "venta")
+
+    assert (recuento["insertados"], recuento["rechazados"]) == (1, 1)
+    assert sorted(bd["venta"].distinct("properties.codigo")) == ["a1", "a2"]
+
+
+@pytest.fixture
+def sin_clientes():
+    sm.cerrar_clientes()
+    yield
+    sm.cerrar_clientes()
+
+
+def test_obtener_cliente_reutiliza_el_cliente_del_proceso(sin_clientes):
+    cliente = sm.obtener_cliente(URI_PRUEBAS)
+
+    assert sm.obtener_cliente(URI_PRUEBAS) is cliente
+    assert sm.conectar_a_mongo("pruebas", URI_PRUEBAS).client is cliente
+
+
+def test_obtener_cliente_sustituye_un_cliente_cerrado(sin_clientes):
+    # Como hacían los notebooks al terminar: cerrar el cliente a través de la base de datos
+    bd = sm.conectar_a_mongo("pruebas", URI_PRUEBAS)
+    bd.client.close()
+
+    nuevo = sm.conectar_a_mongo("pruebas", URI_PRUEBAS).client
+
+    assert nuevo is not bd.client
+    assert nuevo is sm.obtener_cliente(URI_PRUEBAS)
+
+
+def test_cliente_compartido_sigue_funcionando_tras_cerrarlo(bd):
+    bd["venta"].insert_one({"codigo": "a1"})
+    bd.client.close()
+
+    bd = sm.conectar_a_mongo(bd.name, URI_PRUEBAS)
+
+    assert bd["venta"].count_documents({}) == 1
+
+
+@pytest.mark.parametrize("medir_bytes", [False, True])
+def test_metricas_mongo_registra_los_comandos(bd, monkeypatch, medir_bytes):
+    monkeypatch.setitem(sm.config_cliente, "medir_bytes", medir_bytes)
+    sm.metricas_mongo(reiniciar=True)
+    bd["venta"].insert_many([{"codigo": f"a{i}"} for i in range(3)])
+    list(bd["venta"].find())
+
+    metricas = sm.metricas_mongo(reiniciar=True)
+
+    assert metricas.loc["insert", "documentos"] == 3
+    assert metricas.loc["find", "documentos"] == 3
+    # Sin medir_bytes (por defecto) los comandos no se vuelven a serializar para medirlos
+    assert ((metricas["bytes_recibidos"] > 0) == medir_bytes).all()
+    assert sm.metricas_mongo().empty
+
+
+def test_comparar_importacion_mongo_de_extremo_a_extremo(bd):
+    from src import soporte_rendimiento as sr
+
+    sr.crear_coleccion_sintetica(bd, "venta", n=2_000)
+
+    resultados = sr.comparar_importacion_mongo(bd, "venta", campos=["properties.precio"])
+
+    assert resultados["variante"].tolist() == ["completa", "bloques", "bloques_proyeccion"]
+    assert (resultados["filas"] == 2_000).all()
+    assert resultados["columnas"].tolist()[:2] == [resultados.loc[0, "columnas"]] * 2
+    assert resultados.loc[2, "columnas"] == 1
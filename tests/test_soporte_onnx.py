@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from src import soporte_onnx as so
+
+
+# Tamaños con lado largo no entero tras escalar (640x480 -> 298,67) y con desplazamiento de recorte impar
+# (250x401 -> 224x359, 135 px que recortar)
+TAMANIOS = [(640, 480), (480, 640), (250, 401), (401, 250), (224, 224), (1000, 999), (300, 200)]
+
+
+def imagen_aleatoria(ancho, alto, semilla=0):
+    generador = np.random.default_rng(semilla)
+    return Image.fromarray(generador.integers(0, 256, (alto, ancho, 3), dtype=np.uint8))
+
+
+def transformaciones_ultralytics(img, imgsz=224):
+    """
+    Referencia de classify_transforms de ultralytics (sin torch): torchvision Resize(imgsz) sobre el lado corto
+    (el largo se trunca), CenterCrop(imgsz) (desplazamiento redondeado), ToTensor y Normalize(0, 1).
+    """
+    ancho, alto = img.size
+    corto, largo = (ancho, alto) if ancho <= alto else (alto, ancho)
+    nuevo_largo = int(imgsz * largo / corto)
+    nuevo = (imgsz, nuevo_largo) if ancho <= alto else (nuevo_largo, imgsz)
+    img = img.convert("RGB").resize(nuevo, Image.BILINEAR)
+    arriba = int(round((nuevo[1] - imgsz) / 2.0))
+    izquierda = int(round((nuevo[0] - imgsz) / 2.0))
+    img = img.crop((izquierda, arriba, izquierda + imgsz, arriba + imgsz))
+    return np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+
+
+@pytest.mark.parametrize("ancho, alto", TAMANIOS)
+def test_preprocesar_igual_que_ultralytics(ancho, alto):
+    img = imagen_aleatoria(ancho, alto)
+
+    np.testing.assert_allclose(so.preprocesar(img), transformaciones_ultralytics(img), atol=1e-6)
+
+
+def test_preprocesar_escribe_en_el_buffer():
+    salida = np.full((3, 224, 224), np.nan, dtype=np.float32)
+    img = imagen_aleatoria(640, 480)
+
+    resultado = so.preprocesar(img.convert("L"), salida=salida)
+
+    assert resultado is salida
+    assert np.isfinite(salida).all() and salida.min() >= 0 and salida.max() <= 1
+    np.testing.assert_array_equal(salida[0], salida[2])
+
+
+@pytest.mark.parametrize("ancho, alto", TAMANIOS)
+def test_preprocesar_igual_que_classify_transforms(ancho, alto):
+    augment = pytest.importorskip("ultralytics.data.augment")
+    img = imagen_aleatoria(ancho, alto)
+
+    esperado = augment.classify_transforms(224)(img).numpy()
+
+    np.testing.assert_allclose(so.preprocesar(img), esperado, atol=1e-6)
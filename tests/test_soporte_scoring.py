@@ -0,0 +1,241 @@
+import pandas as pd
+import pytest
+from tqdm import tqdm
+
+from src import soporte_scoring as ss
+from tests.servidor_anthropic import ServidorAnthropic, evaluar
+
+
+@pytest.fixture(autouse=True)
+def sin_descargas(monkeypatch):
+    """Evita descargar fotos y mostrar barras de progreso de Jupyter."""
+    monkeypatch.setattr(ss, "url_a_base64_con_mime",
+                        lambda url: ("aGVsbG8=", "image/jpeg") if isinstance(url, str) else (None, None))
+    monkeypatch.setattr(ss, "tqdm", tqdm)
+    monkeypatch.setattr(ss, "registro_uso", [])
+
+
+def catalogo(n):
+    return pd.DataFrame({
+        "codigo": [str(100 + i) for i in range(n)],
+        "url_cocina": [f"https://img.example/cocina/{i}.jpg" for i in range(n)],
+        "url_banio": [f"https://img.example/banio/{i}.jpg" for i in range(n)],
+    })
+
+
+def test_concurrente_reencola_sin_dividir_tras_429():
+    with ServidorAnthropic(errores_429=3) as servidor:
+        df, resultados = ss.analizar_propiedades_concurrente(
+            catalogo(6), batch=3, max_concurrencia=2, reintentos=1, usar_cache=False, base_url=servidor.url
+        )
+
+    assert servidor.respuestas_429 == 3
+    # Los lotes limitados vuelven enteros a la cola: ninguna petición se ha dividido
+    assert sorted(len(ids) for ids in servidor.peticiones) == [3, 3]
+    assert len(resultados) == 6
+    assert df["puntuacion_cocina"].tolist() == [4] * 6
+
+
+def test_concurrente_reencola_sin_dividir_tras_529():
+    with ServidorAnthropic(errores_529=2) as servidor:
+        df, resultados = ss.analizar_propiedades_concurrente(
+            catalogo(6), batch=3, max_concurrencia=1, reintentos=1, usar_cache=False, base_url=servidor.url
+        )
+
+    # El 529 (OverloadedError) no es un InternalServerError: el lote vuelve entero a la cola y no se pierde
+    assert servidor.respuestas_529 == 2
+    assert sorted(len(ids) for ids in servidor.peticiones) == [3, 3]
+    assert len(resultados) == 6
+    assert df["puntuacion_cocina"].tolist() == [4] * 6
+
+
+def test_concurrente_divide_peticiones_demasiado_grandes():
+    with ServidorAnthropic(max_propiedades=2) as servidor:
+        df, resultados = ss.analizar_propiedades_concurrente(
+            catalogo(4), batch=4, max_concurrencia=2, usar_cache=False, base_url=servidor.url
+        )
+
+    assert servidor.respuestas_413 == 1
+    assert sorted(len(ids) for ids in servidor.peticiones) == [2, 2]
+    assert len(resultados) == 4
+
+
+def test_concurrente_divide_respuestas_invalidas():
+    def respuesta(ids):
+        return "Sin JSON" if len(ids) > 1 else evaluar(ids)
+
+    with ServidorAnthropic(respuesta=respuesta) as servidor:
+        df, _ = ss.analizar_propiedades_concurrente(
+            catalogo(4), batch=4, max_concurrencia=2, usar_cache=False, base_url=servidor.url
+        )
+
+    assert sorted(len(ids) for ids in servidor.peticiones) == [1, 1, 1, 1, 2, 2, 4]
+    assert df["puntuacion_banio"].tolist() == [3] * 4
+
+
+def test_concurrente_mantiene_los_trabajadores_con_la_cola_vacia():
+    def respuesta(ids):
+        return evaluar(ids[:1]) if len(ids) > 1 else evaluar(ids)
+
+    # Un solo lote: las mitades reencoladas deben repartirse entre los trabajadores que esperan en la cola
+    with ServidorAnthropic(respuesta=respuesta, latencia=0.2) as servidor:
+        df, _ = ss.analizar_propiedades_concurrente(
+            catalogo(5), batch=5, max_concurrencia=2, usar_cache=False, base_url=servidor.url
+        )
+
+    assert servidor.max_en_vuelo == 2
+    assert df["puntuacion_cocina"].notna().all()
+
+
+def test_lotes_reanudar_reenvia_peticiones_fallidas_y_caducadas(tmp_path):
+    def resultado_lote(numero_trabajo, custom_id):
+        if numero_trabajo == 0:
+            return {"lote-000001": "errored", "lote-000002": "expired"}.get(custom_id, "succeeded")
+        return "succeeded"
+
+    ruta_estado = str(tmp_path / "trabajos.json")
+    with ServidorAnthropic(resultado_lote=resultado_lote) as servidor:
+        df = ss.analizar_propiedades_por_lotes(catalogo(6), ruta_estado, batch=2, intervalo=0, base_url=servidor.url)
+        assert df["puntuacion_cocina"].notna().sum() == 2
+        assert len(ss._cargar_estado(ruta_estado)["errores"]) == 2
+
+        # Al reanudar sólo se vuelven a enviar las cuatro propiedades de las peticiones con errores
+        df = ss.analizar_propiedades_por_lotes(df, ruta_estado, batch=2, intervalo=0, base_url=servidor.url)
+
+    assert len(servidor.trabajos) == 2
+    assert len(servidor.trabajos["msgbatch_1"]["peticiones"]) == 2
+    assert df["puntuacion_cocina"].tolist() == [4] * 6
+    assert ss._cargar_estado(ruta_estado)["errores"] == {}
+
+
+def test_lotes_reenvios_limitados(tmp_path):
+    ruta_estado = str(tmp_path / "trabajos.json")
+    with ServidorAnthropic(resultado_lote=lambda numero, custom_id: "errored") as servidor:
+        for _ in range(3):
+            ss.analizar_propiedades_por_lotes(catalogo(2), ruta_estado, batch=2, intervalo=0,
+                                              base_url=servidor.url, max_reenvios=1)
+
+    # El envío inicial y un único reenvío
+    assert len(servidor.trabajos) == 2
+    estado = ss._cargar_estado(ruta_estado)
+    assert estado["reenvios"] == {"100": 1, "101": 1}
+    assert list(estado["errores"].values()) == ["errored"]
+
+
+def test_concurrente_no_guarda_ceros_de_fotos_no_preparadas(tmp_path, monkeypatch):
+    ruta_original = ss.sp.RUTA_ALMACEN
+    ss.sp.configurar_almacen(str(tmp_path / "puntuaciones.sqlite"))
+    monkeypatch.setattr(ss, "_hashes_propiedad", lambda cocina, banio: (cocina, banio))
+    # Las fotos de la propiedad 1 fallan de forma transitoria al prepararse
+    monkeypatch.setattr(ss, "url_a_base64_con_mime", lambda url: (None, None) if url.endswith("/1.jpg")
+                        else ("aGVsbG8=", "image/jpeg"))
+    try:
+        with ServidorAnthropic() as servidor:
+            df, _ = ss.analizar_propiedades_concurrente(catalogo(3), batch=3, base_url=servidor.url)
+
+        assert df["puntuacion_cocina"].tolist() == [4, 0, 4]
+        assert ss.sp.estadisticas_almacen()["evaluaciones"] == 2
+        assert ss.sp.consultar(df.at[1, "url_cocina"], df.at[1, "url_banio"], ss.MODELO_SCORING,
+                               ss.version_prompt()) is None
+    finally:
+        ss.sp.configurar_almacen(ruta_original)
+
+
+@pytest.mark.parametrize("lado_maximo", [1024, 300])
+def test_reducir_imagen_aplica_la_orientacion_exif(lado_maximo):
+    from io import BytesIO
+    from PIL import Image
+
+    # Foto de móvil de 400x200 guardada en horizontal con orientación 6 (girar 90° en sentido horario)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    salida = BytesIO()
+    Image.new("RGB", (400, 200), "white").save(salida, format="JPEG", exif=exif.tobytes())
+
+    reducida = Image.open(BytesIO(ss.reducir_imagen(salida.getvalue(), lado_maximo)))
+
+    escala = min(1, lado_maximo / 400)
+    assert reducida.size == (round(200 * escala), round(400 * escala))
+    assert reducida.getexif().get(0x0112, 1) == 1
+
+
+def test_interpretar_respuesta_descarta_solo_las_entradas_mal_formadas():
+    texto = """Evaluación:
+    [{"id": 1, "kitchen_rating": 4, "kitchen_size": 10, "bathroom_rating": 3, "bathroom_size": 5},
+     {"kitchen_rating": 2, "kitchen_size": 8, "bathroom_rating": 2, "bathroom_size": 4},
+     {"id": "3", "kitchen_rating": 9, "kitchen_size": 8, "bathroom_rating": 2, "bathroom_size": 4},
+     "texto suelto",
+     {"id": 5, "kitchen_rating": 5, "kitchen_size": 12, "bathroom_rating": 0, "bathroom_size": 0}]"""
+
+    assert ss.interpretar_respuesta(texto) == {"1": (4, 10, 3, 5), "5": (5, 12, 0, 0)}
+
+
+def test_prompt_sistema_solo_marca_la_cache_si_el_prefijo_alcanza_el_minimo(monkeypatch):
+    # Con la guía de evaluación, el prompt de sistema supera el mínimo de 2048 tokens de Haiku
+    assert ss.tokens_prefijo() >= ss.minimo_tokens_cache()
+    assert ss.prompt_sistema()[0]["cache_control"] == {"type": "ephemeral"}
+    monkeypatch.setitem(ss.config_prompt, "cache", False)
+    assert "cache_control" not in ss.prompt_sistema()[0]
+
+    # Las instrucciones solas (~300 tokens) no se marcarían: la API no las cachearía
+    monkeypatch.setitem(ss.config_prompt, "cache", True)
+    monkeypatch.setattr(ss, "GUIA_EVALUACION", "")
+    assert "cache_control" not in ss.prompt_sistema()[0]
+
+
+def test_medir_cache_prompt_lee_el_prefijo_de_la_cache():
+    with ServidorAnthropic() as servidor:
+        df = ss.medir_cache_prompt(catalogo(9), batch=3, muestra=9, base_url=servidor.url).set_index("modo")
+
+    assert df.index.tolist() == ["instrucciones_en_mensaje", "sin_cache", "con_cache"]
+    assert (df["peticiones"] == 3).all()
+    # La primera petición con caché escribe el prefijo y las dos siguientes lo leen
+    assert df.loc["con_cache", "tokens_cache_escritura"] == df["tokens_prefijo"].iloc[0]
+    assert df.loc["con_cache", "tokens_cache_lectura"] == 2 * df["tokens_prefijo"].iloc[0]
+    assert df.loc["sin_cache", "tokens_cache_lectura"] == 0
+    assert df.loc["con_cache", "coste_entrada_por_peticion"] < df.loc["sin_cache", "coste_entrada_por_peticion"]
+    assert (df["coincidencia_puntuaciones"] == 1).all()
+    assert (df["propiedades_comparadas"] == 9).all()
+
+
+def test_hoja_contacto_coloca_cada_foto_en_su_celda(monkeypatch):
+    import base64
+    from io import BytesIO
+    from PIL import Image
+
+    def png(ancho, alto, color):
+        salida = BytesIO()
+        Image.new("RGB", (ancho, alto), color).save(salida, format="PNG")
+        return base64.b64encode(salida.getvalue()).decode()
+
+    # Registrar los textos dibujados en la hoja
+    textos = []
+    texto_original = ss.ImageDraw.ImageDraw.text
+
+    def text(self, xy, texto, *args, **kwargs):
+        textos.append((xy, texto))
+        return texto_original(self, xy, texto, *args, **kwargs)
+
+    monkeypatch.setattr(ss.ImageDraw.ImageDraw, "text", text)
+    imagenes = [
+        (png(160, 120, "red"), "image/png", png(60, 120, "blue"), "image/png"),
+        (None, None, png(200, 150, "green"), "image/png"),
+    ]
+
+    hoja = ss.componer_hoja_contacto(imagenes, ["101", "102"], ancho_celda=128, alto_celda=96)
+
+    # Dos columnas (cocina, baño) y una fila por propiedad de 32 px de etiqueta + la celda
+    assert hoja.size == (256, 2 * (96 + 32))
+    assert [texto for _, texto in textos] == [
+        "Property 101 Kitchen", "Property 101 Bathroom", "Property 102 Kitchen", "No photo", "Property 102 Bathroom",
+    ]
+    assert textos[3][0] == (64, 128 + 32 + 48)
+    # Cada foto reducida a la celda y centrada; la vertical de 60x120 queda en 48x96 con márgenes blancos
+    assert hoja.getpixel((64, 80)) == (255, 0, 0)
+    assert hoja.getpixel((192, 80)) == (0, 0, 255)
+    assert hoja.getpixel((140, 80)) == (255, 255, 255)
+    assert hoja.getpixel((192, 128 + 80)) == (0, 128, 0)
+    # La celda sin foto no tiene ninguna foto pegada y las etiquetas van en una franja negra
+    celda_vacia = hoja.crop((2, 128 + 34, 126, 254)).getcolors()
+    assert {color for _, color in celda_vacia} <= {(r, r, r) for r in range(256)}
+    assert hoja.getpixel((126, 2)) == (0, 0, 0)
@@ -0,0 +1,150 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from src import soporte_yolo as sy
+
+
+URLS = [f"https://img.example/{i}.jpg" for i in range(10)]
+
+
+@pytest.fixture
+def habitaciones(monkeypatch):
+    """Sustituye el clasificador por un diccionario URL -> habitación y registra las URLs clasificadas."""
+    habitacion_por_url = {}
+    clasificadas = []
+
+    def detectar(url):
+        clasificadas.append(url)
+        return habitacion_por_url.get(url), []
+
+    monkeypatch.setattr(sy, "detectar_habitacion", detectar)
+    return habitacion_por_url, clasificadas
+
+
+def test_tags_sin_informacion_no_ahorran_inferencias(habitaciones):
+    habitacion_por_url, clasificadas = habitaciones
+    habitacion_por_url.update({URLS[0]: "kitchen", URLS[1]: "bathroom"})
+    tags = ["Sin Tag"] * len(URLS)
+
+    resultados, _ = sy._procesar_anuncios([URLS], [tags])
+
+    assert resultados == [(URLS[0], URLS[1], 0, 0)]
+    assert clasificadas == URLS[:2]
+
+
+def test_tags_informativos_ahorran_las_fotos_anteriores(habitaciones):
+    habitacion_por_url, clasificadas = habitaciones
+    habitacion_por_url.update({URLS[7]: "kitchen", URLS[8]: "bathroom"})
+    tags = ["livingRoom"] * 7 + ["kitchen", "bathroom", "facade"]
+
+    resultados, _ = sy._procesar_anuncios([URLS], [tags])
+
+    # El recorrido en el orden del anuncio habría clasificado como mucho 9 fotos; con las etiquetas, 2
+    assert resultados == [(URLS[7], URLS[8], 7, 0)]
+    assert clasificadas == [URLS[7], URLS[8]]
+
+
+def test_sin_ambas_habitaciones_la_referencia_es_el_anuncio_completo(habitaciones):
+    habitacion_por_url, _ = habitaciones
+    habitacion_por_url.update({URLS[3]: "kitchen"})
+    tags = ["Sin Tag"] * 9 + ["facade"]
+
+    resultados, _ = sy._procesar_anuncios([URLS], [tags])
+
+    assert resultados == [(URLS[3], None, 0, 0)]
+
+
+def test_duplicados_derivan_la_habitacion_con_la_regla_vigente(monkeypatch):
+    etiquetas = ["refrigerator", "microwave", "toilet", "shower", "bathtub"]
+    monkeypatch.setattr(sy.sc, "hash_perceptual", lambda url, metodo: 0)
+    monkeypatch.setattr(sy, "clasificar_url", lambda url: (etiquetas, [0.2] * 5))
+    monkeypatch.setattr(sy, "kitchen_items", list(sy.kitchen_items))
+    sy.configurar_deduplicacion(activa=True)
+    try:
+        assert sy.detectar_habitacion(URLS[0]) == ("kitchen", etiquetas)
+
+        # Sin nevera en la lista de cocina, el duplicado deja de ser cocina aunque no se vuelva a clasificar
+        sy.kitchen_items.remove("refrigerator")
+        monkeypatch.setattr(sy, "clasificar_url", lambda url: pytest.fail("el duplicado no debe clasificarse"))
+        assert sy.detectar_habitacion(URLS[1]) == ("bathroom", etiquetas)
+        assert sy.resumen_deduplicacion()["inferencias_evitadas"] == 1
+    finally:
+        sy.configurar_deduplicacion(activa=False)
+
+
+def test_reutilizadas_por_deduplicacion_se_cuentan_aparte(monkeypatch):
+    hashes = {URLS[0]: 0, URLS[1]: 1, URLS[2]: 2 ** 64 - 1, URLS[3]: 0x0F0F0F0F0F0F0F0F}
+    monkeypatch.setattr(sy.sc, "hash_perceptual", lambda url, metodo: hashes[url])
+    monkeypatch.setattr(sy, "clasificar_url", lambda url: (["sofa"], [0.9]))
+    sy.configurar_deduplicacion(activa=True)
+    try:
+        # Las dos primeras fotos son casi idénticas: la segunda reutiliza el resultado de la primera
+        resultados, detecciones = sy._procesar_anuncios([URLS[:4]], [None])
+    finally:
+        sy.configurar_deduplicacion(activa=False)
+
+    assert resultados == [(None, None, 0, 1)]
+    assert [d["duplicada"] for d in detecciones] == [False, True, False, False]
+
+
+def _ubicaciones_almacenes(_):
+    return sy.sc.DIRECTORIO_CACHE, sy.sc.TAMANIO_MAXIMO_MB, sy.sd.RUTA_ALMACEN
+
+
+def test_procesos_usan_la_cache_y_el_almacen_configurados(tmp_path, monkeypatch):
+    monkeypatch.setattr(sy.sc, "DIRECTORIO_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(sy.sc, "TAMANIO_MAXIMO_MB", 64.0)
+    monkeypatch.setattr(sy.sd, "RUTA_ALMACEN", str(tmp_path / "detecciones.sqlite"))
+    configuracion = {nombre: getattr(sy, nombre) for nombre in sy._variables_configuracion}
+    configuracion["config_backend"] = {**sy.config_backend, "backend": "onnx"}
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=sy._inicializar_proceso,
+                             initargs=(configuracion, 1, sy._configuracion_almacenes())) as executor:
+        ubicaciones = executor.submit(_ubicaciones_almacenes, None).result()
+
+    assert ubicaciones == (str(tmp_path / "cache"), 64.0, str(tmp_path / "detecciones.sqlite"))
+
+
+@pytest.mark.parametrize("etiquetas, confianzas, ambigua", [
+    # Cocina con dos coincidencias que suman al menos umbral_confirmacion (0.5): se acepta
+    (["stove", "oven", "dishwasher", "sink", "cabinet"], [0.4, 0.2, 0.2, 0.1, 0.1], False),
+    # Cocina con dos coincidencias de poca probabilidad: se escala
+    (["dishwasher", "stove", "oven", "sink", "cabinet"], [0.6, 0.2, 0.1, 0.05, 0.05], True),
+    (["toilet", "bathtub", "shower", "sink", "tub"], [0.3, 0.2, 0.1, 0.2, 0.2], False),
+    (["sink", "toilet", "shower", "tub", "cabinet"], [0.7, 0.1, 0.1, 0.05, 0.05], True),
+    # Sin coincidencias: se descarta sólo si el top-1 es seguro (umbral_descarte, 0.5)
+    (["sofa", "table", "lamp", "rug", "chair"], [0.8, 0.1, 0.05, 0.03, 0.02], False),
+    (["sofa", "table", "lamp", "rug", "chair"], [0.3, 0.3, 0.2, 0.1, 0.1], True),
+    # Una sola coincidencia: a un paso de cambiar de habitación, siempre se escala
+    (["stove", "sofa", "table", "lamp", "rug"], [0.9, 0.04, 0.03, 0.02, 0.01], True),
+    ([], [], True),
+])
+def test_es_ambigua(monkeypatch, etiquetas, confianzas, ambigua):
+    monkeypatch.setitem(sy.config_cascada, "umbral_confirmacion", 0.5)
+    monkeypatch.setitem(sy.config_cascada, "umbral_descarte", 0.5)
+
+    assert sy.es_ambigua(etiquetas, confianzas) is ambigua
+
+
+def test_cascada_solo_escala_las_ambiguas(monkeypatch):
+    monkeypatch.setattr(sy, "estadisticas_cascada", {"imagenes": 0, "escaladas": 0})
+    monkeypatch.setitem(sy.config_cascada, "modelo_pequenio", "s")
+    monkeypatch.setitem(sy.config_cascada, "modelo_grande", "x")
+    top5 = {
+        ("clara", "s"): (["stove", "oven", "sink", "cabinet", "sofa"], [0.5, 0.3, 0.1, 0.05, 0.05]),
+        ("dudosa", "s"): (["stove", "sofa", "table", "lamp", "rug"], [0.4, 0.3, 0.1, 0.1, 0.1]),
+        ("dudosa", "x"): (["toilet", "shower", "sink", "tub", "rug"], [0.6, 0.2, 0.1, 0.05, 0.05]),
+    }
+    llamadas = []
+
+    def clasificar(img, tamanio):
+        llamadas.append((img, tamanio))
+        return top5[(img, tamanio)]
+
+    assert sy.clasificar_con_cascada("clara", clasificar) == top5[("clara", "s")]
+    assert sy.clasificar_con_cascada("dudosa", clasificar) == top5[("dudosa", "x")]
+    assert llamadas == [("clara", "s"), ("dudosa", "s"), ("dudosa", "x")]
+    assert sy.estadisticas_cascada == {"imagenes": 2, "escaladas": 1}